@@ -1,7 +1,19 @@
 # flake8: noqa
-from .predicate import P
-from .predicate import PredicateQuerySet
+import sys
 
 __version__ = '2.0.1'
 __all__ = ['P', 'PredicateQuerySet']
 
+if sys.version_info < (3, 7):
+    from .predicate import P
+    from .predicate import PredicateQuerySet
+else:
+    def __getattr__(name):
+        # P subclasses Django's Q, which loads the ORM, so it is only imported
+        # when first used. This keeps `import predicate` and imports of
+        # submodules that don't need the ORM, such as lookup_utils, fast.
+        if name in __all__:
+            from . import predicate
+            value = globals()[name] = getattr(predicate, name)
+            return value
+        raise AttributeError('module %r has no attribute %r' % (__name__, name))
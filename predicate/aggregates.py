@@ -0,0 +1,172 @@
+"""
+In-memory computation of Django aggregates, for PredicateQuerySet.
+"""
+from django.db.models import F
+from django.db.models.expressions import Star
+
+from .predicate import GET
+from .predicate import LookupComponent
+from .predicate import LookupNode
+from .predicate import lookup_rows
+
+
+class Accumulator(object):
+    """
+    Running state of one aggregate, over the values it is given one at a time.
+
+    None values are ignored, as in SQL. Only distinct values are kept for
+    aggregates with ``distinct=True``; otherwise state is constant in size.
+    """
+    def __init__(self, aggregate):
+        self.default = getattr(aggregate, 'default', None)
+        self.seen = set() if getattr(aggregate, 'distinct', False) else None
+
+    def add(self, value):
+        if value is None:
+            return
+        if self.seen is not None:
+            if value in self.seen:
+                return
+            self.seen.add(value)
+        self.update(value)
+
+    def update(self, value):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+
+class CountAccumulator(Accumulator):
+    def __init__(self, aggregate):
+        super(CountAccumulator, self).__init__(aggregate)
+        self.count = 0
+
+    def update(self, value):
+        self.count += 1
+
+    def result(self):
+        return self.count
+
+
+class SumAccumulator(Accumulator):
+    def __init__(self, aggregate):
+        super(SumAccumulator, self).__init__(aggregate)
+        self.total = None
+
+    def update(self, value):
+        self.total = value if self.total is None else self.total + value
+
+    def result(self):
+        return self.default if self.total is None else self.total
+
+
+class MinAccumulator(Accumulator):
+    def __init__(self, aggregate):
+        super(MinAccumulator, self).__init__(aggregate)
+        self.value = None
+
+    def update(self, value):
+        if self.value is None or value < self.value:
+            self.value = value
+
+    def result(self):
+        return self.default if self.value is None else self.value
+
+
+class MaxAccumulator(MinAccumulator):
+    def update(self, value):
+        if self.value is None or value > self.value:
+            self.value = value
+
+
+class AvgAccumulator(Accumulator):
+    def __init__(self, aggregate):
+        super(AvgAccumulator, self).__init__(aggregate)
+        self.total = 0
+        self.count = 0
+
+    def update(self, value):
+        self.total += value
+        self.count += 1
+
+    def result(self):
+        # Dividing by the int count keeps Decimal totals Decimal.
+        return self.total / self.count if self.count else self.default
+
+
+AGGREGATE_TO_ACCUMULATOR = {
+    'Count': CountAccumulator,
+    'Sum': SumAccumulator,
+    'Min': MinAccumulator,
+    'Max': MaxAccumulator,
+    'Avg': AvgAccumulator,
+}
+
+
+def _source_lookup(aggregate):
+    """
+    Returns the lookup an aggregate is computed over, or None for ``'*'``.
+    """
+    if aggregate.name not in AGGREGATE_TO_ACCUMULATOR:
+        raise NotImplementedError('Unsupported aggregate: %s' % aggregate.name)
+    if getattr(aggregate, 'filter', None) is not None:
+        raise NotImplementedError('Aggregates with a filter are not supported.')
+    expression, = aggregate.source_expressions
+    if isinstance(expression, Star):
+        return None
+    elif isinstance(expression, F):
+        return expression.name
+    raise NotImplementedError('Unsupported aggregate expression: %r' % expression)
+
+
+def aggregate(objects, aggregates, group_by=()):
+    """
+    Computes aggregates, a dict mapping aliases to Django aggregate
+    expressions, over objects in a single pass.
+
+    Without group_by, returns a dict mapping the aliases to their values.
+    Otherwise returns a list of dicts of the group_by lookups' values and the
+    aggregates for each group, in order of first appearance. Memory use is
+    proportional to the number of groups, not the number of objects.
+
+    Lookups across relations are joined as in ``get_values_list``, except
+    that, as the ORM's LEFT OUTER JOINs, an object without related objects
+    gives a row of None values, which aggregates other than ``Count('*')``
+    ignore.
+    """
+    sources = []
+    for alias, agg in aggregates.items():
+        lookup = _source_lookup(agg)
+        sources.append((alias, AGGREGATE_TO_ACCUMULATOR[agg.name], agg, lookup))
+    lookups = list(group_by) + [lookup for _, _, _, lookup in sources if lookup is not None]
+    indexes = []
+    for _, _, _, lookup in sources:
+        indexes.append(None if lookup is None else lookups.index(lookup, len(group_by)))
+
+    def new_accumulators():
+        return [accumulator(agg) for _, accumulator, agg, _ in sources]
+
+    groups = {}
+    if not group_by:
+        groups[()] = new_accumulators()
+    lookup_node = LookupNode(lookups={lookup: GET for lookup in lookups})
+    paths = [LookupComponent.parse(lookup) for lookup in lookups]
+    rows = (row for obj in objects for row in lookup_rows(lookup_node, paths, obj, outer=True))
+    for row in rows:
+        row = tuple(row)
+        key = row[:len(group_by)]
+        try:
+            accumulators = groups[key]
+        except KeyError:
+            accumulators = groups[key] = new_accumulators()
+        for accumulator, index in zip(accumulators, indexes):
+            accumulator.add(True if index is None else row[index])
+
+    aliases = [alias for alias, _, _, _ in sources]
+    results = []
+    for key, accumulators in groups.items():
+        result = dict(zip(group_by, key))
+        result.update(zip(aliases, (accumulator.result() for accumulator in accumulators)))
+        results.append(result)
+    return results if group_by else results[0]
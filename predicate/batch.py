@@ -0,0 +1,172 @@
+"""
+Evaluation of a predicate against many model instances at once, in the
+database or in memory.
+"""
+import collections
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connections
+from django.db import models
+
+from .lookup_utils import get_field_and_accessor
+from .predicate import iter_lookups
+from .predicate import LookupComponent
+from .rules import split_lookup
+
+DEFAULT_CHUNK_SIZE = 500
+
+# Query lookups the ORM evaluates as P.eval does. Others differ: __range is
+# inclusive in SQL and exclusive in memory, and string lookups like
+# __contains follow the database's collation.
+CONSISTENT_QUERIES = frozenset(['exact', 'in', 'isnull', 'gt', 'gte', 'lt', 'lte'])
+
+
+def _chunk_size(manager):
+    """
+    Returns how many primary keys to query for at once, leaving room within
+    the database's parameter limit for the predicate's own parameters.
+    """
+    max_params = connections[manager.db].features.max_query_params
+    if max_params:
+        return min(DEFAULT_CHUNK_SIZE, max_params // 2)
+    return DEFAULT_CHUNK_SIZE
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _by_model(instances):
+    by_model = collections.OrderedDict()
+    for instance in instances:
+        if not isinstance(instance, models.Model) or instance.pk is None:
+            raise ValueError(
+                'Only saved model instances can be evaluated in the database, not %s.'
+                % type(instance).__name__)
+        by_model.setdefault(type(instance), []).append(instance)
+    return by_model
+
+
+def eval_db_many(predicate, instances, chunk_size=None):
+    """
+    Evaluates predicate against saved model instances in the database, with
+    one ``filter(predicate, pk__in=...)`` query per model and chunk of
+    primary keys. Returns a dict mapping (model, primary key) pairs to
+    booleans, so instances of different models with the same primary key
+    have separate results.
+
+    Results follow the ORM's semantics, and the saved state of the instances
+    rather than any unsaved changes. Instances are looked up with the base
+    manager, so a default manager that filters rows doesn't hide matches.
+    """
+    results = {}
+    for model, model_instances in _by_model(instances).items():
+        manager = model._base_manager
+        pks = list(collections.OrderedDict.fromkeys(instance.pk for instance in model_instances))
+        for chunk in _chunks(pks, chunk_size or _chunk_size(manager)):
+            results.update(dict.fromkeys(((model, pk) for pk in chunk), False))
+            matching = manager.filter(predicate, pk__in=chunk).values_list('pk', flat=True)
+            results.update(dict.fromkeys(((model, pk) for pk in matching), True))
+    return results
+
+
+def _is_consistent(predicate):
+    """
+    Returns whether the ORM evaluates predicate as P.eval does, so that
+    eval_many can choose either.
+    """
+    for lookup, rhs in iter_lookups(predicate):
+        if split_lookup(lookup)[1] not in CONSISTENT_QUERIES or hasattr(rhs, 'resolve_expression'):
+            return False
+    return True
+
+
+def _is_cached(obj, field, accessor):
+    """
+    Returns whether following field from obj is answered without a query.
+    """
+    if field.many_to_many or field.one_to_many:
+        manager = getattr(obj, accessor)
+        return manager.prefetch_cache_name in getattr(obj, '_prefetched_objects_cache', {})
+    return field.is_cached(obj)
+
+
+def _related(obj, accessor, multi_valued):
+    """
+    Returns a related object loaded from obj's caches, to check the caching of
+    the next relation on.
+    """
+    related = getattr(obj, accessor)
+    if multi_valued:
+        return next(iter(related.all()), None)
+    return related
+
+
+def uncached_relations(predicate, instance):
+    """
+    Returns the number of relations that evaluating predicate in memory
+    queries the database for, per instance like instance. Relations that were
+    loaded with select_related or prefetch_related are free.
+    """
+    paths = set()
+    for lookup, _ in iter_lookups(predicate):
+        components = LookupComponent.parse(lookup)
+        if components and components[-1].is_query:
+            components.pop()
+        model = type(instance)
+        obj = instance
+        for i, component in enumerate(components):
+            try:
+                field, accessor = get_field_and_accessor(model, component)
+            except FieldDoesNotExist:
+                break
+            if not field.is_relation:
+                break
+            if obj is not None and _is_cached(obj, field, accessor):
+                obj = _related(obj, accessor, field.many_to_many or field.one_to_many)
+            else:
+                paths.add(tuple(components[:i + 1]))
+                obj = None
+            model = field.related_model
+    return len(paths)
+
+
+def eval_many(predicate, instances, chunk_size=None):
+    """
+    Returns a list of whether each of instances matches predicate, evaluated
+    in memory or in the database, whichever takes fewer queries.
+
+    In memory, every relation that isn't already loaded costs a query per
+    instance; this is estimated from the first instance of each model. In
+    the database, each chunk of primary keys costs a query. Only saved
+    instances are evaluated in the database, and only for predicates the
+    ORM evaluates entirely and the same way, without __range, string
+    lookups or expressions. The database sees the saved state of instances,
+    so use P.eval for instances with unsaved changes.
+    """
+    instances = list(instances)
+    results = [None] * len(instances)
+    by_model = collections.OrderedDict()
+    for i, instance in enumerate(instances):
+        by_model.setdefault(type(instance), []).append(i)
+
+    for model, indexes in by_model.items():
+        model_instances = [instances[i] for i in indexes]
+        db_results = None
+        if (issubclass(model, models.Model)
+                and all(instance.pk is not None for instance in model_instances)
+                and _is_consistent(predicate)
+                and not predicate.split(model)[1].children):
+            size = chunk_size or _chunk_size(model._base_manager)
+            db_queries = -(-len(model_instances) // size)
+            memory_queries = (
+                uncached_relations(predicate, model_instances[0]) * len(model_instances))
+            if db_queries < memory_queries:
+                db_results = eval_db_many(predicate, model_instances, chunk_size=size)
+        for i, instance in zip(indexes, model_instances):
+            if db_results is None:
+                results[i] = predicate.eval(instance)
+            else:
+                results[i] = db_results[(model, instance.pk)]
+    return results
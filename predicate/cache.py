@@ -0,0 +1,243 @@
+"""
+Memoization of predicate evaluation results for model instances.
+"""
+import collections
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+
+from .predicate import fingerprint
+from .predicate import P
+from .rules import freeze
+
+original_eval = P.eval
+
+CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class EvalCache(object):
+    """
+    A bounded LRU cache of ``P.eval`` results for saved model instances.
+
+    Results are keyed on the fingerprint of the predicate, so equivalent
+    predicates share results, the model and primary key of the instance, and
+    the values of the instance's own fields that the predicate reads. A
+    result is therefore not reused once one of those fields changes on the
+    instance. Changes to related objects are not detected, so
+    set ``ttl`` (in seconds) to bound how long results may be reused for.
+
+    Instances that aren't saved model instances, and predicates reading
+    attributes that aren't model fields, are evaluated without caching. These
+    evaluations count as misses.
+
+    Predicates are assumed not to be modified after they are first evaluated.
+
+    Usage:
+        cache = EvalCache(maxsize=10000, ttl=60)
+        cache.eval(predicate, instance)
+    """
+    def __init__(self, maxsize=1024, ttl=None, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._results = collections.OrderedDict()
+        self._plans = {}
+        # patch_with_eval_cache shares the cache between threads.
+        self._lock = threading.Lock()
+
+    def cache_info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._results))
+
+    def clear(self):
+        """
+        Removes all cached results and resets the hit and miss counters.
+        """
+        with self._lock:
+            self._results.clear()
+            self._plans.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def eval(self, predicate, instance):
+        """
+        Returns ``predicate.eval(instance)``, from the cache if possible.
+        """
+        key = self._key(predicate, instance)
+        with self._lock:
+            if key is not None:
+                try:
+                    result, expires = self._results[key]
+                except KeyError:
+                    pass
+                else:
+                    if expires is None or self.timer() < expires:
+                        self._results.move_to_end(key)
+                        self.hits += 1
+                        return result
+                    del self._results[key]
+            self.misses += 1
+
+        # The lock isn't held while evaluating, which may be slow.
+        result = original_eval(predicate, instance)
+        if key is not None:
+            expires = None if self.ttl is None else self.timer() + self.ttl
+            with self._lock:
+                self._results[key] = (result, expires)
+                if len(self._results) > self.maxsize:
+                    self._results.popitem(last=False)
+        return result
+
+    def _plan(self, predicate, model):
+        """
+        Returns a (fingerprint, attnames) pair for evaluating predicate against
+        instances of model, where attnames are the names of the model's
+        concrete fields that the predicate reads. Returns None if results for
+        the predicate can't be cached.
+        """
+        plan_key = (id(predicate), model)
+        try:
+            ref, plan = self._plans[plan_key]
+        except KeyError:
+            pass
+        else:
+            if ref() is predicate:
+                return plan
+
+        try:
+            plan = ((type(predicate), fingerprint(predicate)), self._attnames(predicate, model))
+        except (TypeError, FieldDoesNotExist):
+            # The predicate has unhashable values, or reads attributes, such as
+            # properties, that aren't fields.
+            plan = None
+
+        def discard(ref, plans=self._plans):
+            plans.pop(plan_key, None)
+
+        self._plans[plan_key] = (weakref.ref(predicate, discard), plan)
+        return plan
+
+    def _attnames(self, predicate, model):
+        attnames = set()
+        for dependency_model, name in predicate.dependencies(model):
+            if dependency_model is not model:
+                continue
+            field = model._meta.get_field(name)
+            if field.concrete and not field.many_to_many:
+                attnames.add(field.attname)
+        return tuple(sorted(attnames))
+
+    def _key(self, predicate, instance):
+        if not isinstance(instance, models.Model) or instance.pk is None:
+            return None
+        model = type(instance)
+        plan = self._plan(predicate, model)
+        if plan is None:
+            return None
+        predicate_fingerprint, attnames = plan
+        try:
+            state = freeze(tuple(getattr(instance, attname) for attname in attnames))
+        except TypeError:
+            return None
+        return (predicate_fingerprint, model, instance.pk, state)
+
+
+class FilterCache(object):
+    """
+    A bounded LRU cache of the results of filtering one collection with
+    predicates, used by ``PredicateQuerySet.cache_results``.
+
+    A predicate whose results aren't cached is evaluated against the smallest
+    cached results of a predicate it implies, rather than the whole
+    collection. Such reuse counts as a hit. Predicates without a fingerprint
+    are evaluated without caching.
+
+    Predicates are assumed not to be modified after they are first filtered
+    with, and the collection not to change.
+    """
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._results = collections.OrderedDict()
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._results))
+
+    def clear(self):
+        self._results.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def filter(self, predicate, objects):
+        """
+        Returns ``predicate.filter(objects)``, from cached results if possible.
+        """
+        try:
+            key = fingerprint(predicate)
+        except TypeError:
+            self.misses += 1
+            return predicate.filter(objects)
+
+        try:
+            _, results = self._results[key]
+        except KeyError:
+            pass
+        else:
+            self._results.move_to_end(key)
+            self.hits += 1
+            return list(results)
+
+        superset = None
+        for cached_key, (cached, results) in self._results.items():
+            if (superset is None or len(results) < len(superset)) and predicate.implies(cached):
+                superset, superset_key = results, cached_key
+        if superset is None:
+            self.misses += 1
+        else:
+            self._results.move_to_end(superset_key)
+            self.hits += 1
+            objects = superset
+
+        results = predicate.filter(objects)
+        self._results[key] = (predicate, results)
+        if len(self._results) > self.maxsize:
+            self._results.popitem(last=False)
+        return list(results)
+
+
+@contextmanager
+def patch_with_eval_cache(cache=None):
+    """
+    Patches P.eval to memoize results in an EvalCache, so that existing code
+    using ``instance in predicate`` benefits from caching. Yields the cache.
+
+    Only the outermost evaluation is cached; predicates nested within it are
+    evaluated as normal. Usage:
+        from predicate.cache import patch_with_eval_cache
+        with patch_with_eval_cache(EvalCache(ttl=5)) as cache:
+            handle_request()
+    """
+    cache = EvalCache() if cache is None else cache
+    local = threading.local()
+
+    def cached_eval(predicate, instance):
+        if getattr(local, 'evaluating', False):
+            return original_eval(predicate, instance)
+        local.evaluating = True
+        try:
+            return cache.eval(predicate, instance)
+        finally:
+            local.evaluating = False
+
+    try:
+        P.eval = cached_eval
+        yield cache
+    finally:
+        P.eval = original_eval
@@ -1,9 +1,19 @@
-from copy import deepcopy
+import collections
+import logging
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 
+from django.db import close_old_connections
+from django.db import connections
+from django.db import models
+
 from predicate import P
 from predicate import PredicateQuerySet
 
+logger = logging.getLogger(__name__)
+
 original_eval = P.eval
 
 
@@ -43,30 +53,55 @@ def patch_with_orm_eval():
             some_code_where_calling_P()
 
     This will evaluate both in-memory, and via a roundtrip to the database, so
-    should not be used in production code.
+    should not be used in production code. ``P.filter`` is patched too, to
+    check all the objects it's given with a single query.
     """
     try:
         P.eval = orm_eval
+        P.filter = orm_filter
         yield
     finally:
         P.eval = original_eval
+        P.filter = original_filter
 
 
-original_filter = PredicateQuerySet.filter
+original_filter = P.filter
 
 
-def orm_filter(predicate, instance):
-    manager = type(instance)._default_manager
-    orm_value = manager.filter(predicate, pk=instance.pk).exists()
-    super_value = original_filter(predicate, instance)
-    assert orm_value == super_value
-    return super_value
+def orm_filter(predicate, iterable):
+    """
+    Implementation of P.filter that asserts the ORM selects the same model
+    instances from iterable, using a single query.
+    """
+    objects = list(iterable)
+    filtered = [obj for obj in objects if original_eval(predicate, obj)]
+    if objects:
+        manager = type(objects[0])._default_manager
+        orm_pks = manager.filter(
+            predicate, pk__in=[obj.pk for obj in objects]).values_list('pk', flat=True)
+        assert set(orm_pks) == {obj.pk for obj in filtered}
+    return filtered
+
+
+def _pks(iterable):
+    """
+    Returns the sorted primary keys of the objects in iterable, using a
+    single query for QuerySets.
+    """
+    if isinstance(iterable, models.QuerySet):
+        pks = iterable.values_list('pk', flat=True)
+    else:
+        pks = (obj.pk for obj in iterable)
+    return sorted(pks)
 
 
 class OrmPredicateQuerySet(object):
     """
     Wraps a QuerySet and a PredicateQuerySet. Calls the same methods on both,
     and asserts they return the same value.
+
+    Resulting QuerySets and PredicateQuerySets are compared by the primary
+    keys they contain, with one query for the QuerySet.
     """
     def __init__(self, queryset, predicatequeryset=None):
         """
@@ -81,16 +116,14 @@ class OrmPredicateQuerySet(object):
         qs_value = getattr(self.qs, method)(*args, **kwargs)
 
         if isinstance(pqs_value, PredicateQuerySet):
-            self._assert_iterables_equal()
+            self._assert_iterables_equal(qs_value, pqs_value)
             return type(self)(qs_value, predicatequeryset=pqs_value)
         else:
             assert pqs_value == qs_value
             return pqs_value
 
-    def _assert_iterables_equal(self):
-        pqs = deepcopy(self.pqs)
-        qs = deepcopy(self.qs)
-        assert list(pqs) == list(qs)
+    def _assert_iterables_equal(self, qs, pqs):
+        assert _pks(pqs) == _pks(qs)
 
     def all(self, *args, **kwargs):
         return self._call_on_iterables('all', *args, **kwargs)
@@ -115,3 +148,147 @@ class OrmPredicateQuerySet(object):
 
     def __or__(self, *args, **kwargs):
         return self._call_on_iterables('__or__', *args, **kwargs)
+
+
+Mismatch = collections.namedtuple('Mismatch', ['predicate', 'model', 'pk', 'in_memory', 'orm'])
+
+
+def log_mismatch(mismatch):
+    logger.warning(
+        'P.eval returned %s but the ORM returned %s for %s(pk=%r) and %r',
+        mismatch.in_memory, mismatch.orm, mismatch.model.__name__, mismatch.pk,
+        mismatch.predicate)
+
+
+class SamplingValidator(object):
+    """
+    Checks a random sample of ``P.eval`` results against the ORM in the
+    background, at a bounded cost suitable for production.
+
+    Sampled results are batched per predicate fingerprint and model, and each batch is
+    checked with a single ``filter(predicate, pk__in=...)`` query on the
+    executor, a thread pool by default. Each result that the ORM disagrees
+    with is passed to ``on_mismatch`` as a Mismatch, which by default is
+    logged as a warning.
+
+    ``rand`` is the function returning a float in [0, 1) that sampling
+    decisions are made with.
+
+    Since checks happen after the fact, instances changed between the
+    evaluation and the check, or evaluated with unsaved changes, are reported
+    as mismatches too. Only saved model instances are sampled.
+
+    Usage:
+        validator = SamplingValidator(rate=0.001)
+        validator.eval(predicate, instance)
+    """
+    def __init__(self, rate=0.01, on_mismatch=log_mismatch, batch_size=100,
+                 executor=None, rand=random.random):
+        self.rate = rate
+        self.on_mismatch = on_mismatch
+        self.batch_size = batch_size
+        self.rand = rand
+        self._executor = executor
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        return self._executor
+
+    def eval(self, predicate, instance):
+        """
+        Returns ``predicate.eval(instance)``, sampling the result for checking.
+        """
+        result = original_eval(predicate, instance)
+        if self.rand() < self.rate:
+            self.sample(predicate, instance, result)
+        return result
+
+    def sample(self, predicate, instance, result):
+        """
+        Queues result, the in-memory evaluation of predicate for instance, to
+        be checked against the ORM.
+        """
+        if not isinstance(instance, models.Model) or instance.pk is None:
+            return
+        model = type(instance)
+        try:
+            # Equivalent predicates share a batch, and so a query.
+            key = (predicate.fingerprint(), model)
+        except TypeError:
+            # The batch holds a reference to the predicate, so its id can't be
+            # reused while the batch is pending.
+            key = (id(predicate), model)
+        with self._lock:
+            _, _, results = self._batches.setdefault(key, (predicate, model, {}))
+            results[instance.pk] = result
+            if len(results) < self.batch_size:
+                return
+            batch = self._batches.pop(key)
+        self.executor.submit(self._check, *batch)
+
+    def flush(self):
+        """
+        Submits all pending batches for checking, and returns their futures.
+        """
+        with self._lock:
+            batches = list(self._batches.values())
+            self._batches.clear()
+        return [self.executor.submit(self._check, *batch) for batch in batches]
+
+    def _check(self, predicate, model, results):
+        try:
+            matching = set(
+                model._default_manager
+                .filter(predicate, pk__in=list(results))
+                .values_list('pk', flat=True))
+            for pk, in_memory in results.items():
+                if (pk in matching) != in_memory:
+                    self.on_mismatch(Mismatch(predicate, model, pk, in_memory, not in_memory))
+        except Exception:
+            # Nothing waits on the futures of full batches, so report failures
+            # rather than losing them.
+            logger.exception('Failed to check %r against the ORM', predicate)
+            raise
+        finally:
+            # Executor threads open connections of their own, which Django
+            # only closes at the end of requests. A check run in a transaction
+            # shares the caller's connection, which must stay open.
+            if not any(connection.in_atomic_block for connection in connections.all()):
+                close_old_connections()
+
+
+@contextmanager
+def patch_with_sampling_validator(validator=None):
+    """
+    Patches P.eval to check a sample of results against the ORM with a
+    SamplingValidator, and yields the validator. Pending batches are
+    submitted when the context exits. Usage:
+        from predicate.debug import patch_with_sampling_validator
+        with patch_with_sampling_validator(SamplingValidator(rate=0.001)):
+            serve_requests()
+
+    Only the outermost evaluation is sampled; predicates nested within it are
+    evaluated as normal.
+    """
+    validator = SamplingValidator() if validator is None else validator
+    local = threading.local()
+
+    def sampled_eval(predicate, instance):
+        if getattr(local, 'evaluating', False):
+            return original_eval(predicate, instance)
+        local.evaluating = True
+        try:
+            return validator.eval(predicate, instance)
+        finally:
+            local.evaluating = False
+
+    try:
+        P.eval = sampled_eval
+        yield validator
+    finally:
+        P.eval = original_eval
+        validator.flush()
@@ -0,0 +1,199 @@
+"""
+Descriptions of how predicates are evaluated in memory, for ``P.explain``.
+"""
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+from django.db.models.query_utils import Q
+
+from .lookup_utils import get_field_and_accessor
+from .lookup_utils import LOOKUP_TO_EVALUATOR
+from .predicate import eval_wrapper
+from .predicate import expression_references
+from .predicate import is_expression
+from .predicate import LookupNode
+from .predicate import LookupNotFound
+from .rules import EvaluationState
+from .rules import lookup_index_entries
+from .rules import split_lookup
+
+INDENT = '  '
+
+# Orders whether paths are multi-valued from least to most rows, with None
+# for unknown.
+_FAN_OUT_ORDER = {False: 0, None: 1, True: 2}
+
+
+def _relation_kind(field):
+    if field.many_to_many:
+        return 'many-to-many relation'
+    elif field.one_to_many:
+        return 'reverse foreign key'
+    elif field.one_to_one:
+        return 'one-to-one relation' if field.concrete else 'reverse one-to-one relation'
+    return 'foreign key'
+
+
+def _describe_steps(model, path):
+    """
+    Yields a (description, multi_valued) pair for each component of path,
+    where multi_valued is None if it can't be known.
+    """
+    for component in path:
+        if model is None:
+            yield '%s: attribute or key' % component, None
+            continue
+        try:
+            field, _ = get_field_and_accessor(model, component)
+        except FieldDoesNotExist:
+            yield '%s: attribute of %s (not a field)' % (component, model.__name__), None
+            model = None
+            continue
+        if not field.is_relation:
+            yield '%s: field %s.%s' % (component, model.__name__, field.name), False
+            model = None
+        else:
+            yield '%s: %s to %s (traversed)' % (
+                component, _relation_kind(field), field.related_model.__name__), \
+                field.many_to_many or field.one_to_many
+            model = field.related_model
+
+
+class _Explainer(object):
+    def __init__(self, model, instance):
+        self.model = model
+        self.state = None if instance is None else EvaluationState(instance)
+        self.lines = []
+
+    def add(self, depth, line):
+        self.lines.append(INDENT * depth + line)
+
+    def fan_out(self, path, multi_valued):
+        """
+        Returns a description of the number of values reached by path.
+        """
+        if self.state is not None:
+            try:
+                return '%d value(s)' % len(self.state.values(path))
+            except LookupNotFound:
+                return 'missing'
+        elif multi_valued:
+            return 'many values'
+        elif multi_valued is None:
+            return 'unknown'
+        return '1 value'
+
+    def explain_predicate(self, predicate, depth):
+        first = {Q.AND: 'False', Q.OR: 'True'}[predicate.connector]
+        self.add(depth, '%s%s: children evaluated in order, stopping at the first %s' % (
+            'NOT ' if predicate.negated else '', predicate.connector, first))
+        children = [
+            child for child in eval_wrapper(predicate.children, predicate.connector)
+            if not isinstance(child, LookupNode) or child.children]
+        for i, child in enumerate(children, 1):
+            if isinstance(child, LookupNode):
+                self.explain_lookup_node(child, depth + 1, i)
+            else:
+                self.add(depth + 1, '%d. predicate' % i)
+                self.explain_predicate(child, depth + 2)
+
+    def observed_rows(self, node):
+        """
+        Returns a description of the number of rows node is evaluated
+        against for the explained instance.
+        """
+        try:
+            rows = node.convert_to_query_values_node().values(self.state.instance)
+        except LookupNotFound:
+            return 'missing'
+        return '%d observed' % len(rows)
+
+    def explain_lookup_node(self, node, depth, number):
+        self.add(depth, '%d. lookups joined by %s, evaluated against every row of values' % (
+            number, node.connector))
+        groups = {}
+        for component, child in node.children.items():
+            for rest, rhs in child.items():
+                lookup = '__'.join(filter(None, [component, rest]))
+                for group, multi_valued in self.explain_lookup(lookup, rhs, depth + 1):
+                    groups[group] = max(
+                        groups.get(group, False), multi_valued, key=_FAN_OUT_ORDER.get)
+        multi_valued_groups = sorted(
+            group for group, multi_valued in groups.items() if multi_valued)
+        unknown_groups = sorted(group for group, multi_valued in groups.items()
+                                if multi_valued is None)
+        if len(groups) > 1 and multi_valued_groups:
+            rows = 'cartesian join of %s, multi-valued through %s' % (
+                ' x '.join(sorted(groups)), ', '.join(multi_valued_groups))
+        elif multi_valued_groups:
+            rows = 'one per related value of %s' % multi_valued_groups[0]
+        elif unknown_groups:
+            rows = 'unknown, one per value of %s if multi-valued' % ', '.join(unknown_groups)
+        else:
+            rows = '1'
+        if self.state is not None:
+            rows = '%s, %s' % (rows, self.observed_rows(node))
+        self.add(depth + 1, 'rows: %s' % rows)
+
+    def explain_path(self, path, depth):
+        """
+        Describes the relations path traverses, and returns whether it
+        reaches multiple values, or None if that can't be known.
+        """
+        multi_valued = False
+        model = self.model
+        if model is None and self.state is not None:
+            model = type(self.state.instance)
+        if model is not None and not issubclass(model, models.Model):
+            model = None
+        for i, (description, step_multi_valued) in enumerate(_describe_steps(model, path)):
+            if step_multi_valued:
+                multi_valued = True
+            elif step_multi_valued is None and not multi_valued:
+                multi_valued = None
+            self.add(depth, '%s, fan-out: %s' % (
+                description, self.fan_out(path[:i + 1], multi_valued)))
+        return multi_valued
+
+    def explain_lookup(self, lookup, rhs, depth):
+        """
+        Describes a single lookup and the lookups of any F expressions it
+        compares with. Returns a (first component, multi_valued) pair for
+        each path, where multi_valued is whether the path reaches multiple
+        values, or None if that can't be known.
+        """
+        path, query = split_lookup(lookup)
+        evaluator = LOOKUP_TO_EVALUATOR[query].__name__
+        self.add(depth, '%s=%r [%s]' % (lookup, rhs, evaluator))
+        groups = [(path[0] if path else '', self.explain_path(path, depth + 1))]
+        for reference in expression_references(rhs) if is_expression(rhs) else []:
+            self.add(depth + 1, 'F(%r):' % reference)
+            reference_path = split_lookup(reference)[0]
+            groups.append((reference_path[0], self.explain_path(reference_path, depth + 2)))
+
+        entries = lookup_index_entries(lookup, rhs)
+        if entries is None:
+            index = 'none, always evaluated'
+        elif entries and entries[0][1] == 'hash':
+            index = 'hash lookup of %s' % ('value' if query == 'exact' else 'values')
+        elif entries:
+            index = 'interval tree'
+        else:
+            index = 'never matches'
+        self.add(depth + 1, 'PredicateSet/PredicateIndex: %s' % index)
+        return groups
+
+
+def explain(predicate, model_or_instance=None):
+    """
+    Returns a description of how predicate is evaluated in memory against
+    instances of a model, or against a particular instance.
+
+    Given an instance, fan-outs are the actual number of values reached, which
+    may require database queries. Given a model, they are estimates.
+    """
+    if isinstance(model_or_instance, type):
+        explainer = _Explainer(model_or_instance, None)
+    else:
+        explainer = _Explainer(None, model_or_instance)
+    explainer.explain_predicate(predicate, 0)
+    return '\n'.join(explainer.lines)
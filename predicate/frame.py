@@ -0,0 +1,245 @@
+"""
+Vectorized evaluation of predicates against pandas DataFrames and pyarrow
+Tables and Datasets.
+
+Each lookup path is read from a column, named by joining the path with
+``__`` (``parent__int_value`` is read from the column ``parent__int_value``)
+unless a ``columns`` mapping from lookup paths to column names is given.
+Columns hold one value per row, so there are no multi-valued joins.
+
+pandas and pyarrow are optional, and only imported when used. Usage:
+    P(int_value__gt=5).filter_frame(df)
+    for batch in filter_dataset(P(int_value__gt=5), 'data/', format='parquet'):
+        process(batch)
+"""
+import re
+
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.query_utils import Q
+
+from .lookup_utils import is_date
+from .lookup_utils import LOOKUP_TO_EVALUATOR
+from .lookup_utils import Regex
+from .predicate import eval_wrapper
+from .predicate import LookupNode
+from .predicate import LookupNotFound
+from .rules import split_lookup
+
+
+def _lookups(predicate):
+    """
+    Returns predicate as a tree of ('node', connector, negated, children) and
+    ('lookup', (path, query, rhs)) tuples, in evaluation order.
+    """
+    children = []
+    for child in eval_wrapper(predicate.children, predicate.connector):
+        if isinstance(child, LookupNode):
+            if child.references:
+                raise NotImplementedError('F expressions are not supported for frames')
+            children.extend(
+                ('lookup', split_lookup(lookup) + (rhs,)) for lookup, rhs in child.items())
+        else:
+            children.append(_lookups(child))
+    return ('node', predicate.connector, predicate.negated, children)
+
+
+def _column_name(path, columns):
+    lookup = LOOKUP_SEP.join(path)
+    return columns.get(lookup, lookup) if columns else lookup
+
+
+def _combine(masks, connector, negated, true, false):
+    if not masks:
+        mask = true if connector == Q.AND else false
+    else:
+        mask = masks[0]
+        for other in masks[1:]:
+            mask = (mask & other) if connector == Q.AND else (mask | other)
+    return ~mask if negated else mask
+
+
+class _PandasEvaluator(object):
+    def __init__(self, frame, columns):
+        import pandas
+        self.pandas = pandas
+        self.frame = frame
+        self.columns = columns
+
+    def mask(self, node):
+        kind = node[0]
+        if kind == 'lookup':
+            return self.lookup(*node[1])
+        _, connector, negated, children = node
+        masks = [self.mask(child) for child in children]
+        true = self.pandas.Series(True, index=self.frame.index)
+        return _combine(masks, connector, negated, true, ~true)
+
+    def column(self, path):
+        name = _column_name(path, self.columns)
+        if name not in self.frame.columns:
+            raise LookupNotFound('No column %r for lookup %s' % (name, LOOKUP_SEP.join(path)))
+        return self.frame[name]
+
+    def lookup(self, path, query, rhs):
+        column = self.column(path)
+        try:
+            mask = self.vectorized(column, query, rhs)
+        except TypeError:
+            mask = None
+        if mask is None:
+            # Evaluate in Python, with missing values as None.
+            evaluator = LOOKUP_TO_EVALUATOR[query](rhs)
+            isna = self.pandas.isna
+            mask = column.map(lambda value: evaluator(None if _is_missing(isna, value) else value))
+        return mask.fillna(False).astype(bool)
+
+    def vectorized(self, column, query, rhs):
+        """
+        Returns the mask of a lookup computed by pandas, or None if pandas
+        can't match the Python semantics of the lookup.
+        """
+        if query == 'exact':
+            return column.isna() if rhs is None else column == rhs
+        elif query == 'isnull' and isinstance(rhs, bool):
+            return column.isna() if rhs else column.notna()
+        elif query in ('gt', 'gte', 'lt', 'lte') and rhs is not None:
+            if is_date(rhs) and self.pandas.api.types.is_datetime64_any_dtype(column):
+                column = column.dt.normalize()
+                rhs = self.pandas.Timestamp(rhs)
+            return {'gt': column > rhs, 'gte': column >= rhs,
+                    'lt': column < rhs, 'lte': column <= rhs}[query]
+        elif query == 'in':
+            values = list(LOOKUP_TO_EVALUATOR['in'](rhs).rhs)
+            mask = column.isin([value for value in values if value is not None])
+            return (mask | column.isna()) if None in values else mask
+        elif query == 'range':
+            low, high = rhs
+            return (column > low) & (column < high)
+        elif query in ('contains', 'search') and isinstance(rhs, str):
+            return column.str.contains(rhs, regex=False)
+        elif query == 'startswith' and isinstance(rhs, str):
+            return column.str.startswith(rhs)
+        elif query == 'endswith' and isinstance(rhs, str):
+            return column.str.endswith(rhs)
+        elif issubclass(LOOKUP_TO_EVALUATOR[query], Regex):
+            return column.str.contains(LOOKUP_TO_EVALUATOR[query](rhs).rhs, regex=True)
+        elif query in ('year', 'month', 'day'):
+            return getattr(column.dt, query) == rhs
+        elif query == 'week_day':
+            # Sunday=1 to Saturday=7, from Monday=0 to Sunday=6.
+            return column.dt.dayofweek == (rhs - 2) % 7
+        return None
+
+
+def _is_missing(isna, value):
+    try:
+        return bool(isna(value))
+    except (TypeError, ValueError):
+        return False
+
+
+class _ArrowExpressionBuilder(object):
+    def __init__(self, columns, schema=None):
+        import pyarrow
+        import pyarrow.compute
+        self.pyarrow = pyarrow
+        self.compute = pyarrow.compute
+        self.columns = columns
+        self.schema = schema
+
+    def expression(self, node):
+        kind = node[0]
+        if kind == 'lookup':
+            return self.lookup(*node[1])
+        _, connector, negated, children = node
+        expressions = [self.expression(child) for child in children]
+        true = self.compute.scalar(True)
+        return _combine(expressions, connector, negated, true, ~true)
+
+    def lookup(self, path, query, rhs):
+        name = _column_name(path, self.columns)
+        if self.schema is not None and name not in self.schema.names:
+            raise LookupNotFound('No column %r for lookup %s' % (name, LOOKUP_SEP.join(path)))
+        # Null comparisons are false rather than null, so negation matches
+        # in-memory evaluation.
+        return self.compute.coalesce(self.comparison(self.compute.field(name), query, rhs), False)
+
+    def comparison(self, field, query, rhs):
+        compute = self.compute
+        if query == 'exact':
+            return field.is_null() if rhs is None else field == rhs
+        elif query == 'isnull' and isinstance(rhs, bool):
+            return field.is_null() if rhs else ~field.is_null()
+        elif query in ('gt', 'gte', 'lt', 'lte') and rhs is not None:
+            return {'gt': field > rhs, 'gte': field >= rhs,
+                    'lt': field < rhs, 'lte': field <= rhs}[query]
+        elif query == 'in':
+            values = list(LOOKUP_TO_EVALUATOR['in'](rhs).rhs)
+            expression = field.isin(self.pyarrow.array(
+                [value for value in values if value is not None]))
+            return (expression | field.is_null()) if None in values else expression
+        elif query == 'range':
+            low, high = rhs
+            return (field > low) & (field < high)
+        elif query in ('contains', 'search', 'icontains'):
+            return compute.match_substring(field, rhs, ignore_case=query == 'icontains')
+        elif query in ('startswith', 'istartswith'):
+            return compute.starts_with(field, rhs, ignore_case=query == 'istartswith')
+        elif query in ('endswith', 'iendswith'):
+            return compute.ends_with(field, rhs, ignore_case=query == 'iendswith')
+        elif query in ('regex', 'iregex', 'iexact'):
+            pattern = LOOKUP_TO_EVALUATOR[query](rhs).rhs
+            return compute.match_substring_regex(
+                field, pattern.pattern, ignore_case=bool(pattern.flags & re.I))
+        elif query in ('year', 'month', 'day'):
+            return getattr(compute, query)(field) == rhs
+        elif query == 'week_day':
+            return compute.day_of_week(field) == (rhs - 2) % 7
+        raise NotImplementedError(
+            'The %s lookup is not supported for Arrow data: %r' % (query, rhs))
+
+
+def _is_arrow(data):
+    module = type(data).__module__
+    return module.startswith('pyarrow')
+
+
+def to_mask(predicate, data, columns=None):
+    """
+    Returns a boolean mask of the rows of a pandas DataFrame (as a Series) or
+    a pyarrow Table (as a BooleanArray) that match predicate.
+    """
+    tree = _lookups(predicate)
+    if _is_arrow(data):
+        import pyarrow.dataset
+        expression = _ArrowExpressionBuilder(columns, data.schema).expression(tree)
+        return pyarrow.dataset.dataset(data).to_table(
+            columns={'mask': expression}).column('mask').combine_chunks()
+    return _PandasEvaluator(data, columns).mask(tree)
+
+
+def filter_frame(predicate, data, columns=None):
+    """
+    Returns the rows of a pandas DataFrame or pyarrow Table that match
+    predicate. Given a pyarrow Dataset, returns a generator of the matching
+    rows of each of its record batches, so datasets that don't fit in memory
+    can be processed a batch at a time.
+    """
+    tree = _lookups(predicate)
+    if _is_arrow(data):
+        expression = _ArrowExpressionBuilder(columns, data.schema).expression(tree)
+        if hasattr(data, 'to_batches') and hasattr(data, 'files'):
+            return (batch for batch in data.to_batches(filter=expression))
+        return data.filter(expression)
+    return data[_PandasEvaluator(data, columns).mask(tree)]
+
+
+def filter_dataset(predicate, source, format='parquet', columns=None, **kwargs):
+    """
+    Opens local Parquet or Arrow IPC files as a pyarrow Dataset, and returns
+    a generator of the matching rows of each record batch. Additional
+    arguments are passed to ``pyarrow.dataset.dataset``.
+    """
+    import pyarrow.dataset
+    dataset = pyarrow.dataset.dataset(source, format=format, **kwargs)
+    return filter_frame(predicate, dataset, columns=columns)
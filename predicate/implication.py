@@ -0,0 +1,235 @@
+"""
+Checks of whether one predicate implies another.
+
+Implication is decided for lookups with ``exact``, ``in``, ``isnull``,
+``startswith``, ``range`` and comparison queries, combined with AND, OR and
+negation. Other lookups, lookups comparing with F expressions, and
+combinations that would need a model's fields to reason about, are treated
+as unknown: ``implies`` then returns False rather than guessing, so a True
+result can be relied on.
+"""
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.query_utils import Q
+
+from .lookup_utils import _is_model_instance
+from .lookup_utils import LOOKUP_TO_EVALUATOR
+from .predicate import eval_wrapper
+from .predicate import is_expression
+from .predicate import LookupNode
+from .rules import split_lookup
+
+AND = 'and'
+OR = 'or'
+NOT = 'not'
+GROUP = 'group'
+NONEMPTY = 'nonempty'
+
+COMPARISONS = {'gt': (True, False), 'gte': (True, True), 'lt': (False, False), 'lte': (False, True)}
+
+
+def _first_component(lookup):
+    return lookup.split(LOOKUP_SEP, 1)[0]
+
+
+def _group_terms(node):
+    """
+    Returns the terms of a LookupNode. Lookups starting with the same
+    component are matched by a single row of related values in an AND node,
+    so form one group.
+    """
+    groups = {}
+    for lookup, rhs in node.items():
+        groups.setdefault(_first_component(lookup), {})[lookup] = rhs
+    if node.connector == Q.AND:
+        return [(GROUP, lookups) for lookups in groups.values()]
+    terms = [(GROUP, {lookup: rhs}) for lookup, rhs in node.items()]
+    if len(groups) == 1:
+        return terms
+    # LookupNode matches nothing if the values of any of its first components,
+    # such as a many-to-many relation or a list, are empty, so the disjunction
+    # also needs each of them to be non-empty.
+    return [(AND, [(NONEMPTY, component) for component in groups] + [(OR, terms)])]
+
+
+def _term(predicate):
+    """
+    Returns predicate as a tree of (AND, children), (OR, children),
+    (NOT, term), (GROUP, lookups) and (NONEMPTY, component) terms.
+    """
+    children = []
+    for child in eval_wrapper(predicate.children, predicate.connector):
+        if isinstance(child, LookupNode):
+            children.extend(_group_terms(child))
+        else:
+            children.append(_term(child))
+    term = (AND if predicate.connector == Q.AND else OR, children)
+    if len(children) == 1:
+        term = children[0]
+    return (NOT, term) if predicate.negated else term
+
+
+class _Bound(object):
+    def __init__(self, value, closed):
+        self.value = value
+        self.closed = closed
+
+    def within(self, other, lower):
+        """
+        Returns whether this bound is at least as tight as other.
+        """
+        if self.value == other.value:
+            return other.closed or not self.closed
+        return self.value > other.value if lower else self.value < other.value
+
+
+class _Constraint(object):
+    """
+    What a conjunction of lookups on one path says about the path's values.
+    """
+    def __init__(self, lookups):
+        self.lookups = lookups
+        self.candidates = None
+        self.not_null = False
+        self.lower = None
+        self.upper = None
+        self.prefixes = []
+        for query, rhs in lookups:
+            self._add(query, rhs)
+
+    def _add(self, query, rhs):
+        if is_expression(rhs):
+            # The value of an expression differs between objects.
+            return
+        elif query == 'exact':
+            self._add_candidates([rhs])
+        elif query == 'in' and isinstance(rhs, (list, tuple, set, frozenset, range)):
+            values = list(rhs)
+            if not any(isinstance(value, tuple) or _is_model_instance(value) for value in values):
+                # Model instances and values_list rows are cast by __in, so
+                # they aren't the values themselves.
+                self._add_candidates(values)
+        elif query == 'isnull' and isinstance(rhs, bool):
+            if rhs:
+                self._add_candidates([None])
+            else:
+                self.not_null = True
+        elif query in COMPARISONS and rhs is not None:
+            lower, closed = COMPARISONS[query]
+            self._add_bound(_Bound(rhs, closed), lower)
+        elif query == 'range':
+            low, high = rhs
+            self._add_bound(_Bound(low, False), True)
+            self._add_bound(_Bound(high, False), False)
+        elif query == 'startswith':
+            self.not_null = True
+            self.prefixes.append(rhs)
+
+    def _add_candidates(self, values):
+        if self.candidates is None:
+            self.candidates = values
+
+    def _add_bound(self, bound, lower):
+        self.not_null = True
+        current = self.lower if lower else self.upper
+        try:
+            tighter = current is None or bound.within(current, lower)
+        except TypeError:
+            # Ignoring a bound only loosens the constraint.
+            tighter = False
+        if tighter:
+            if lower:
+                self.lower = bound
+            else:
+                self.upper = bound
+
+    def _possible(self, value):
+        """
+        Returns whether value may satisfy all lookups, erring towards True.
+        """
+        try:
+            return all(LOOKUP_TO_EVALUATOR[query](rhs)(value) for query, rhs in self.lookups)
+        except (TypeError, KeyError):
+            return True
+
+    def implies(self, query, rhs):
+        """
+        Returns whether every value satisfying this constraint satisfies the
+        lookup query=rhs. Incomparable values give False.
+        """
+        if is_expression(rhs):
+            return False
+        try:
+            if self.candidates is not None:
+                evaluator = LOOKUP_TO_EVALUATOR[query](rhs)
+                return all(evaluator(value) for value in self.candidates if self._possible(value))
+            if query == 'isnull' and rhs is False:
+                return self.not_null
+            elif query in COMPARISONS and rhs is not None:
+                lower, closed = COMPARISONS[query]
+                return self._within(_Bound(rhs, closed), lower)
+            elif query == 'range':
+                low, high = rhs
+                return self._within(_Bound(low, False), True) and self._within(
+                    _Bound(high, False), False)
+            elif query == 'startswith':
+                return any(prefix.startswith(rhs) for prefix in self.prefixes)
+        except (TypeError, KeyError, ValueError, AttributeError):
+            pass
+        return False
+
+    def _within(self, bound, lower):
+        own = self.lower if lower else self.upper
+        return own is not None and own.within(bound, lower)
+
+
+def _group_implies(lookups, other_lookups):
+    """
+    Returns whether a row of values matching all of lookups matches all of
+    other_lookups.
+    """
+    constraints = {}
+    for lookup, rhs in lookups.items():
+        path, query = split_lookup(lookup)
+        constraints.setdefault(path, []).append((query, rhs))
+    for lookup, rhs in other_lookups.items():
+        path, query = split_lookup(lookup)
+        if path not in constraints or not _Constraint(constraints[path]).implies(query, rhs):
+            return False
+    return True
+
+
+def _implies(term, other):
+    if term == other:
+        return True
+    kind, other_kind = term[0], other[0]
+    if other_kind == AND:
+        return all(_implies(term, child) for child in other[1])
+    elif kind == OR:
+        return all(_implies(child, other) for child in term[1])
+    elif kind == AND and any(_implies(child, other) for child in term[1]):
+        return True
+    elif other_kind == OR and any(_implies(term, child) for child in other[1]):
+        return True
+    elif kind == NOT and other_kind == NOT:
+        return _implies(other[1], term[1])
+    elif kind == GROUP and other_kind == GROUP:
+        return _group_implies(term[1], other[1])
+    elif kind == GROUP and other_kind == NONEMPTY:
+        # A row of values matching the group has a value for each of its
+        # first components.
+        return any(_first_component(lookup) == other[1] for lookup in term[1])
+    return False
+
+
+def implies(predicate, other):
+    """
+    Returns True if every object matching predicate also matches other, as
+    evaluated in memory. False means that this is not the case, or that it
+    could not be shown.
+    """
+    try:
+        if predicate.fingerprint() == other.fingerprint():
+            return True
+    except TypeError:
+        pass
+    return _implies(_term(predicate), _term(other))
@@ -1,9 +1,25 @@
 import datetime
 import operator
+import sys
 
 import re
 
-from django.db import models
+
+_model_class = None
+
+
+def _is_model_instance(value):
+    """
+    Returns whether value is a Django model instance, without importing the
+    ORM: if it hasn't been imported, there can't be any model instances.
+    """
+    global _model_class
+    if _model_class is None:
+        models = sys.modules.get('django.db.models')
+        if models is None:
+            return False
+        _model_class = models.Model
+    return isinstance(value, _model_class)
 
 
 class LookupQueryEvaluator(object):
@@ -100,7 +116,7 @@ class In(LookupQueryEvaluator):
         if isinstance(value, tuple):
             # Handles __in=MyModel.objects.values_list('pk')
             value, = value
-        elif isinstance(value, models.Model):
+        elif _is_model_instance(value):
             value = value.pk
         return value
 
@@ -204,7 +220,7 @@ LOOKUP_TO_EVALUATOR = {
 def get_field_and_accessor(instance_or_model, lookup_part):
     if lookup_part == 'pk':
         field = instance_or_model._meta.pk
-        direct = True
-    field = instance_or_model._meta.get_field(lookup_part)
+    else:
+        field = instance_or_model._meta.get_field(lookup_part)
     direct = not field.auto_created or field.concrete
     return field, (lookup_part if direct else field.get_accessor_name())
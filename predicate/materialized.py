@@ -0,0 +1,169 @@
+"""
+Incrementally maintained collections of the objects matching a predicate.
+"""
+import collections
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+
+
+Delta = collections.namedtuple('Delta', ['entered', 'left'])
+
+
+def default_key(obj):
+    """
+    Returns the key identifying obj within a view.
+
+    Saved model instances are identified by their model and primary key, so
+    that a freshly loaded copy of an object replaces the stale one. Other
+    objects are identified by themselves if hashable, or else by identity.
+    """
+    if isinstance(obj, models.Model):
+        if obj.pk is not None:
+            return (obj._meta.concrete_model, obj.pk)
+        return id(obj)
+    try:
+        hash(obj)
+    except TypeError:
+        return id(obj)
+    return obj
+
+
+class MaterializedPredicateView(object):
+    """
+    The objects of a collection that match a predicate, kept up to date as
+    the collection changes.
+
+    Changes are reported with ``insert``, ``update`` and ``delete`` (or all at
+    once with ``apply``), or automatically from Django's ``post_save`` and
+    ``post_delete`` signals after calling ``connect(model)``. Only the changed
+    objects are evaluated against the predicate, and saves whose
+    ``update_fields`` the predicate doesn't read are not evaluated at all.
+    Each change returns a ``Delta`` of the objects that entered and left the
+    view, which is also passed to all callbacks registered with ``subscribe``.
+
+    Usage:
+        view = MaterializedPredicateView(P(status='open'), Ticket.objects.all())
+        view.subscribe(lambda delta: notify(delta.entered, delta.left))
+        view.connect(Ticket)
+    """
+    def __init__(self, predicate, iterable=(), key=default_key):
+        self.predicate = predicate
+        self.key = key
+        self._matches = {}
+        self._subscribers = []
+        self._receivers = []
+        self._fields_read = {}
+        for obj in iterable:
+            if predicate.eval(obj):
+                self._matches[key(obj)] = obj
+
+    def __repr__(self):
+        return '<MaterializedPredicateView %r: %d objects>' % (self.predicate, len(self))
+
+    def __iter__(self):
+        return iter(list(self._matches.values()))
+
+    def __len__(self):
+        return len(self._matches)
+
+    def __contains__(self, obj):
+        return self.key(obj) in self._matches
+
+    def subscribe(self, callback):
+        """
+        Registers callback to be called with the Delta of every change that
+        adds or removes objects from the view.
+        """
+        self._subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+    def apply(self, saved=(), deleted=()):
+        """
+        Updates the view for objects that were inserted or updated (saved),
+        and objects that were deleted from the underlying collection.
+
+        Returns a Delta of the objects that entered and left the view.
+        """
+        entered = []
+        left = []
+        for obj in saved:
+            key = self.key(obj)
+            was_match = key in self._matches
+            if self.predicate.eval(obj):
+                self._matches[key] = obj
+                if not was_match:
+                    entered.append(obj)
+            elif was_match:
+                left.append(self._matches.pop(key))
+        for obj in deleted:
+            key = self.key(obj)
+            if key in self._matches:
+                left.append(self._matches.pop(key))
+
+        delta = Delta(entered, left)
+        if entered or left:
+            for callback in list(self._subscribers):
+                callback(delta)
+        return delta
+
+    def insert(self, obj):
+        return self.apply(saved=[obj])
+
+    def update(self, obj):
+        return self.apply(saved=[obj])
+
+    def delete(self, obj):
+        return self.apply(deleted=[obj])
+
+    def connect(self, model):
+        """
+        Keeps the view up to date with saves and deletes of instances of model.
+        """
+        def on_save(sender, instance, update_fields=None, **kwargs):
+            if update_fields is None or self._reads_any(sender, update_fields):
+                self.apply(saved=[instance])
+            elif self.key(instance) in self._matches:
+                self._matches[self.key(instance)] = instance
+
+        def on_delete(sender, instance, **kwargs):
+            self.apply(deleted=[instance])
+
+        for signal, receiver in ((post_save, on_save), (post_delete, on_delete)):
+            signal.connect(receiver, sender=model, weak=False)
+            self._receivers.append((signal, receiver, model))
+
+    def _reads_any(self, model, field_names):
+        """
+        Returns whether the predicate reads any of the named fields of model,
+        i.e. whether saving only those fields can change whether an instance
+        matches.
+        """
+        try:
+            fields_read = self._fields_read[model]
+        except KeyError:
+            names = {name for dependency_model, name in self.predicate.dependencies(model)
+                     if dependency_model is model}
+            try:
+                fields_read = {model._meta.get_field(name).name for name in names}
+            except FieldDoesNotExist:
+                # Attributes other than fields, such as properties, may read
+                # any field.
+                fields_read = None
+            self._fields_read[model] = fields_read
+        if fields_read is None:
+            return True
+        return any(model._meta.get_field(name).name in fields_read for name in field_names)
+
+    def disconnect(self):
+        """
+        Stops following the signals of all models passed to connect.
+        """
+        for signal, receiver, model in self._receivers:
+            signal.disconnect(receiver, sender=model)
+        self._receivers = []
@@ -1,5 +1,13 @@
+import collections
 import copy
+import datetime
+import decimal
+import hashlib
+import heapq
 import itertools
+import math
+import operator
+import uuid
 
 from django.utils.tree import Node
 
@@ -10,10 +18,20 @@ from django.db import models
 from django.db.models import Manager
 from django.db.models import QuerySet
 from django.db.models.constants import LOOKUP_SEP
+from django.db.models.expressions import Combinable
+from django.db.models.expressions import CombinedExpression
+from django.db.models.expressions import F
+from django.db.models.expressions import Value
 from django.db.models.query import REPR_OUTPUT_SIZE
 from django.db.models.query_utils import Q
 from django.utils.functional import cached_property
 
+try:
+    import dataclasses
+except ImportError:
+    # Python < 3.7.
+    dataclasses = None
+
 from .lookup_utils import get_field_and_accessor
 from .lookup_utils import LOOKUP_TO_EVALUATOR
 
@@ -36,6 +54,252 @@ def eval_wrapper(children, connector):
     yield lookups
 
 
+def iter_lookups(node):
+    """
+    Yields the (lookup, value) pairs of all filter expressions in a Q or P tree.
+    """
+    for child in node.children:
+        if isinstance(child, Node):
+            for item in iter_lookups(child):
+                yield item
+        else:
+            yield child
+
+
+def _orm_lookup(model, lookup):
+    """
+    Returns whether the ORM can evaluate lookup for model, i.e. whether each
+    of its components is a field, or a lookup or transform of the last field.
+    """
+    field = None
+    for component in lookup.split(LOOKUP_SEP):
+        if model is not None:
+            try:
+                field, _ = get_field_and_accessor(model, component)
+            except FieldDoesNotExist:
+                model = None
+            else:
+                model = field.related_model if field.is_relation else None
+                continue
+        if field is None or not (field.get_lookup(component) or field.get_transform(component)):
+            return False
+    return True
+
+
+def _orm_node(node, model):
+    return all(
+        _orm_node(child, model) if isinstance(child, Node) else _orm_lookup(model, child[0])
+        for child in node.children)
+
+
+def _to_q(node):
+    q = Q()
+    q.connector = node.connector
+    q.negated = node.negated
+    q.children = [_to_q(child) if isinstance(child, Node) else child for child in node.children]
+    return q
+
+
+def _split(node, model):
+    """
+    Returns a (Q, residual P) pair for P.split, where either may be None if
+    empty.
+    """
+    if _orm_node(node, model):
+        return _to_q(node), None
+    elif node.connector == Q.OR or node.negated:
+        return None, node
+
+    orm_children = []
+    residual_children = []
+    groups = collections.OrderedDict()
+    for child in node.children:
+        if isinstance(child, Node):
+            q, residual = _split(child, model)
+            if q is not None:
+                orm_children.append(q)
+            if residual is not None:
+                residual_children.append(residual)
+        else:
+            groups.setdefault(child[0].split(LOOKUP_SEP, 1)[0], []).append(child)
+    for lookups in groups.values():
+        if all(_orm_lookup(model, lookup) for lookup, _ in lookups):
+            orm_children.extend(lookups)
+        else:
+            residual_children.extend(lookups)
+
+    q = residual = None
+    if orm_children:
+        q = Q()
+        q.children = orm_children
+    if residual_children:
+        residual = type(node)()
+        residual.children = residual_children
+    return q, residual
+
+
+def _parse_lookup(lookup):
+    """
+    Returns a (path, query) pair for lookup, where path is a tuple of
+    components.
+    """
+    components = LookupComponent.parse(lookup)
+    query = components.pop() if components and components[-1].is_query else 'exact'
+    return tuple(components), query
+
+
+def _bind_lookup(child, known):
+    lookup, rhs = child
+    if is_expression(rhs):
+        return child
+    path, query = _parse_lookup(lookup)
+    try:
+        value = known[path]
+    except KeyError:
+        return child
+    return LookupComponent(query).build_evaluator(rhs)(value)
+
+
+def _bind(node, known):
+    """
+    Returns node with the lookups of the paths in known evaluated: True or
+    False if that decides it, or else a node of its remaining children.
+    """
+    lookups = [child for child in node.children if not isinstance(child, Node)]
+    # LookupNode matches nothing in memory if the values of any of its first
+    # components, such as a relation or a list, are empty, so the lookups of
+    # a disjunction starting from several components aren't independent of
+    # each other.
+    bind_lookups = not (
+        node.connector == Q.OR
+        and len({lookup.split(LOOKUP_SEP, 1)[0] for lookup, _ in lookups}) > 1)
+    deciding = node.connector == Q.OR
+    children = []
+    for child in node.children:
+        if isinstance(child, Node):
+            result = _bind(child, known)
+        elif bind_lookups:
+            result = _bind_lookup(child, known)
+        else:
+            result = child
+        if result is deciding:
+            return deciding != node.negated
+        elif result is not (not deciding):
+            children.append(result)
+    if not children:
+        return (not deciding) != node.negated
+    elif len(children) == 1 and isinstance(children[0], Node) and not node.negated:
+        return children[0]
+    return type(node)._new_instance(children, node.connector, node.negated)
+
+
+def _unique(filtered):
+    """
+    Returns the only element of the list filtered, raising
+    ObjectDoesNotExist or MultipleObjectsReturned otherwise.
+    """
+    if len(filtered) == 0:
+        raise ObjectDoesNotExist('Object matching query does not exist.')
+    elif len(filtered) > 1:
+        raise MultipleObjectsReturned(
+            'get() returned more than one object -- it returned %s!' % len(filtered))
+    return filtered[0]
+
+
+# Values of these types are canonicalized by their repr, which is the same for
+# equal values in every process.
+_REPR_TYPES = (
+    type(None), bool, int, float, decimal.Decimal, str, bytes, datetime.date, datetime.time,
+    datetime.timedelta, uuid.UUID)
+
+
+def _type_name(value):
+    return '%s.%s' % (type(value).__module__, type(value).__qualname__)
+
+
+def _canonical_value(value, unordered=False):
+    """
+    Returns a canonical form of a lookup's right hand side, built from
+    strings so that it can be hashed the same way in every process. Items of
+    sets, and of unordered values like those of ``__in``, are sorted.
+
+    Raises TypeError for values without a stable canonical form.
+    """
+    if isinstance(value, _REPR_TYPES):
+        return (_type_name(value), repr(value))
+    elif isinstance(value, models.Model):
+        if value.pk is None:
+            raise TypeError('Unsaved %s has no canonical form.' % type(value).__name__)
+        return ('model', value._meta.label_lower, _canonical_value(value.pk))
+    elif isinstance(value, (set, frozenset)) or unordered and isinstance(
+            value, (list, tuple, range)):
+        return ('set', tuple(sorted({_canonical_value(item) for item in value}, key=repr)))
+    elif isinstance(value, (list, tuple)):
+        return (_type_name(value), tuple(_canonical_value(item) for item in value))
+    elif isinstance(value, dict):
+        return ('dict', tuple(sorted(
+            ((_canonical_value(k), _canonical_value(v)) for k, v in value.items()), key=repr)))
+    elif type(value).__repr__ is not object.__repr__ and not isinstance(value, (QuerySet, Manager)):
+        hash(value)
+        return (_type_name(value), repr(value))
+    raise TypeError('%s has no canonical form.' % type(value).__name__)
+
+
+def _canonical_lookup(lookup, value):
+    components = LookupComponent.parse(lookup)
+    query = components[-1] if components and components[-1].is_query else 'exact'
+    if query == 'exact' and components and components[-1] == 'exact':
+        components.pop()
+    if query == 'in' and isinstance(value, (list, tuple, set, frozenset)):
+        # __in values are compared as a set, after the same casting.
+        value = [item[0] if isinstance(item, tuple) and len(item) == 1 else
+                 item.pk if isinstance(item, models.Model) else item for item in value]
+    return ('lookup', LOOKUP_SEP.join(components), _canonical_value(value, unordered=query == 'in'))
+
+
+def canonical_form(node):
+    """
+    Returns a canonical form of a Q or P tree, which is equal for trees that
+    evaluate the same way because they differ only in the order or repetition
+    of the children of a node, nesting that doesn't change how lookups are
+    grouped, or ``__exact`` suffixes.
+
+    The lookups of a node are kept apart from those of its child nodes, since
+    lookups evaluated together on a multi-valued relation must match the same
+    related object.
+
+    Raises TypeError if the tree contains values without a canonical form,
+    such as unsaved model instances or objects without a repr.
+    """
+    lookups = set()
+    nodes = set()
+    for child in node.children:
+        if not isinstance(child, Node):
+            lookups.add(_canonical_lookup(*child))
+            continue
+        form = canonical_form(child)
+        _, connector, negated, child_lookups, child_nodes = form
+        if not negated and not child_lookups and (
+                connector == node.connector or len(child_nodes) == 1):
+            nodes.update(child_nodes)
+        else:
+            nodes.add(form)
+    if not node.negated and not lookups and len(nodes) == 1:
+        return nodes.pop()
+    # With a single child, the connector makes no difference.
+    connector = node.connector if len(lookups) + len(nodes) != 1 else Q.AND
+    return ('node', connector, node.negated,
+            tuple(sorted(lookups, key=repr)), tuple(sorted(nodes, key=repr)))
+
+
+def fingerprint(node):
+    """
+    Returns a hex digest of the canonical form of a Q or P tree, which is
+    stable across processes. See canonical_form.
+    """
+    return hashlib.sha1(repr(canonical_form(node)).encode('utf-8')).hexdigest()
+
+
 class P(Q):
     """
     A Django 'predicate' construct
@@ -63,6 +327,174 @@ class P(Q):
         else:
             return ret
 
+    def dependencies(self, model):
+        """
+        Returns the set of (model, field name) pairs read when evaluating this
+        predicate against instances of model.
+
+        Lookups that follow relations include the relation field and the
+        fields read on each related model. Lookups of attributes that are not
+        model fields, such as properties, are included under the attribute
+        name, though what such an attribute reads in turn can't be known.
+        The lookups of F expressions compared with are included too.
+        """
+        lookups = []
+        for lookup, rhs in iter_lookups(self):
+            lookups.append(lookup)
+            if is_expression(rhs):
+                lookups.extend(expression_references(rhs))
+        dependencies = set()
+        for lookup in lookups:
+            components = LookupComponent.parse(lookup)
+            if components and components[-1].is_query:
+                components.pop()
+            current_model = model
+            for component in components:
+                try:
+                    field, _ = get_field_and_accessor(current_model, component)
+                except FieldDoesNotExist:
+                    dependencies.add((current_model, component))
+                    break
+                dependencies.add((current_model, field.name))
+                if not field.is_relation:
+                    break
+                current_model = field.related_model
+        return dependencies
+
+    def fingerprint(self):
+        """
+        Returns a digest of the structure of this predicate, for use as a
+        cache or deduplication key. It is the same for predicates that differ
+        only in the order of their children and other details that don't
+        change how they evaluate, and in every process.
+
+        Raises TypeError if the predicate has values without a stable
+        representation, such as unsaved model instances.
+        """
+        return fingerprint(self)
+
+    def implies(self, other):
+        """
+        Returns True if every object matching this predicate also matches
+        other, so that ``other.filter(objects)`` is a superset of
+        ``self.filter(objects)``.
+
+        This is decided for exact, in, isnull, startswith, range and
+        comparison lookups combined with AND, OR and negation. False means
+        that this predicate doesn't imply other, or that it couldn't be
+        shown to.
+        """
+        from .implication import implies
+        return implies(self, other)
+
+    def is_subset_of(self, other):
+        """
+        Alias of implies: whether the objects matching this predicate are a
+        subset of those matching other.
+        """
+        return self.implies(other)
+
+    def bind(self, **known):
+        """
+        Partially evaluates this predicate for objects whose lookup paths
+        have the known values, such as ``tenant_id=3``. Lookups on those paths
+        are evaluated once, and returns True or False if that decides the
+        predicate, or else a residual P of the lookups left to evaluate per
+        object.
+
+        Known paths are assumed to have a single value. Usage:
+            residual = predicate.bind(tenant_id=3, is_active=True)
+            if residual is True:
+                matches = objects
+            elif residual is not False:
+                matches = residual.filter(objects)
+        """
+        residual = _bind(self, {_parse_lookup(lookup)[0]: value for lookup, value in known.items()})
+        if isinstance(residual, Node) and not isinstance(residual, P):
+            residual = type(self)._new_instance(
+                residual.children, residual.connector, residual.negated)
+        return residual
+
+    def split(self, model):
+        """
+        Splits this predicate into a Q that the ORM can evaluate for model,
+        and a residual P of the lookups it can't, such as lookups of
+        properties. An instance matches this predicate if it matches both.
+
+        The Q is as large as possible: the children of AND nodes are split
+        apart, while OR and negated nodes go to the Q only as a whole. Lookups
+        that share their first component stay together, so multi-valued
+        relations are joined the same way on both sides.
+
+        Either part may be empty. Usage:
+            q, residual = predicate.split(Model)
+            matches = residual.filter(Model.objects.filter(q))
+        """
+        q, residual = _split(self, model)
+        return (Q() if q is None else q), (type(self)() if residual is None else residual)
+
+    def filter_queryset(self, queryset):
+        """
+        Returns a PredicateQuerySet of the objects of queryset that match this
+        predicate. The database evaluates as much of the predicate as it can,
+        and the rest is evaluated in memory on the objects it returns.
+        """
+        q, residual = self.split(queryset.model)
+        return PredicateQuerySet(queryset.filter(q), residual)
+
+    def eval_db_many(self, instances, chunk_size=None):
+        """
+        Evaluates this predicate against saved model instances in the
+        database, with one query per model and chunk of primary keys.
+        Returns a dict mapping (model, primary key) pairs to booleans.
+        """
+        from .batch import eval_db_many
+        return eval_db_many(self, instances, chunk_size=chunk_size)
+
+    def eval_many(self, instances, chunk_size=None):
+        """
+        Returns a list of whether each of instances matches this predicate,
+        evaluated in memory or in the database, whichever takes fewer
+        queries given the relations the predicate follows. The database is
+        only used for lookups it evaluates the same way, and sees the saved
+        state of instances.
+        """
+        from .batch import eval_many
+        return eval_many(self, instances, chunk_size=chunk_size)
+
+    def explain(self, model_or_instance=None):
+        """
+        Returns a description of how this predicate is evaluated against
+        instances of a model, or a particular instance.
+
+        This describes the tree as it is evaluated, the order in which its
+        children are evaluated, the relations each lookup traverses and how
+        many values it reaches, the cartesian joins of multi-valued lookups,
+        the evaluator used for each lookup, and whether each lookup can be
+        indexed by PredicateSet and PredicateIndex.
+        """
+        from .explain import explain
+        return explain(self, model_or_instance)
+
+    def to_mask(self, frame, columns=None):
+        """
+        Returns a boolean mask of the rows of a pandas DataFrame or pyarrow
+        Table that match this predicate, computed with vectorized operations.
+        Lookups are read from columns named by their ``__``-joined paths, or
+        by the columns mapping from lookups to column names.
+        """
+        from .frame import to_mask
+        return to_mask(self, frame, columns=columns)
+
+    def filter_frame(self, frame, columns=None):
+        """
+        Returns the rows of a pandas DataFrame or pyarrow Table that match
+        this predicate, or a generator of the matching rows of each record
+        batch of a pyarrow Dataset.
+        """
+        from .frame import filter_frame
+        return filter_frame(self, frame, columns=columns)
+
     def add(self, data, conn_type, squash=True):
         """
         Adapted from `django.utils.tree.Node.add`` to handle the case of
@@ -134,6 +566,18 @@ class P(Q):
         """
         return list(filter((~self).eval, iterable))
 
+    def partition(self, iterable):
+        """
+        Returns a (matches, non_matches) pair of lists of the elements of
+        iterable, evaluating self once per element.
+
+        This is equivalent to (self.filter(iterable), self.exclude(iterable)).
+        """
+        matches, non_matches = [], []
+        for obj in iterable:
+            (matches if self.eval(obj) else non_matches).append(obj)
+        return matches, non_matches
+
     def get(self, iterable):
         """
         Gets the unique element of iterable that matches self.
@@ -141,21 +585,93 @@ class P(Q):
         This follows the QuerySet.get() api, raising ObjectDoesNotExist if no
         element matches and MultipleObjectsReturned if multiple objects match.
         """
-        filtered = self.filter(iterable)
-        if len(filtered) == 0:
-            raise ObjectDoesNotExist('Object matching query does not exist.')
-        elif len(filtered) > 1:
-            raise MultipleObjectsReturned(
-                'get() returned more than one object -- it returned %s!' % len(filtered))
-        else:
-            return filtered[0]
+        return _unique(self.filter(iterable))
 
 
 class LookupNotFound(Exception):
     pass
 
 
+MISSING = object()
+
+# Accessors for LookupComponent._apply_lookup, keyed by (type, component).
+# These are ITEM for keys of plain dicts, ATTRIBUTE for fields of namedtuples
+# and dataclasses, or functions returning the value or MISSING.
+ITEM = 'item'
+ATTRIBUTE = 'attribute'
+_ACCESSORS = {}
+
+
+def _attribute_or_item(component):
+    """
+    Returns an accessor for component as an attribute, or else as a key of
+    dicts, for objects whose attributes aren't known from their type.
+    """
+    def get(obj):
+        value = getattr(obj, component, MISSING)
+        if value is MISSING and isinstance(obj, dict):
+            try:
+                return obj[component]
+            except KeyError:
+                pass
+        return value
+    return get
+
+
+def _model_field(model, component):
+    try:
+        _, accessor = get_field_and_accessor(model, component)
+    except FieldDoesNotExist:
+        return None
+    fallback = _attribute_or_item(component)
+
+    def get(obj):
+        try:
+            return getattr(obj, accessor)
+        except ObjectDoesNotExist:
+            # Occurs in evaluating reverse OneToOneField relationships.
+            return None
+        except AttributeError:
+            return fallback(obj)
+    return get
+
+
+def _dataclass_field(cls, component):
+    """
+    Returns whether component is a field of the dataclass cls that is always
+    set on its instances.
+    """
+    for field in dataclasses.fields(cls):
+        if field.name == component:
+            return field.init or field.default is not dataclasses.MISSING or (
+                field.default_factory is not dataclasses.MISSING)
+    return False
+
+
+def _accessor(cls, component):
+    """
+    Returns the accessor of component for instances of cls. Fields of plain
+    dicts, namedtuples and dataclasses are read directly, without looking for
+    an attribute first.
+    """
+    if issubclass(cls, models.Model):
+        accessor = _model_field(cls, component)
+        if accessor is not None:
+            return accessor
+    elif cls is dict and not hasattr(dict, component):
+        return ITEM
+    elif issubclass(cls, tuple) and component in getattr(cls, '_fields', ()):
+        return ATTRIBUTE
+    elif dataclasses is not None and dataclasses.is_dataclass(cls) and _dataclass_field(
+            cls, component):
+        return ATTRIBUTE
+    return _attribute_or_item(component)
+
+
 class LookupComponent(str):
+    # Accessors by type of object, see _accessor.
+    _accessors = {}
+
     def __repr__(self):
         return '{self.__class__.__name__}({repr})'.format(
             self=self,
@@ -184,18 +700,19 @@ class LookupComponent(str):
         query = 'exact' if self == LookupComponent.EMPTY else self
         return LOOKUP_TO_EVALUATOR[query](rhs)
 
-    def _get_django_field_lookup(self, obj):
+    def _accessor(self, cls):
         """
-        Attempts to get the lookup specified by self using django's field accessor.
-
-        Raises FieldDoesNotExist if the field cannot be found.
+        Returns how to apply this lookup to instances of cls, caching it on
+        self for later evaluations and globally for other components.
         """
-        field, accessor = get_field_and_accessor(obj, self)
-        try:
-            return getattr(obj, accessor)
-        except ObjectDoesNotExist:
-            # Occurs in evaluating reverse OneToOneField relationships.
-            return None
+        key = (cls, self)
+        accessor = _ACCESSORS.get(key)
+        if accessor is None:
+            accessor = _ACCESSORS[key] = _accessor(cls, self)
+        if '_accessors' not in self.__dict__:
+            self._accessors = {}
+        self._accessors[cls] = accessor
+        return accessor
 
     def _apply_lookup(self, obj):
         """
@@ -203,20 +720,22 @@ class LookupComponent(str):
          - The django field accessor if defined.
          - `getattr` if the object has the appropriate attribute.
          - `__getitem__` if the object has a matching key (in a dict).
+
+        Which of these applies is worked out once per type of object, and
+        raises LookupNotFound if none does.
         """
-        if isinstance(obj, models.Model):
-            try:
-                return self._get_django_field_lookup(obj)
-            except (FieldDoesNotExist, AttributeError):
-                pass
-        if hasattr(obj, self):
+        accessor = self._accessors.get(type(obj))
+        if accessor is None:
+            accessor = self._accessor(type(obj))
+        if accessor is ITEM:
+            value = obj.get(self, MISSING)
+        elif accessor is ATTRIBUTE:
             return getattr(obj, self)
-        elif isinstance(obj, dict):
-            try:
-                return obj[self]
-            except KeyError:
-                pass
-        raise LookupNotFound(self, obj)
+        else:
+            value = accessor(obj)
+        if value is MISSING:
+            raise LookupNotFound(self, obj)
+        return value
 
     def values_list(self, obj):
         if obj is None:
@@ -237,6 +756,81 @@ UNDEFINED = object()
 GET = object()
 
 
+def is_expression(value):
+    """
+    Returns whether value is a query expression, such as ``F('int_value')``,
+    rather than a constant.
+    """
+    return isinstance(value, Combinable)
+
+
+def expression_references(expression):
+    """
+    Returns the lookups of the F expressions within expression.
+    """
+    if isinstance(expression, F):
+        return [expression.name]
+    references = []
+    for source in getattr(expression, 'get_source_expressions', list)():
+        references.extend(expression_references(source))
+    return references
+
+
+def _divide(lhs, rhs):
+    if rhs == 0:
+        return None
+    if isinstance(lhs, int) and isinstance(rhs, int):
+        # Integer division truncates towards zero in SQL.
+        quotient = abs(lhs) // abs(rhs)
+        return quotient if (lhs < 0) == (rhs < 0) else -quotient
+    return lhs / rhs
+
+
+def _modulo(lhs, rhs):
+    if rhs == 0:
+        return None
+    if isinstance(lhs, int) and isinstance(rhs, int):
+        # As in SQL, the result has the sign of lhs.
+        return lhs - rhs * _divide(lhs, rhs)
+    elif isinstance(lhs, float) or isinstance(rhs, float):
+        return math.fmod(lhs, rhs)
+    return lhs % rhs
+
+
+EXPRESSION_OPERATORS = {
+    Combinable.ADD: operator.add,
+    Combinable.SUB: operator.sub,
+    Combinable.MUL: operator.mul,
+    Combinable.DIV: _divide,
+    Combinable.MOD: _modulo,
+    Combinable.POW: operator.pow,
+}
+
+
+def evaluate_expression(expression, values):
+    """
+    Returns the value of an F, Value or arithmetic CombinedExpression, where
+    values maps the lookups of F expressions to their values. As in SQL, the
+    result is None if any operand is None, or on division by zero.
+    """
+    if isinstance(expression, F):
+        return values[expression.name]
+    elif isinstance(expression, Value):
+        return expression.value
+    elif isinstance(expression, CombinedExpression) and (
+            expression.connector in EXPRESSION_OPERATORS):
+        lhs = evaluate_expression(expression.lhs, values)
+        rhs = evaluate_expression(expression.rhs, values)
+        if lhs is None or rhs is None:
+            return None
+        return EXPRESSION_OPERATORS[expression.connector](lhs, rhs)
+    raise NotImplementedError('Cannot evaluate %r in memory' % (expression,))
+
+
+def _never(value):
+    return False
+
+
 class LookupNode(object):
     def __init__(self, lookups=None, connector=Q.AND):
         lookups = lookups or {}
@@ -292,11 +886,42 @@ class LookupNode(object):
 
     @cached_property
     def evaluators(self):
-        return [query.build_evaluator(rhs) for query, rhs in self.items()]
+        return [
+            None if is_expression(rhs) else query.build_evaluator(rhs)
+            for query, rhs in self.items()]
+
+    @cached_property
+    def references(self):
+        """
+        Returns the lookups of the F expressions among the values of self.
+        """
+        references = []
+        for _, rhs in self.items():
+            if is_expression(rhs):
+                references.extend(expression_references(rhs))
+        return references
+
+    def row_evaluators(self, row):
+        """
+        Returns the evaluators of self with expressions evaluated against
+        row, a dict of the values of a row of lookups. Lookups comparing with
+        None this way are false, as NULL comparisons are in SQL.
+        """
+        evaluators = []
+        for (query, rhs), evaluator in zip(self.items(), self.evaluators):
+            if evaluator is None:
+                rhs = evaluate_expression(rhs, row)
+                evaluator = _never if rhs is None else query.build_evaluator(rhs)
+            evaluators.append(evaluator)
+        return evaluators
 
     def eval(self, instance):
         query_values_lookups = self.convert_to_query_values_node()
         values = query_values_lookups.values(instance)
+        if self.references:
+            # The values of F expressions are read from the same row of
+            # related values as the lookups comparing with them.
+            return self._eval_expressions(values)
         for node in values:
             if self.connector == Q.AND:
                 node_matches = True
@@ -319,24 +944,51 @@ class LookupNode(object):
                 return True
         return False
 
+    def _eval_expressions(self, values):
+        evaluate = all if self.connector == Q.AND else any
+        paths = self.paths
+        for node in values:
+            row = dict(node.items())
+            if evaluate(
+                    evaluator(row[path])
+                    for path in paths
+                    for evaluator in self[path].row_evaluators(row)):
+                return True
+        return False
+
+    @cached_property
+    def paths(self):
+        """
+        Returns the lookups of self with any query lookup components removed.
+        """
+        paths = []
+        for lookup, _ in self.items():
+            parsed = LookupComponent.parse(lookup)
+            if parsed[-1].is_query:
+                parsed.pop()
+            path = LOOKUP_SEP.join(parsed)
+            if path not in paths:
+                paths.append(path)
+        return paths
+
     def convert_to_query_values_node(self):
         """
         Returns a version of self that has had all query lookup components
-        replaced by GET operations.
+        replaced by GET operations, including the lookups of F expressions.
 
         Used for evaluating predicates.
         """
         lookups = LookupNode(connector=self.connector)
-        for lookup, _ in self.items():
-            parsed = LookupComponent.parse(lookup)
-            if parsed[-1].is_query:
-                parsed.pop()
-            lookups[LOOKUP_SEP.join(parsed)] = GET
+        for path in itertools.chain(self.paths, self.references):
+            lookups[path] = GET
         return lookups
 
-    def values(self, obj):
+    def values(self, obj, outer=False):
         """
         Returns a list of LookupNode instances matching the GET lookups in self.
+
+        With outer=True, a relation without any related objects is followed
+        to None rather than ending the row, as in a LEFT OUTER JOIN.
         """
         lookup2values = {}
         for lookup, child in self.children.items():
@@ -344,9 +996,11 @@ class LookupNode(object):
             if lookup == LookupComponent.EMPTY:
                 child_values = lookup_objects
             else:
+                if outer and not lookup_objects:
+                    lookup_objects = [None]
                 child_values = []
                 for lookup_obj in lookup_objects:
-                    child_values.extend(child.values(lookup_obj))
+                    child_values.extend(child.values(lookup_obj, outer=outer))
             lookup2values[lookup] = child_values
 
         # Construct a cartesian product of all returned values. This
@@ -372,21 +1026,183 @@ def get_values_list(obj, *lookups, **kwargs):
     Django model instances and lookups on django fields:
         SomeModel.objects.filter(pk=obj.pk).values_list(*lookups, **kwargs)
     """
+    return list(values_list([obj], *lookups, **kwargs))
+
+
+def lookup_rows(lookup_node, paths, obj, outer=False):
+    """
+    Yields a list of the values of each of paths for every row of
+    ``lookup_node.values(obj, outer)``.
+    """
+    for value_dict in lookup_node.values(obj, outer=outer):
+        row = []
+        for path in paths:
+            node = value_dict
+            for component in path:
+                node = node.children[component]
+            row.append(node.value)
+        yield row
+
+
+def values_list(iterable, *lookups, **kwargs):
+    """
+    Simulates QuerySet.values_list over every object of iterable, returning a
+    generator of rows. The lookups are parsed once, rather than once per
+    object.
+
+    Accepts the ``flat`` and ``named`` arguments of QuerySet.values_list. With
+    ``columnar=True``, returns a dict mapping each lookup to the list of its
+    values instead, with one entry per row.
+    """
     flat = kwargs.pop('flat', False)
+    named = kwargs.pop('named', False)
+    columnar = kwargs.pop('columnar', False)
     if kwargs:
         raise TypeError('Unexpected keyword arguments to values_list: %s' %
-                        kwargs.keys())
+                        list(kwargs.keys()))
+    if flat and named:
+        raise TypeError("'flat' and 'named' can't be used together.")
     if flat and len(lookups) > 1:
         raise TypeError("'flat' is not valid when values_list is called with more than one field.")  # noqa:E501
 
     lookup_node = LookupNode(lookups={lookup: GET for lookup in lookups})
-    value_dicts = lookup_node.values(obj)
-    if flat:
-        [lookup] = lookups
-        return [value_dict[lookup].value for value_dict in value_dicts]
-    else:
-        return [tuple(value_dict[lookup].value for lookup in lookups)
-                for value_dict in value_dicts]
+    paths = [LookupComponent.parse(lookup) for lookup in lookups]
+
+    def rows():
+        for obj in iterable:
+            for row in lookup_rows(lookup_node, paths, obj):
+                yield row
+
+    if columnar:
+        columns = {lookup: [] for lookup in lookups}
+        appends = [columns[lookup].append for lookup in lookups]
+        for row in rows():
+            for append, value in zip(appends, row):
+                append(value)
+        return columns
+    elif flat:
+        return (value for value, in rows())
+    elif named:
+        Row = collections.namedtuple('Row', lookups, rename=True)
+        return (Row(*row) for row in rows())
+    return (tuple(row) for row in rows())
+
+
+def _filter_partitioned(predicate, objects, lookups):
+    """
+    Returns ``predicate.filter(objects)``, binding predicate once for each
+    combination of the values of lookups among objects, and evaluating only
+    the residual predicate for each object. Objects with several or no
+    values for the lookups are evaluated in full.
+    """
+    lookup_node = LookupNode(lookups={lookup: GET for lookup in lookups})
+    paths = [LookupComponent.parse(lookup) for lookup in lookups]
+    residuals = {}
+    results = []
+    for obj in objects:
+        try:
+            rows = list(lookup_rows(lookup_node, paths, obj))
+        except LookupNotFound:
+            rows = []
+        key = tuple(rows[0]) if len(rows) == 1 else None
+        try:
+            residual = residuals[key]
+        except KeyError:
+            residual = residuals[key] = (
+                predicate if key is None else predicate.bind(**dict(zip(lookups, key))))
+        except TypeError:
+            # Unhashable values.
+            residual = predicate
+        if residual is True or residual is not False and residual.eval(obj):
+            results.append(obj)
+    return results
+
+
+class _Reversed(object):
+    """
+    Wraps a value to invert its ordering, for sorting in descending order.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def _ordering_key(ordering):
+    """
+    Returns a function computing the sort key of an object for ordering, a
+    list of lookups optionally prefixed with '-' for descending order.
+
+    None sorts before all other values, so first in ascending order and last
+    in descending order, as on SQLite and MySQL. PostgreSQL and Oracle sort
+    NULL the other way round. Objects are sorted by the first value of
+    lookups following multi-valued relations.
+    """
+    descending = [lookup.startswith('-') for lookup in ordering]
+    lookups = [lookup[1:] if desc else lookup for desc, lookup in zip(descending, ordering)]
+    lookup_node = LookupNode(lookups={lookup: GET for lookup in lookups})
+    paths = [LookupComponent.parse(lookup) for lookup in lookups]
+    missing = [None] * len(lookups)
+
+    def key(obj):
+        row = next(lookup_rows(lookup_node, paths, obj), missing)
+        return tuple(
+            _Reversed((value is not None, value)) if desc else (value is not None, value)
+            for desc, value in zip(descending, row))
+    return key
+
+
+def _slice_limit(k):
+    """
+    Returns the number of leading results needed for the index or slice k,
+    or None if all results are needed.
+    """
+    if isinstance(k, slice):
+        if k.stop is not None and k.stop >= 0 and (k.start or 0) >= 0:
+            return k.stop
+    elif k >= 0:
+        return k + 1
+    return None
+
+
+def _identity(obj):
+    """
+    Returns a key identifying obj when removing duplicates: the model and
+    primary key of saved model instances, the items of dicts, and otherwise
+    the object itself if hashable, or its id.
+    """
+    if isinstance(obj, models.Model) and obj.pk is not None:
+        return (obj._meta.concrete_model, obj.pk)
+    if isinstance(obj, dict):
+        obj = tuple(obj.items())
+    try:
+        hash(obj)
+    except TypeError:
+        return ('id', id(obj))
+    return obj
+
+
+def _distinct(objects):
+    """
+    Returns a list of objects without duplicates, in their original order.
+    """
+    seen = set()
+    distinct = []
+    for obj in objects:
+        key = _identity(obj)
+        if key not in seen:
+            seen.add(key)
+            distinct.append(obj)
+    return distinct
+
+
+DIFFERENCE = 'DIFFERENCE'
 
 
 class PredicateQuerySet(object):
@@ -394,42 +1210,92 @@ class PredicateQuerySet(object):
     Iterable wrapper that follows the QuerySet API.
     """
     def __init__(self, iterable, p=None):
-        self._evaluated = False
+        self._result_cache = None
+        self._engine = None
+        self._filter_cache = None
+        self._partition = ()
+        self._distinct = False
+        self._ordering = ()
         self.iterable = iterable
         if p is None:
             p = P()
         self.P = p
 
+    @property
+    def _evaluated(self):
+        return self._result_cache is not None
+
     def _evaluate(self):
         """
-        Applies own filters to stored iterable.
+        Applies own filters to stored iterable, caching the results. The
+        iterable itself is left as is, and shared with clones.
+        """
+        if self._result_cache is None:
+            self._result_cache = self._results()
+
+    def _source(self):
         """
-        if self._evaluated:
-            return
-        self._evaluated = True
-        self.iterable = self.P.filter(self.iterable)
+        Returns the objects that own filters apply to.
+        """
+        return self.iterable
+
+    def _results(self, limit=None):
+        """
+        Returns a list of the objects of the source that match own filters,
+        without duplicates if distinct and sorted if ordered.
+
+        Given a limit, returns only the first limit results. These are
+        selected with a heap, in O(n log limit) time, rather than by sorting
+        all results.
+        """
+        if self._engine is not None:
+            results = self._engine.filter(self.P)
+        elif self._filter_cache is not None:
+            results = self._filter_cache.filter(self.P, self._source())
+        elif self._partition:
+            results = _filter_partitioned(self.P, self._source(), self._partition)
+        else:
+            results = self.P.filter(self._source())
+        if self._distinct:
+            results = _distinct(results)
+        if self._ordering:
+            key = _ordering_key(self._ordering)
+            if limit is None:
+                results = sorted(results, key=key)
+            else:
+                results = heapq.nsmallest(limit, results, key=key)
+        elif limit is not None:
+            results = results[:limit]
+        return results
 
     def __repr__(self):
         self._evaluate()
-        data = self.iterable[:REPR_OUTPUT_SIZE + 1]
+        data = self._result_cache[:REPR_OUTPUT_SIZE + 1]
         if len(data) > REPR_OUTPUT_SIZE:
             data[-1] = "...(remaining elements truncated)..."
         return '<PredicateQuerySet %r>' % data
 
     def __getitem__(self, k):
-        self._evaluate()
+        limit = _slice_limit(k)
+        if not self._evaluated and self._ordering and limit is not None:
+            results = self._results(limit)
+        else:
+            self._evaluate()
+            results = self._result_cache
         if isinstance(k, slice):
-            return self.__class__(self.iterable[k])
-        return self.iterable[k]
+            return PredicateQuerySet(results[k])
+        return results[k]
 
     def __iter__(self):
-        return iter(self.iterable)
+        self._evaluate()
+        return iter(self._result_cache)
 
     def _clone(self):
-        clone = type(self)(None)
-        for name, value in self.__dict__.items():
-            setattr(clone, name, copy.deepcopy(value))
-        clone._evaluated = False
+        """
+        Returns an unevaluated copy of self, sharing its iterable.
+        """
+        clone = copy.copy(self)
+        clone._result_cache = None
         return clone
 
     def all(self):
@@ -447,30 +1313,156 @@ class PredicateQuerySet(object):
 
     def get(self, *args, **kwargs):
         clone = self.filter(*args, **kwargs)
-        return clone.P.get(clone.iterable)
+        clone._evaluate()
+        return _unique(clone._result_cache)
 
     def exists(self):
         self._evaluate()
-        return bool(self.iterable)
+        return bool(self._result_cache)
 
     def count(self):
         self._evaluate()
-        return len(self.iterable)
+        return len(self._result_cache)
+
+    def values_list(self, *lookups, **kwargs):
+        """
+        Returns a list of the values of lookups for each object, following
+        QuerySet.values_list.
+        """
+        self._evaluate()
+        return list(values_list(self._result_cache, *lookups, **kwargs))
+
+    def order_by(self, *lookups):
+        """
+        Returns a copy of self sorted by lookups, following QuerySet.order_by.
+        Lookups prefixed with '-' sort in descending order. None sorts as
+        NULL does on SQLite: first in ascending order.
+
+        Sorting happens when results are needed. Indexing or slicing from the
+        start of an unevaluated ordered PredicateQuerySet, as in
+        ``pqs.order_by('-datetime_value')[:20]``, only selects the results
+        needed rather than sorting all of them.
+        """
+        clone = self._clone()
+        clone._ordering = lookups
+        return clone
+
+    def offload(self, engine=None):
+        """
+        Returns a copy of self whose filters, and those of its clones, are
+        evaluated by engine, which must have been created from the same
+        source. Defaults to a new predicate.sqlite.SQLiteEngine.
+
+        Clones share the engine, so the values it loads for one filter are
+        reused by the others.
+        """
+        if engine is None:
+            from .sqlite import SQLiteEngine
+            engine = SQLiteEngine(self._source())
+        clone = self._clone()
+        clone._engine = engine
+        return clone
+
+    def cache_results(self, cache=None):
+        """
+        Returns a copy of self whose filter results, and those of its clones,
+        are kept in cache, a predicate.cache.FilterCache by default. A filter
+        implying one whose results are cached, such as a narrower range or an
+        added condition, re-filters those results instead of the source:
+            pqs = PredicateQuerySet(objects).cache_results()
+            recent = pqs.filter(date__gt=last_week)
+            recent_red = recent.filter(color='red')  # Filters recent's results.
+
+        The source is assumed not to change while results are cached.
+        """
+        if cache is None:
+            from .cache import FilterCache
+            cache = FilterCache()
+        clone = self._clone()
+        clone._filter_cache = cache
+        return clone
+
+    def partition_by(self, *lookups):
+        """
+        Returns a copy of self that partitions the objects by the values of
+        lookups, such as ``tenant_id``, and binds its filters to those values
+        once per partition with P.bind. Each object is then evaluated against
+        only the residual predicate, and partitions whose residual is a
+        constant are included or skipped without evaluating their objects.
+        """
+        clone = self._clone()
+        clone._partition = lookups
+        return clone
+
+    def values(self, *lookups):
+        """
+        Returns a ValuesPredicateQuerySet of dicts of the values of lookups
+        for each object, following QuerySet.values. Without lookups, the
+        concrete fields of model instances, or the keys of dicts, are used.
+        """
+        return ValuesPredicateQuerySet(self, lookups)
+
+    def distinct(self):
+        """
+        Returns a copy of self without duplicate objects. Saved model
+        instances are compared by primary key.
+        """
+        clone = self._clone()
+        clone._distinct = True
+        return clone
+
+    def aggregate(self, *args, **kwargs):
+        """
+        Returns a dict of the values of Django aggregate expressions over the
+        objects, following QuerySet.aggregate. These are computed in a single
+        pass, and Count, Sum, Min, Max and Avg are supported.
+        """
+        from .aggregates import aggregate
+        for arg in args:
+            kwargs[arg.default_alias] = arg
+        self._evaluate()
+        return aggregate(self._result_cache, kwargs)
+
+    def _shares_source(self, other):
+        return (
+            type(self) is type(other)
+            and self.iterable is not None
+            and self.iterable is other.iterable
+            and self._distinct == other._distinct)
 
     def _combine(self, other, connector):
-        clone1 = self._clone()
-        clone2 = other._clone()
-
-        if connector == Q.AND:
-            iterable = filter(set(clone1).__contains__, clone2)
-            p = clone1.P & clone2.P
-        elif connector == Q.OR:
-            iterable = list(itertools.chain(clone1, clone2))
-            p = clone2.P | clone2.P
-        else:
+        """
+        Combines self and other with connector, or DIFFERENCE.
+
+        PredicateQuerySets of the same iterable are combined by combining
+        their predicates, so the result takes a single pass over the iterable.
+        Otherwise the results of each are combined as sets, keeping the order
+        of self then other and removing duplicates. Saved model instances are
+        compared by primary key.
+        """
+        if connector not in (Q.AND, Q.OR, DIFFERENCE):
             raise ValueError('Invalid logical connector: %s' % connector)
 
-        return type(self)(iterable, p=p)
+        if self._shares_source(other):
+            # Q's & and | drop empty operands, though an empty predicate
+            # matches everything, so the nodes are built directly.
+            clone = self._clone()
+            if connector == Q.OR:
+                children = [self.P, other.P]
+            else:
+                children = [self.P, other.P if connector == Q.AND else ~other.P]
+                connector = Q.AND
+            clone.P = type(self.P)._new_instance(children, connector)
+            return clone
+
+        other_keys = {_identity(obj) for obj in other}
+        if connector == Q.OR:
+            objects = itertools.chain(self, other)
+        elif connector == Q.AND:
+            objects = (obj for obj in self if _identity(obj) in other_keys)
+        else:
+            objects = (obj for obj in self if _identity(obj) not in other_keys)
+        return PredicateQuerySet(_distinct(objects))
 
     def __and__(self, other):
         return self._combine(other, Q.AND)
@@ -478,9 +1470,59 @@ class PredicateQuerySet(object):
     def __or__(self, other):
         return self._combine(other, Q.OR)
 
+    def __sub__(self, other):
+        return self._combine(other, DIFFERENCE)
+
     def __bool__(self):
         self._evaluate()
-        return bool(self.iterable)
+        return bool(self._result_cache)
 
     def __nonzero__(self):
         return type(self).__bool__(self)
+
+
+def _fields_of(objects):
+    """
+    Returns the lookups values() uses when given none: the concrete fields of
+    model instances, or the keys of dicts, taken from the first object.
+    """
+    if not objects:
+        return ()
+    elif isinstance(objects[0], models.Model):
+        return tuple(field.attname for field in objects[0]._meta.concrete_fields)
+    elif isinstance(objects[0], dict):
+        return tuple(objects[0])
+    raise TypeError(
+        'values() needs lookups for %s objects, which have no fields or keys.'
+        % type(objects[0]).__name__)
+
+
+class ValuesPredicateQuerySet(PredicateQuerySet):
+    """
+    PredicateQuerySet of dicts of the values of lookups on the objects of
+    another PredicateQuerySet, returned by PredicateQuerySet.values.
+
+    Following QuerySet.values().annotate(), annotating groups the objects by
+    their values, and adds aggregates over each group. The dicts can then be
+    filtered on both their values and their aggregates.
+    """
+    def __init__(self, source=None, lookups=(), p=None):
+        super(ValuesPredicateQuerySet, self).__init__(None, p)
+        self.source = source
+        self.lookups = lookups
+        self.annotations = {}
+
+    def _source(self):
+        objects = list(self.source)
+        lookups = self.lookups or _fields_of(objects)
+        if self.annotations:
+            from .aggregates import aggregate
+            return aggregate(objects, self.annotations, group_by=lookups)
+        return [dict(zip(lookups, row)) for row in values_list(objects, *lookups)]
+
+    def annotate(self, *args, **kwargs):
+        clone = self._clone()
+        for arg in args:
+            kwargs[arg.default_alias] = arg
+        clone.annotations = dict(self.annotations, **kwargs)
+        return clone
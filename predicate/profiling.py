@@ -0,0 +1,223 @@
+"""
+Opt-in profiling of predicate evaluation.
+
+Usage:
+    from predicate.profiling import profile_predicates
+    with profile_predicates() as profile:
+        some_code_where_calling_P()
+    send_to_metrics(profile.as_dict())
+
+Profiling works by patching ``P.eval``, ``LookupNode.eval``,
+``LookupComponent.values_list`` and ``LookupQueryEvaluator.__call__`` for the
+duration of the context, so there is no overhead at all outside of it. Like
+``predicate.debug.patch_with_orm_eval``, the patches apply to all threads,
+and evaluations in all threads are collected in the same profile.
+"""
+import collections
+import threading
+import time
+from contextlib import contextmanager
+from contextlib import ExitStack
+
+from django.db import connections
+from django.db import models
+from django.db.models import QuerySet
+from django.db.models.constants import LOOKUP_SEP
+
+from .lookup_utils import LookupQueryEvaluator
+from .predicate import LookupComponent
+from .predicate import LookupNode
+from .predicate import P
+
+
+class EvaluationStats(object):
+    """
+    Counters for a group of evaluations.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.time = 0.0
+        self.true = 0
+        self.false = 0
+        self.relation_hops = 0
+        self.queries = 0
+
+    def record(self, result, elapsed):
+        self.calls += 1
+        self.time += elapsed
+        if result:
+            self.true += 1
+        else:
+            self.false += 1
+
+    @property
+    def true_ratio(self):
+        return self.true / float(self.calls) if self.calls else None
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'time': self.time,
+            'true': self.true,
+            'false': self.false,
+            'true_ratio': self.true_ratio,
+            'relation_hops': self.relation_hops,
+            'queries': self.queries,
+        }
+
+
+class PredicateProfile(object):
+    """
+    Statistics collected by profile_predicates.
+
+    Attributes:
+        total: Outermost ``P.eval`` calls.
+        nodes: ``LookupNode.eval`` calls, keyed by the node's lookups joined by
+            its connector, e.g. ``'int_value__gt & parent__char_value'``.
+            These include the time spent fetching values, the relations
+            followed and the database queries made while doing so.
+        lookups: Comparisons made for each lookup, e.g. ``'int_value__gt'``.
+        evaluators: Comparisons made by each LookupQueryEvaluator class.
+    """
+    def __init__(self):
+        self.total = EvaluationStats()
+        self.nodes = collections.defaultdict(EvaluationStats)
+        self.lookups = collections.defaultdict(EvaluationStats)
+        self.evaluators = collections.defaultdict(EvaluationStats)
+        self.unattributed_queries = 0
+        self._lock = threading.Lock()
+        # Evaluations in progress are tracked per thread.
+        self._local = threading.local()
+
+    @property
+    def _depth(self):
+        return getattr(self._local, 'depth', 0)
+
+    @_depth.setter
+    def _depth(self, depth):
+        self._local.depth = depth
+
+    @property
+    def _nodes(self):
+        try:
+            return self._local.nodes
+        except AttributeError:
+            nodes = self._local.nodes = []
+            return nodes
+
+    def as_dict(self):
+        return {
+            'total': self.total.as_dict(),
+            'nodes': {key: stats.as_dict() for key, stats in self.nodes.items()},
+            'lookups': {key: stats.as_dict() for key, stats in self.lookups.items()},
+            'evaluators': {key: stats.as_dict() for key, stats in self.evaluators.items()},
+            'unattributed_queries': self.unattributed_queries,
+        }
+
+
+def _node_key(node):
+    return (' %s ' % {'AND': '&', 'OR': '|'}[node.connector]).join(
+        sorted(lookup for lookup, _ in node.items()))
+
+
+def _tag_evaluators(node):
+    """
+    Labels each evaluator of node with its lookup, so comparisons can be
+    attributed to lookups.
+    """
+    for lookup in node.paths:
+        queries = node[lookup]
+        for evaluator, (query, _) in zip(queries.evaluators, queries.items()):
+            if evaluator is None:
+                # Evaluators of expressions are built for each row of values.
+                continue
+            evaluator._profile_lookup = LOOKUP_SEP.join(filter(None, [lookup, query]))
+
+
+@contextmanager
+def profile_predicates(profile=None):
+    """
+    Collects statistics about all predicate evaluations within the context,
+    and yields the PredicateProfile they are collected in.
+    """
+    profile = PredicateProfile() if profile is None else profile
+    timer = time.perf_counter
+    original_eval = P.eval
+    original_node_eval = LookupNode.eval
+    original_values_list = LookupComponent.values_list
+    original_call = LookupQueryEvaluator.__call__
+
+    def eval(predicate, instance):
+        if profile._depth:
+            return original_eval(predicate, instance)
+        profile._depth += 1
+        start = timer()
+        try:
+            result = original_eval(predicate, instance)
+        finally:
+            profile._depth -= 1
+        elapsed = timer() - start
+        with profile._lock:
+            profile.total.record(result, elapsed)
+        return result
+
+    def node_eval(node, instance):
+        with profile._lock:
+            stats = profile.nodes[_node_key(node)]
+        _tag_evaluators(node)
+        profile._nodes.append(stats)
+        start = timer()
+        try:
+            result = original_node_eval(node, instance)
+        finally:
+            profile._nodes.pop()
+        elapsed = timer() - start
+        with profile._lock:
+            stats.record(result, elapsed)
+        return result
+
+    def values_list(component, obj):
+        result = original_values_list(component, obj)
+        # The empty component ending a lookup returns obj itself rather than
+        # following a relation.
+        if component != LookupComponent.EMPTY and profile._nodes and (
+                isinstance(result, QuerySet)
+                or any(isinstance(value, models.Model) for value in result)):
+            with profile._lock:
+                profile._nodes[-1].relation_hops += 1
+        return result
+
+    def call(evaluator, lhs):
+        start = timer()
+        result = original_call(evaluator, lhs)
+        elapsed = timer() - start
+        lookup = getattr(evaluator, '_profile_lookup', None)
+        with profile._lock:
+            profile.evaluators[type(evaluator).__name__].record(result, elapsed)
+            if lookup is not None:
+                profile.lookups[lookup].record(result, elapsed)
+        return result
+
+    def count_query(execute, sql, params, many, context):
+        with profile._lock:
+            if profile._nodes:
+                profile._nodes[-1].queries += 1
+            else:
+                profile.unattributed_queries += 1
+        return execute(sql, params, many, context)
+
+    with ExitStack() as stack:
+        for connection in connections.all():
+            if hasattr(connection, 'execute_wrapper'):  # Django >= 2.0
+                stack.enter_context(connection.execute_wrapper(count_query))
+        try:
+            P.eval = eval
+            LookupNode.eval = node_eval
+            LookupComponent.values_list = values_list
+            LookupQueryEvaluator.__call__ = call
+            yield profile
+        finally:
+            P.eval = original_eval
+            LookupNode.eval = original_node_eval
+            LookupComponent.values_list = original_values_list
+            LookupQueryEvaluator.__call__ = original_call
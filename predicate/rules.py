@@ -0,0 +1,739 @@
+"""
+Evaluation of many predicates against the same instance.
+
+A ``PredicateSet`` compiles a collection of ``P`` objects into a single
+network of checks. Identical lookups are shared between (and within) the
+predicates, so evaluating an instance fetches each lookup path and performs
+each distinct comparison at most once, no matter how many rules use it.
+
+A ``PredicateIndex`` instead maps lookup values and intervals back to the
+predicates using them, so that only the predicates an instance could match
+are evaluated.
+
+``classify`` uses a ``PredicateSet`` to bucket a stream of objects by the
+predicates they match.
+"""
+import collections
+import datetime
+import decimal
+import itertools
+import numbers
+
+from django.db import models
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.query_utils import Q
+
+from .predicate import eval_wrapper
+from .predicate import is_expression
+from .predicate import LookupComponent
+from .predicate import LookupNode
+from .predicate import LookupNotFound
+
+
+def freeze(value):
+    """
+    Returns a hashable representation of value, suitable for use as part of a
+    dictionary key. Raises TypeError if value cannot be represented.
+
+    Values of different types are never frozen to the same key, so the
+    resulting keys are safe to use for sharing lookup evaluators.
+    """
+    if isinstance(value, (list, tuple)):
+        return (type(value), tuple(freeze(item) for item in value))
+    elif isinstance(value, (set, frozenset)):
+        return (type(value), frozenset(freeze(item) for item in value))
+    elif isinstance(value, dict):
+        return (type(value), frozenset(
+            (freeze(k), freeze(v)) for k, v in value.items()))
+    hash(value)
+    return (type(value), value)
+
+
+def _value_key(value):
+    try:
+        return freeze(value)
+    except TypeError:
+        # Unhashable values are only shared with themselves. The compiled
+        # network keeps a reference to value, so its id cannot be reused.
+        return ('id', id(value))
+
+
+def _lookup_node_key(lookups, connector):
+    return ('node', connector, frozenset(
+        (lookup, _value_key(rhs)) for lookup, rhs in lookups.items()))
+
+
+def split_lookup(lookup):
+    """
+    Splits a lookup string into a tuple of path components and the name of
+    the query lookup applied to the values at the end of the path.
+    """
+    components = LookupComponent.parse(lookup)
+    if components and components[-1].is_query:
+        query = components.pop()
+    else:
+        query = 'exact'
+    return tuple(components), query
+
+
+class EvaluationState(object):
+    """
+    Per-instance memo of path values and compiled check results.
+    """
+    def __init__(self, instance):
+        self.instance = instance
+        self.path_values = {(): [instance]}
+        self.value_sets = {}
+        self.results = {}
+
+    def values(self, path):
+        """
+        Returns a flat list of the values reached by following path.
+        """
+        try:
+            return self.path_values[path]
+        except KeyError:
+            pass
+        component = path[-1]
+        values = []
+        for obj in self.values(path[:-1]):
+            values.extend(component.values_list(obj))
+        self.path_values[path] = values
+        return values
+
+    def value_set(self, path):
+        """
+        Returns the set of values reached by following path, or None if the
+        values are not hashable.
+        """
+        try:
+            return self.value_sets[path]
+        except KeyError:
+            pass
+        try:
+            value_set = set(self.values(path))
+        except TypeError:
+            value_set = None
+        self.value_sets[path] = value_set
+        return value_set
+
+    def result(self, check):
+        try:
+            return self.results[check]
+        except KeyError:
+            result = self.results[check] = check.evaluate(self)
+            return result
+
+
+class _LookupCheck(object):
+    """
+    A single lookup on a path, e.g. ``owner__team_id__in=[1, 2]``.
+    """
+    def __init__(self, path, query, rhs):
+        self.path = path
+        self.query = query
+        self.rhs = rhs
+        self.evaluator = LookupComponent(query).build_evaluator(rhs)
+        self.hashable = query == 'exact'
+        try:
+            hash(rhs)
+        except TypeError:
+            self.hashable = False
+
+    def evaluate(self, state):
+        if self.hashable:
+            value_set = state.value_set(self.path)
+            if value_set is not None:
+                # Dispatch all __exact checks on a path through one hash lookup.
+                return self.rhs in value_set
+        return any(self.evaluator(value) for value in state.values(self.path))
+
+
+class _NonEmptyCheck(object):
+    """
+    Whether following a path yields any values at all.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def evaluate(self, state):
+        return bool(state.values(self.path))
+
+
+class _LookupNodeCheck(object):
+    """
+    Lookups that must be satisfied jointly by a single row of related values,
+    e.g. ``m2ms__int_value=1, m2ms__char_value='x'``. These are evaluated with
+    LookupNode to preserve the join semantics.
+    """
+    def __init__(self, lookups, connector):
+        self.node = LookupNode(lookups=lookups, connector=connector)
+
+    def evaluate(self, state):
+        return self.node.eval(state.instance)
+
+
+class _ConnectorCheck(object):
+    def __init__(self, connector, negated, children):
+        self.evaluator = {Q.AND: all, Q.OR: any}[connector]
+        self.negated = negated
+        self.children = children
+
+    def evaluate(self, state):
+        ret = self.evaluator(state.result(child) for child in self.children)
+        return not ret if self.negated else ret
+
+
+class _RuleCollection(object):
+    """
+    Base class for collections of predicates keyed by rule id.
+    """
+    def __init__(self, predicates=None):
+        """
+        Args:
+            predicates: Either a dict mapping rule ids to P objects, or an
+                iterable of P objects, whose rule ids are their indexes.
+        """
+        self.rules = {}
+        if predicates is not None:
+            if isinstance(predicates, dict):
+                predicates = predicates.items()
+            else:
+                predicates = enumerate(predicates)
+            for rule_id, predicate in predicates:
+                self.add(rule_id, predicate)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __contains__(self, rule_id):
+        return rule_id in self.rules
+
+    def __getitem__(self, rule_id):
+        return self.rules[rule_id]
+
+    def add(self, rule_id, predicate):
+        raise NotImplementedError
+
+
+class PredicateSet(_RuleCollection):
+    """
+    A collection of predicates evaluated together against single instances.
+
+    Predicates are added with a rule id, and ``match(instance)`` returns the
+    ids of all rules the instance satisfies. This gives the same answers as
+    calling ``P.eval`` for each rule, but fetches each lookup path once per
+    instance, evaluates each distinct lookup once per instance, and checks all
+    ``__exact`` lookups on a path with a single hash lookup.
+    """
+    def __init__(self, predicates=None):
+        self._roots = {}
+        self._checks = {}
+        super(PredicateSet, self).__init__(predicates)
+
+    def add(self, rule_id, predicate):
+        """
+        Adds predicate to the set under rule_id, replacing any existing rule
+        with that id.
+        """
+        self.rules[rule_id] = predicate
+        self._roots[rule_id] = self._compile(predicate)[0]
+
+    def match(self, instance):
+        """
+        Returns a list of the ids of all rules that instance satisfies, in the
+        order the rules were added.
+        """
+        state = EvaluationState(instance)
+        return [rule_id for rule_id, check in self._roots.items()
+                if state.result(check)]
+
+    def first_match(self, instance, default=None):
+        """
+        Returns the id of the first rule, in the order the rules were added,
+        that instance satisfies, or default if there is none. Later rules are
+        not evaluated.
+        """
+        state = EvaluationState(instance)
+        for rule_id, check in self._roots.items():
+            if state.result(check):
+                return rule_id
+        return default
+
+    def _share(self, key, factory, *args):
+        """
+        Returns the compiled check for key, creating it if necessary.
+        """
+        try:
+            return self._checks[key]
+        except KeyError:
+            check = self._checks[key] = factory(*args)
+            return check
+
+    def _compile(self, predicate):
+        """
+        Returns a (check, key) pair for the P object predicate.
+        """
+        checks = []
+        for child in eval_wrapper(predicate.children, predicate.connector):
+            if isinstance(child, LookupNode):
+                if not child.children:
+                    # An empty LookupNode does not affect its parent's result.
+                    continue
+                checks.append(self._compile_lookup_node(child))
+            else:
+                checks.append(self._compile(child))
+        return self._connector(predicate.connector, checks, negated=predicate.negated)
+
+    def _compile_lookup_node(self, node):
+        """
+        Returns a (check, key) pair for a LookupNode of lookups joined by the
+        parent predicate's connector.
+
+        Lookups starting with different components are independent of each
+        other when LookupNode builds its cartesian product of values, so each
+        such group is compiled separately. Groups containing several lookups
+        may need a single joint row of values, so are evaluated as a whole.
+        So are nodes with F expressions, which may read values from the row
+        of any group.
+        """
+        if node.references:
+            lookups = node.to_dict()
+            key = _lookup_node_key(lookups, node.connector)
+            return self._share(key, _LookupNodeCheck, lookups, node.connector), key
+        groups = []
+        for component, child in node.children.items():
+            lookups = {
+                LOOKUP_SEP.join(filter(None, [component, rest])): rhs
+                for rest, rhs in child.to_dict().items()}
+            if len(lookups) == 1:
+                [(lookup, rhs)] = lookups.items()
+                path, query = split_lookup(lookup)
+                key = ('lookup', path, query, _value_key(rhs))
+                check = self._share(key, _LookupCheck, path, query, rhs)
+            elif node.connector == Q.AND:
+                path = None
+                key = _lookup_node_key(lookups, node.connector)
+                check = self._share(key, _LookupNodeCheck, lookups, node.connector)
+            else:
+                # Whether a joint group is empty can't be known without
+                # evaluating it, so evaluate the whole disjunction as one.
+                lookups = node.to_dict()
+                key = _lookup_node_key(lookups, node.connector)
+                return self._share(key, _LookupNodeCheck, lookups, node.connector), key
+            groups.append((check, key, path))
+
+        checks = [(check, key) for check, key, _ in groups]
+        if len(checks) == 1:
+            return checks[0]
+        if node.connector == Q.OR:
+            # An empty group empties the whole cartesian product, in which case
+            # LookupNode finds no matching row even if another group matches.
+            nonempty = [
+                (self._share(('nonempty', path), _NonEmptyCheck, path), ('nonempty', path))
+                for _, _, path in groups]
+            return self._connector(Q.AND, nonempty + [self._connector(Q.OR, checks)])
+        return self._connector(Q.AND, checks)
+
+    def _connector(self, connector, checks, negated=False):
+        # AND and OR are commutative and idempotent, so nodes whose children
+        # differ only in order or repetition share one check.
+        checks = collections.OrderedDict((key, check) for check, key in checks)
+        key = ('connector', connector, negated, frozenset(checks))
+        check = self._share(key, _ConnectorCheck, connector, negated, list(checks.values()))
+        return check, key
+
+
+class InternTable(object):
+    """
+    A table of predicates interned by fingerprint.
+
+    ``intern(predicate)`` returns the first interned predicate with the same
+    fingerprint, so equivalent predicates, such as the same rule saved by many
+    users, are kept once. Interned predicates are compiled into one network
+    of checks, so identical subtrees within and across them share a single
+    evaluator, and evaluations sharing an EvaluationState compute the result
+    of each subtree once per instance.
+
+    Usage:
+        table = InternTable()
+        rules = [table.intern(predicate) for predicate in predicates]
+        state = EvaluationState(instance)
+        matches = [rule for rule in rules if table.eval(rule, instance, state)]
+    """
+    def __init__(self):
+        self._predicates = {}
+        self._fingerprints = {}
+        self._network = PredicateSet()
+
+    def __len__(self):
+        return len(self._predicates)
+
+    def __contains__(self, predicate):
+        return predicate.fingerprint() in self._predicates
+
+    def intern(self, predicate):
+        """
+        Returns the interned predicate equivalent to predicate, interning
+        predicate itself if there is none.
+        """
+        key = predicate.fingerprint()
+        try:
+            return self._predicates[key]
+        except KeyError:
+            pass
+        self._predicates[key] = predicate
+        # Interned predicates are kept alive by the table, so their ids can't
+        # be reused.
+        self._fingerprints[id(predicate)] = key
+        self._network.add(key, predicate)
+        return predicate
+
+    def eval(self, predicate, instance, state=None):
+        """
+        Returns ``predicate.eval(instance)``, interning predicate if needed.
+        Pass the same EvaluationState for instance to share the results of
+        identical subtrees between predicates.
+        """
+        key = self._fingerprints.get(id(predicate))
+        if key is None:
+            key = self._fingerprints[id(self.intern(predicate))]
+        if state is None:
+            state = EvaluationState(instance)
+        return state.result(self._network._roots[key])
+
+
+def _index_key(value):
+    """
+    Casts value the same way the ``__in`` evaluator does, so that values that
+    compare equal to a lookup's right hand side also hash equal to it.
+    """
+    if isinstance(value, tuple) and len(value) == 1:
+        value, = value
+    elif isinstance(value, models.Model):
+        value = value.pk
+    return value
+
+
+def _interval_kind(value):
+    """
+    Returns a key grouping values that are comparable with each other.
+    """
+    if isinstance(value, (numbers.Real, decimal.Decimal)):
+        return 'number'
+    elif isinstance(value, datetime.datetime):
+        return ('datetime', value.tzinfo is None)
+    return type(value)
+
+
+class _IntervalTreeNode(object):
+    def __init__(self, intervals):
+        endpoints = sorted(
+            bound for lo, hi, _ in intervals for bound in (lo, hi) if bound is not None)
+        self.center = center = endpoints[len(endpoints) // 2]
+        left, here, right = [], [], []
+        for interval in intervals:
+            lo, hi, _ = interval
+            if hi is not None and hi < center:
+                left.append(interval)
+            elif lo is not None and lo > center:
+                right.append(interval)
+            else:
+                here.append(interval)
+        # Unbounded ends sort before all bounded ones.
+        self.by_lo = sorted(
+            here, key=lambda interval: (interval[0] is not None, interval[0]))
+        self.by_hi = sorted(
+            here, key=lambda interval: (interval[1] is None, interval[1]), reverse=True)
+        self.left = _IntervalTreeNode(left) if left else None
+        self.right = _IntervalTreeNode(right) if right else None
+
+
+class IntervalTree(object):
+    """
+    Centered interval tree, answering which closed intervals contain a point in
+    O(log n + k) time for k results.
+
+    Intervals are (lo, hi) pairs, where a bound of None is unbounded. All the
+    bounds in a tree must be comparable with each other. The tree is rebuilt
+    lazily on the first query after it is modified.
+    """
+    def __init__(self):
+        self._intervals = []
+        self._root = None
+        self._dirty = False
+
+    def __len__(self):
+        return len(self._intervals)
+
+    def __iter__(self):
+        return (item for _, _, item in self._intervals)
+
+    def add(self, lo, hi, item):
+        if lo is None and hi is None:
+            raise ValueError('An interval needs at least one bound.')
+        self._intervals.append((lo, hi, item))
+        self._dirty = True
+
+    def remove(self, item):
+        self._intervals = [
+            interval for interval in self._intervals if interval[2] != item]
+        self._dirty = True
+
+    def stab(self, point):
+        """
+        Yields the items of all intervals containing point.
+        """
+        if self._dirty:
+            # Empty intervals contain no points.
+            intervals = [
+                interval for interval in self._intervals
+                if interval[0] is None or interval[1] is None or interval[0] <= interval[1]]
+            self._root = _IntervalTreeNode(intervals) if intervals else None
+            self._dirty = False
+        node = self._root
+        while node is not None:
+            if point < node.center:
+                for lo, _, item in node.by_lo:
+                    if lo is not None and lo > point:
+                        break
+                    yield item
+                node = node.left
+            elif point > node.center:
+                for _, hi, item in node.by_hi:
+                    if hi is not None and hi < point:
+                        break
+                    yield item
+                node = node.right
+            else:
+                for _, _, item in node.by_lo:
+                    yield item
+                node = None
+
+
+_LOWER_BOUNDED = {'gt', 'gte'}
+_UPPER_BOUNDED = {'lt', 'lte'}
+
+
+def lookup_index_entries(lookup, rhs):
+    """
+    Returns a list of index entries for a single lookup, or None if the lookup
+    cannot be indexed. Any value satisfying the lookup hits one of the entries.
+    """
+    if is_expression(rhs):
+        return None
+    path, query = split_lookup(lookup)
+    if query in ('exact', 'in'):
+        keys = [rhs] if query == 'exact' else rhs
+        try:
+            return [(path, 'hash', key) for key in {_index_key(key) for key in keys}]
+        except TypeError:
+            return None
+    if query in _LOWER_BOUNDED:
+        lo, hi = rhs, None
+    elif query in _UPPER_BOUNDED:
+        lo, hi = None, rhs
+    elif query == 'range':
+        lo, hi = rhs
+    else:
+        return None
+    if lo is None and hi is None:
+        return None
+    kinds = {_interval_kind(bound) for bound in (lo, hi) if bound is not None}
+    if len(kinds) != 1:
+        return None
+    if lo is not None and hi is not None and lo > hi:
+        # No value is within an inverted range, so the lookup never matches.
+        return []
+    return [(path, 'interval', (lo, hi))]
+
+
+def _entries_cost(entries):
+    return sum(1 if kind == 'hash' else 4 for _, kind, _ in entries)
+
+
+def index_entries(predicate):
+    """
+    Returns a list of index entries for the P object predicate, such that any
+    instance matching predicate hits at least one of the entries, or None if
+    no such entries can be found.
+    """
+    if predicate.negated:
+        return None
+    options = []
+    for child in eval_wrapper(predicate.children, predicate.connector):
+        if isinstance(child, LookupNode):
+            # Every lookup must hold for some value on its path, regardless of
+            # how LookupNode joins the values.
+            options.extend(
+                lookup_index_entries(lookup, rhs) for lookup, rhs in child.items())
+        else:
+            options.append(index_entries(child))
+    if predicate.connector == Q.AND:
+        options = [entries for entries in options if entries is not None]
+        return min(options, key=_entries_cost) if options else None
+    elif None in options:
+        return None
+    return [entry for entries in options for entry in entries]
+
+
+def _interval_trees(interval):
+    """
+    Yields (tree kind, interval) pairs that interval should be stored under.
+    """
+    lo, hi = interval
+    kind = _interval_kind(lo if lo is not None else hi)
+    yield kind, interval
+    if isinstance(kind, tuple):
+        # Datetime bounds are compared with date values as dates.
+        yield datetime.date, tuple(
+            None if bound is None else bound.date() for bound in interval)
+
+
+class PredicateIndex(_RuleCollection):
+    """
+    An inverted index over a collection of predicates, answering which of them
+    an instance matches.
+
+    Each predicate is indexed under the values of its ``__exact`` and ``__in``
+    lookups, or the intervals of its ``__gt``, ``__lt`` and ``__range`` style
+    lookups, that any matching instance must hit. Matching an instance looks
+    up its values in the index to find candidate predicates, and only fully
+    evaluates those candidates. Predicates that cannot be indexed, such as
+    negated ones, are always candidates.
+
+    Instances that are missing an indexed lookup path do not match the
+    predicates indexed on that path.
+    """
+    def __init__(self, predicates=None):
+        self._order = {}
+        self._entries = {}
+        self._unindexed = set()
+        self._hashes = {}
+        self._intervals = {}
+        self._sequence = itertools.count()
+        super(PredicateIndex, self).__init__(predicates)
+
+    def add(self, rule_id, predicate):
+        """
+        Adds predicate to the index under rule_id, replacing any existing rule
+        with that id.
+        """
+        if rule_id in self.rules:
+            self.remove(rule_id)
+        entries = index_entries(predicate)
+        self.rules[rule_id] = predicate
+        self._order[rule_id] = next(self._sequence)
+        self._entries[rule_id] = entries
+        if entries is None:
+            self._unindexed.add(rule_id)
+            return
+        for path, kind, payload in entries:
+            if kind == 'hash':
+                self._hashes.setdefault(path, {}).setdefault(payload, set()).add(rule_id)
+            else:
+                for tree_kind, (lo, hi) in _interval_trees(payload):
+                    trees = self._intervals.setdefault(path, {})
+                    trees.setdefault(tree_kind, IntervalTree()).add(lo, hi, rule_id)
+
+    def remove(self, rule_id):
+        """
+        Removes the rule with id rule_id from the index.
+        """
+        del self.rules[rule_id]
+        del self._order[rule_id]
+        entries = self._entries.pop(rule_id)
+        if entries is None:
+            self._unindexed.discard(rule_id)
+            return
+        for path, kind, payload in entries:
+            if kind == 'hash':
+                rule_ids = self._hashes[path][payload]
+                rule_ids.discard(rule_id)
+                if not rule_ids:
+                    del self._hashes[path][payload]
+                    if not self._hashes[path]:
+                        del self._hashes[path]
+            else:
+                for tree_kind, _ in _interval_trees(payload):
+                    self._intervals[path][tree_kind].remove(rule_id)
+
+    def _probe_intervals(self, trees, value):
+        kind = _interval_kind(value)
+        probes = [(kind, value)]
+        if isinstance(kind, tuple):
+            # Datetime values are compared with date bounds as dates.
+            probes.append((datetime.date, value.date()))
+        for kind, point in probes:
+            tree = trees.get(kind)
+            if tree is None:
+                continue
+            try:
+                for rule_id in tree.stab(point):
+                    yield rule_id
+            except TypeError:
+                # Incomparable values can't be ruled out.
+                for rule_id in tree:
+                    yield rule_id
+
+    def candidates(self, instance):
+        """
+        Returns the set of ids of the rules that instance may match.
+        """
+        state = EvaluationState(instance)
+        candidates = set(self._unindexed)
+        for path in set(self._hashes) | set(self._intervals):
+            try:
+                values = state.values(path)
+            except LookupNotFound:
+                continue
+            hashes = self._hashes.get(path, {})
+            trees = self._intervals.get(path, {})
+            for value in values:
+                try:
+                    candidates.update(hashes.get(_index_key(value), ()))
+                except TypeError:
+                    pass
+                if trees and value is not None:
+                    candidates.update(self._probe_intervals(trees, value))
+        return candidates
+
+    def match(self, instance):
+        """
+        Returns a list of the ids of all rules that instance satisfies, in the
+        order the rules were added.
+        """
+        candidates = sorted(self.candidates(instance), key=self._order.__getitem__)
+        return [rule_id for rule_id in candidates if self.rules[rule_id].eval(instance)]
+
+
+def classify(iterable, predicates, first_match=True, default=None):
+    """
+    Buckets the elements of iterable by the predicates they match, in a single
+    pass that fetches each lookup path once per element, however many of the
+    predicates use it.
+
+    Args:
+        predicates: Either a dict mapping names to P objects, or an iterable
+            of P objects, whose names are their indexes.
+        first_match: If true, each element goes in the bucket of the first
+            predicate it matches. Otherwise it goes in the bucket of every
+            predicate it matches.
+        default: The name of the bucket of elements matching no predicate.
+
+    Returns a dict mapping each name, and default, to a list of elements in
+    the order of iterable.
+    """
+    rules = PredicateSet(predicates)
+    buckets = {rule_id: [] for rule_id in rules}
+    buckets.setdefault(default, [])
+    for obj in iterable:
+        if first_match:
+            buckets[rules.first_match(obj, default)].append(obj)
+        else:
+            for rule_id in rules.match(obj) or [default]:
+                buckets[rule_id].append(obj)
+    return buckets
@@ -0,0 +1,257 @@
+"""
+Evaluation of predicates over large in-memory collections with SQLite.
+
+The values a predicate's lookups reach are loaded into tables of an
+in-memory SQLite database, and the predicate is translated into a WHERE
+clause over them. Tables and indexes are kept for later predicates over the
+same collection that use the same lookups.
+
+Usage:
+    engine = SQLiteEngine(objects)
+    matches = engine.filter(P(int_value__gt=5) | ~P(tags__name='x'))
+    # or, for all filters of a PredicateQuerySet and its clones:
+    pqs = PredicateQuerySet(objects).offload()
+"""
+import sqlite3
+
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.query_utils import Q
+
+from .lookup_utils import LOOKUP_TO_EVALUATOR
+from .predicate import eval_wrapper
+from .predicate import GET
+from .predicate import LookupComponent
+from .predicate import LookupNode
+from .predicate import lookup_rows
+from .predicate import LookupNotFound
+from .rules import split_lookup
+
+# Columns hold numbers or text natively. Columns of other values, or of both
+# numbers and text, hold references to the Python values instead, and lookups
+# on them are evaluated in Python.
+NUMBER = 'number'
+TEXT = 'text'
+OPAQUE = 'opaque'
+
+# Beyond this size, __in lists are checked in Python against a set rather
+# than passed as query parameters.
+MAX_IN_PARAMETERS = 500
+
+
+def _kind(value):
+    if isinstance(value, float) or isinstance(value, int) and -2 ** 63 <= value < 2 ** 63:
+        return NUMBER
+    elif isinstance(value, str):
+        return TEXT
+    return OPAQUE
+
+
+class _Table(object):
+    """
+    The rows of ``LookupNode.values`` for every object, for the paths of one
+    lookup node. Column i holds the values of paths[i], and each row holds
+    the index of the object it belongs to.
+    """
+    def __init__(self, name, paths, kinds):
+        self.name = name
+        self.columns = {path: 'c%d' % i for i, path in enumerate(paths)}
+        self.kinds = dict(zip(paths, kinds))
+        self.indexed = set()
+
+
+class SQLiteEngine(object):
+    """
+    Filters a collection of objects with predicates evaluated by an
+    in-memory SQLite database.
+
+    Results are the same as ``P.filter``: comparisons that SQLite can't make
+    with Python semantics, such as regexes, case-insensitive lookups and
+    lookups on dates or model instances, are made by calling the lookup's
+    evaluator from SQL. Lookups comparing with F expressions are evaluated
+    in Python for each object. Predicates with lookups that some objects
+    don't have are evaluated with ``P.eval``, which raises LookupNotFound
+    only for the lookups it reaches.
+
+    The collection is assumed not to change after the engine is created.
+    """
+    def __init__(self, objects):
+        self.objects = list(objects)
+        self.connection = sqlite3.connect(':memory:')
+        self.connection.execute('CREATE TABLE objects (row INTEGER PRIMARY KEY)')
+        self.connection.executemany(
+            'INSERT INTO objects (row) VALUES (?)', ((i,) for i in range(len(self.objects))))
+        self._tables = {}
+        self._references = []
+        self._evaluators = []
+        self.connection.create_function('py_lookup', 2, self._lookup)
+        self.connection.create_function('py_lookup_ref', 2, self._lookup_reference)
+        self.connection.create_function('py_object', 2, self._object)
+
+    def _lookup(self, evaluator, value):
+        return self._evaluators[evaluator](value)
+
+    def _object(self, evaluator, row):
+        return self._evaluators[evaluator](self.objects[row])
+
+    def _lookup_reference(self, evaluator, reference):
+        return self._evaluators[evaluator](
+            None if reference is None else self._references[reference])
+
+    def _table(self, paths):
+        """
+        Returns the _Table of the values of paths, loading it if needed.
+        """
+        key = frozenset(paths)
+        try:
+            return self._tables[key]
+        except KeyError:
+            pass
+
+        paths = sorted(key)
+        lookups = [LOOKUP_SEP.join(path) for path in paths]
+        node = LookupNode(lookups={lookup: GET for lookup in lookups})
+        parsed = [LookupComponent.parse(lookup) for lookup in lookups]
+        rows = [
+            [i] + row
+            for i, obj in enumerate(self.objects)
+            for row in lookup_rows(node, parsed, obj)]
+
+        kinds = []
+        for column in range(1, len(paths) + 1):
+            column_kinds = {_kind(row[column]) for row in rows if row[column] is not None}
+            if len(column_kinds) > 1:
+                kind = OPAQUE
+            else:
+                kind = column_kinds.pop() if column_kinds else NUMBER
+            if kind == OPAQUE:
+                for row in rows:
+                    if row[column] is not None:
+                        self._references.append(row[column])
+                        row[column] = len(self._references) - 1
+            kinds.append(kind)
+
+        table = _Table('t%d' % len(self._tables), paths, kinds)
+        columns = ', '.join(table.columns[path] for path in paths)
+        self.connection.execute('CREATE TABLE %s (row INTEGER, %s)' % (table.name, columns))
+        self.connection.executemany(
+            'INSERT INTO %s VALUES (%s)' % (table.name, ', '.join('?' * (len(paths) + 1))),
+            rows)
+        self.connection.execute('CREATE INDEX %s_row ON %s (row)' % (table.name, table.name))
+        self._tables[key] = table
+        return table
+
+    def _index(self, table, column):
+        if column not in table.indexed:
+            self.connection.execute('CREATE INDEX %s_%s ON %s (%s)' % (
+                table.name, column, table.name, column))
+            table.indexed.add(column)
+
+    def _python_lookup(self, table, path, query, rhs, params):
+        self._evaluators.append(LOOKUP_TO_EVALUATOR[query](rhs))
+        params.append(len(self._evaluators) - 1)
+        function = 'py_lookup_ref' if table.kinds[path] == OPAQUE else 'py_lookup'
+        return '%s(?, %s)' % (function, table.columns[path])
+
+    def _lookup_sql(self, table, path, query, rhs, params):
+        """
+        Returns SQL for a lookup that is true or false, and never NULL.
+        """
+        column = table.columns[path]
+        kind = table.kinds[path]
+        if query == 'isnull' and isinstance(rhs, bool):
+            return '(%s IS NULL) = %d' % (column, rhs)
+        elif query == 'exact' and rhs is None:
+            return '%s IS NULL' % column
+        elif kind == OPAQUE or not (rhs is None or _kind(rhs) == kind or query in ('in', 'range')):
+            return self._python_lookup(table, path, query, rhs, params)
+
+        operators = {'exact': 'IS', 'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<='}
+        if query in operators:
+            self._index(table, column)
+            params.append(rhs)
+            return 'COALESCE(%s %s ?, 0)' % (column, operators[query])
+        elif (query == 'in' and isinstance(rhs, (list, tuple, set, frozenset))
+                and len(rhs) <= MAX_IN_PARAMETERS
+                and all(value is None or _kind(value) == kind for value in rhs)):
+            self._index(table, column)
+            values = [value for value in rhs if value is not None]
+            params.extend(values)
+            sql = 'COALESCE(%s IN (%s), 0)' % (column, ', '.join('?' * len(values)))
+            if len(values) < len(rhs):
+                sql = '(%s OR %s IS NULL)' % (sql, column)
+            return sql
+        elif query == 'range' and len(rhs) == 2 and all(_kind(value) == kind for value in rhs):
+            self._index(table, column)
+            params.extend(rhs)
+            return 'COALESCE(%s > ? AND %s < ?, 0)' % (column, column)
+        elif kind == TEXT and query in ('contains', 'search') and _kind(rhs) == TEXT:
+            params.append(rhs)
+            return 'COALESCE(instr(%s, ?) > 0, 0)' % column
+        elif kind == TEXT and query == 'startswith' and _kind(rhs) == TEXT:
+            params.extend([rhs, rhs])
+            return 'COALESCE(substr(%s, 1, length(?)) = ?, 0)' % column
+        return self._python_lookup(table, path, query, rhs, params)
+
+    def _node_sql(self, node, params):
+        """
+        Returns SQL for whether a row of objects matches a LookupNode: whether
+        any of the rows of its values match all (or any, for OR) lookups.
+        """
+        if node.references:
+            # Lookups comparing with F expressions are evaluated in Python.
+            self._evaluators.append(node.eval)
+            params.append(len(self._evaluators) - 1)
+            return 'py_object(?, objects.row)'
+        lookups = [(split_lookup(lookup), rhs) for lookup, rhs in node.items()]
+        table = self._table({path for (path, _), _ in lookups})
+        conditions = [
+            self._lookup_sql(table, path, query, rhs, params)
+            for (path, query), rhs in lookups]
+        connector = ' AND ' if node.connector == Q.AND else ' OR '
+        return 'objects.row IN (SELECT row FROM %s WHERE %s)' % (
+            table.name, connector.join(conditions))
+
+    def _where(self, predicate, params):
+        conditions = []
+        for child in eval_wrapper(predicate.children, predicate.connector):
+            if not isinstance(child, LookupNode):
+                conditions.append(self._where(child, params))
+            elif child.children:
+                conditions.append(self._node_sql(child, params))
+        if conditions:
+            connector = ' AND ' if predicate.connector == Q.AND else ' OR '
+            sql = '(%s)' % connector.join(conditions)
+        else:
+            sql = '1' if predicate.connector == Q.AND else '0'
+        return 'NOT %s' % sql if predicate.negated else sql
+
+    def rows(self, predicate):
+        """
+        Returns the indexes of the objects that match predicate, in order.
+        """
+        params = []
+        self._evaluators = []
+        try:
+            where = self._where(predicate, params)
+        except LookupNotFound:
+            # Tables hold the values of every lookup, but P.eval only reads
+            # lookups it gets to, so doesn't raise when another child already
+            # decides the result. Evaluate as P.filter does.
+            return [row for row, obj in enumerate(self.objects) if predicate.eval(obj)]
+        sql = 'SELECT row FROM objects WHERE %s ORDER BY row' % where
+        return [row for row, in self.connection.execute(sql, params)]
+
+    def filter(self, predicate):
+        """
+        Returns a list of the objects that match predicate, in order.
+        """
+        return [self.objects[row] for row in self.rows(predicate)]
+
+    def exclude(self, predicate):
+        return self.filter(~predicate)
+
+    def count(self, predicate):
+        return len(self.rows(predicate))
+
+    def close(self):
+        self.connection.close()
@@ -31,6 +31,9 @@ setup(
     packages=[
         'predicate',
     ],
+    extras_require={
+        'frame': ['pandas', 'pyarrow'],
+    },
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Environment :: Web Environment',
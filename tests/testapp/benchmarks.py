@@ -0,0 +1,282 @@
+"""
+Benchmarks for in-memory predicate evaluation.
+
+Run from the repository root with:
+    python -m tests.testapp.benchmarks [--scale 1] [--repeat 5] \
+        [--json results.json] [--compare baseline.json]
+
+The benchmarks run offline against a throwaway SQLite test database. Test
+objects are loaded (with their relations prefetched) before timing, so the
+numbers measure in-memory evaluation rather than database access. For each
+benchmark this reports the throughput in objects per second, using the best of
+``--repeat`` runs, and the peak memory allocated during a single run.
+Results saved with ``--json`` from one commit can be passed to ``--compare`` on
+another to show the relative change.
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import time
+import tracemalloc
+
+BENCHMARKS = []
+
+COLORS = ['red', 'blue', 'yellow', 'green', 'orange',
+          'purple', 'violet', 'brown', 'black', 'white']
+
+
+def benchmark(func):
+    """
+    Registers a benchmark. The decorated function takes the list of test
+    objects, and returns a function to time, which is called with no
+    arguments and processes every test object once.
+    """
+    BENCHMARKS.append(func)
+    return func
+
+
+def make_objects(scale):
+    """
+    Creates the benchmark data, and returns the test objects with their
+    relations loaded.
+
+    Each TestObj is part of a parent chain at least four deep, and has five
+    m2ms out of a pool of fifty.
+    """
+    from .models import M2MModel
+    from .models import TestObj
+
+    rng = random.Random(0)
+    M2MModel.objects.bulk_create([
+        M2MModel(int_value=rng.randint(0, 20), char_value=rng.choice(COLORS))
+        for _ in range(50)])
+    m2ms = list(M2MModel.objects.all())
+    count = max(int(1000 * scale), 10)
+    parent = None
+    for i in range(count):
+        obj = TestObj.objects.create(
+            int_value=rng.randint(0, 100),
+            char_value=' '.join(rng.choice(COLORS) for _ in range(3)),
+            parent=parent if i % 10 else None)
+        obj.m2ms.set(rng.sample(m2ms, 5))
+        parent = obj
+    return list(
+        TestObj.objects
+        .select_related('parent__parent__parent__parent')
+        .prefetch_related('m2ms')
+        .order_by('pk'))
+
+
+def _eval_all(predicate, objects):
+    def run():
+        for obj in objects:
+            predicate.eval(obj)
+    return run
+
+
+@benchmark
+def flat_predicate(objects):
+    from predicate import P
+    return _eval_all(P(int_value__gt=50, char_value__contains='red'), objects)
+
+
+@benchmark
+def deep_foreign_key_chain(objects):
+    from predicate import P
+    return _eval_all(P(parent__parent__parent__parent__int_value__gt=50), objects)
+
+
+@benchmark
+def m2m_fan_out_join(objects):
+    from predicate import P
+    return _eval_all(P(m2ms__int_value__gt=5, m2ms__char_value='red'), objects)
+
+
+@benchmark
+def negation(objects):
+    from predicate import P
+    return _eval_all(~(P(int_value__lt=30) | P(char_value__startswith='blue')), objects)
+
+
+@benchmark
+def plain_objects(objects):
+    try:
+        import dataclasses
+    except ImportError:
+        # Python < 3.7, where all records are dicts.
+        dataclasses = None
+    from predicate import P
+    if dataclasses is not None:
+        Record = dataclasses.make_dataclass('Record', ['int_value', 'char_value', 'parent'])
+    records = []
+    for i, obj in enumerate(objects):
+        parent = obj.parent and {'int_value': obj.parent.int_value}
+        if i % 2 and dataclasses is not None:
+            records.append(Record(obj.int_value, obj.char_value, parent))
+        else:
+            records.append(
+                {'int_value': obj.int_value, 'char_value': obj.char_value, 'parent': parent})
+    return _eval_all(
+        P(int_value__gt=50, char_value__contains='red', parent__int_value__lt=90), records)
+
+
+@benchmark
+def large_in_list(objects):
+    from predicate import P
+    return _eval_all(P(pk__in=range(0, 100000, 3)), objects)
+
+
+@benchmark
+def regex(objects):
+    from predicate import P
+    return _eval_all(P(char_value__iregex=r'^(red|blue) .* (green|black)$'), objects)
+
+
+@benchmark
+def predicate_queryset_filter_chain(objects):
+    from predicate import PredicateQuerySet
+
+    def run():
+        (PredicateQuerySet(objects)
+         .filter(int_value__gte=10)
+         .exclude(char_value__startswith='white')
+         .filter(parent__int_value__lt=90)
+         .count())
+    return run
+
+
+@benchmark
+def sqlite_engine(objects):
+    from predicate import P
+    from predicate.sqlite import SQLiteEngine
+    engine = SQLiteEngine(objects)
+    predicate = P(int_value__gt=50, char_value__contains='red') | P(m2ms__int_value__lt=3)
+
+    def run():
+        engine.filter(predicate)
+    return run
+
+
+@benchmark
+def get_values_list(objects):
+    from predicate.predicate import get_values_list
+
+    def run():
+        for obj in objects:
+            get_values_list(obj, 'int_value', 'parent__char_value', 'm2ms__int_value')
+    return run
+
+
+@benchmark
+def bulk_values_list(objects):
+    from predicate.predicate import values_list
+
+    def run():
+        for _ in values_list(objects, 'int_value', 'parent__char_value', 'm2ms__int_value'):
+            pass
+    return run
+
+
+@benchmark
+def lookup_node_values(objects):
+    from predicate.predicate import GET
+    from predicate.predicate import LookupNode
+    node = LookupNode(lookups={
+        'int_value': GET, 'parent__parent__int_value': GET, 'm2ms__char_value': GET})
+
+    def run():
+        for obj in objects:
+            node.values(obj)
+    return run
+
+
+def measure(run, repeat):
+    """
+    Returns (best seconds per run, peak bytes allocated in one run).
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return best, peak
+
+
+def run_benchmarks(scale=1, repeat=5, names=None):
+    """
+    Runs the benchmarks against the configured database, and returns a dict
+    mapping benchmark names to their results.
+    """
+    objects = make_objects(scale)
+    results = {}
+    for func in BENCHMARKS:
+        if names and func.__name__ not in names:
+            continue
+        seconds, peak = measure(func(objects), repeat)
+        results[func.__name__] = {
+            'objects': len(objects),
+            'seconds': seconds,
+            'objects_per_second': len(objects) / seconds if seconds else float('inf'),
+            'peak_bytes': peak,
+        }
+    return results
+
+
+def format_results(results, baseline=None):
+    lines = ['%-34s %14s %12s %10s' % ('benchmark', 'objects/s', 'peak KiB', 'change')]
+    for name, result in results.items():
+        change = ''
+        if baseline and name in baseline:
+            ratio = result['objects_per_second'] / baseline[name]['objects_per_second']
+            change = '%+.1f%%' % (100 * (ratio - 1))
+        lines.append('%-34s %14.0f %12.1f %10s' % (
+            name, result['objects_per_second'], result['peak_bytes'] / 1024., change))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scale', type=float, default=1,
+                        help='Multiplier for the number of test objects (1000 at scale 1).')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', help='Write the results to this file.')
+    parser.add_argument('--compare', help='Compare against results saved with --json.')
+    parser.add_argument('names', nargs='*', help='Only run these benchmarks.')
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.testapp.settings')
+    import django
+    django.setup()
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    from django.test.utils import teardown_test_environment
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        results = run_benchmarks(args.scale, args.repeat, args.names)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print(format_results(results, baseline))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -31,6 +31,15 @@ class M2MModel(Base):
     pass
 
 
+class PositiveManager(models.Manager):
+    def get_queryset(self):
+        return super(PositiveManager, self).get_queryset().filter(int_value__gt=0)
+
+
+class FilteredManagerModel(Base):
+    objects = PositiveManager()
+
+
 class OneToOneModel(Base):
     test_obj = models.OneToOneField(
         TestObj, null=True, on_delete=models.CASCADE)
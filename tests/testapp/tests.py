@@ -3,27 +3,87 @@
 from datetime import date
 from datetime import datetime
 from datetime import timedelta
-from random import choice, random
+from decimal import Decimal
+import collections
+import heapq
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from random import choice, random, Random
 from unittest import expectedFailure
+from unittest import skipUnless
 
 import mock
 from django.core.exceptions import MultipleObjectsReturned
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.db.models import Avg
+from django.db.models import Count
+from django.db.models import F
+from django.db.models import Max
+from django.db.models import Min
 from django.db.models import Q
+from django.db.models import StdDev
+from django.db.models import Sum
 from django.test import skipIfDBFeature
 from django.test import TestCase
-
+from django.test import TransactionTestCase
+
+try:
+    import dataclasses
+except ImportError:
+    # Python < 3.7.
+    dataclasses = None
+
+try:
+    import pandas
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pandas = pyarrow = None
+
+from predicate.debug import Mismatch
+from predicate.debug import original_eval
 from predicate.debug import OrmP
 from predicate.debug import patch_with_orm_eval
 from predicate.debug import OrmPredicateQuerySet
+from predicate.debug import patch_with_sampling_validator
+from predicate.debug import SamplingValidator
+from predicate.frame import filter_dataset
+from predicate.predicate import evaluate_expression
 from predicate.predicate import GET
 from predicate.predicate import get_values_list
 from predicate.predicate import LookupComponent
 from predicate.predicate import LookupNode
 from predicate.predicate import LookupNotFound
+from predicate.predicate import lookup_rows
+from predicate.predicate import values_list
 from predicate import P
 from predicate import PredicateQuerySet
+from predicate.cache import CacheInfo
+from predicate.cache import EvalCache
+from predicate.cache import FilterCache
+from predicate.cache import patch_with_eval_cache
+from predicate.materialized import Delta
+from predicate.materialized import MaterializedPredicateView
+from predicate.profiling import profile_predicates
+from predicate.rules import classify
+from predicate.rules import EvaluationState
+from predicate.rules import InternTable
+from predicate.rules import IntervalTree
+from predicate.rules import PredicateIndex
+from predicate.rules import PredicateSet
+from predicate.sqlite import SQLiteEngine
+from .benchmarks import BENCHMARKS
+from .benchmarks import format_results
+from .benchmarks import run_benchmarks
 from .models import CustomRelatedNameOneToOneModel
+from .models import FilteredManagerModel
 from .models import ForeignKeyModel
 from .models import M2MModel
 from .models import OneToOneModel
@@ -912,6 +972,28 @@ class TestPredicateQuerySet(TestCase):
         orm_pqs = OrmPredicateQuerySet(queryset)
         orm_pqs.count()
 
+    def test_compares_results_of_call(self):
+        queryset = TestObj.objects.all()
+        orm_pqs = OrmPredicateQuerySet(queryset)
+        with self.assertNumQueries(2):
+            filtered = orm_pqs.filter(int_value__lt=50)
+        filtered.pqs = PredicateQuerySet(TestObj.objects.none())
+        with self.assertRaises(AssertionError):
+            filtered.filter(int_value__lt=40)
+
+    def test_iter_applies_filters(self):
+        pqs = PredicateQuerySet(TestObj.objects.all()).filter(int_value__lt=50)
+        self.assertEqual(
+            sorted(obj.pk for obj in pqs),
+            sorted(TestObj.objects.filter(int_value__lt=50).values_list('pk', flat=True)))
+
+    def test_patched_filter_uses_one_query(self):
+        objs = list(TestObj.objects.all())
+        with patch_with_orm_eval():
+            with self.assertNumQueries(1):
+                filtered = P(int_value__lt=50).filter(objs)
+        self.assertEqual(filtered, [obj for obj in objs if obj.int_value < 50])
+
     def assertResultsEqual(self, queryset, predicatequeryset):
         queryset._fetch_all()
         predicatequeryset._evaluate()
@@ -958,3 +1040,1445 @@ class TestPredicateQuerySet(TestCase):
         for i in range(qs.count()):
             for j in range(i + 1, qs.count()):
                 self.assertEqual(list(qs[i:j]), list(pqs[i:j]))
+
+
+class CountingDict(dict):
+    """
+    dict that counts how many times each key is read.
+    """
+    def __init__(self, *args, **kwargs):
+        super(CountingDict, self).__init__(*args, **kwargs)
+        self.reads = {}
+
+    def __getitem__(self, key):
+        self.reads[key] = self.reads.get(key, 0) + 1
+        return super(CountingDict, self).__getitem__(key)
+
+
+class TestPredicateSet(TestCase):
+    def setUp(self):
+        make_test_objects()
+        for obj in TestObj.objects.all()[:20]:
+            obj.m2ms.create(int_value=obj.int_value % 7, char_value=choice(colors))
+            obj.m2ms.create(int_value=obj.int_value % 5, char_value=choice(colors))
+        self.predicates = [
+            P(int_value__gt=50),
+            P(int_value__gt=50) & P(char_value__contains='red'),
+            P(char_value__startswith='red') | P(int_value__lt=10),
+            ~P(int_value__gt=50),
+            P(parent__int_value__gte=30),
+            P(parent__parent__int_value__lt=30, int_value__in=[1, 2, 3, 40, 41]),
+            P(m2ms__int_value=3),
+            P(m2ms__int_value=3, m2ms__char_value='red'),
+            P(m2ms__int_value=3) | P(int_value=20),
+            ~(P(m2ms__int_value__in=[1, 2]) | P(parent__isnull=True)),
+            P(children__int_value__gt=90),
+            P(),
+        ]
+        self.predicates.extend(P(int_value=i) for i in range(100))
+
+    def test_matches_eval(self):
+        predicate_set = PredicateSet(self.predicates)
+        self.assertEqual(len(predicate_set), len(self.predicates))
+        for obj in TestObj.objects.all():
+            expected = [i for i, p in enumerate(self.predicates) if p.eval(obj)]
+            self.assertEqual(predicate_set.match(obj), expected)
+
+    def test_rule_ids(self):
+        predicate_set = PredicateSet({'big': P(int_value__gt=50), 'small': P(int_value__lte=50)})
+        self.assertEqual(predicate_set.match({'int_value': 60}), ['big'])
+        self.assertEqual(predicate_set.match({'int_value': 10}), ['small'])
+        predicate_set.add('big', P(int_value__gt=5))
+        self.assertEqual(predicate_set.match({'int_value': 10}), ['big', 'small'])
+        self.assertIn('small', predicate_set)
+        self.assertEqual(predicate_set['small'], P(int_value__lte=50))
+
+    def test_lookups_are_shared(self):
+        predicate_set = PredicateSet(
+            [P(status=status, team='a') for status in range(100)]
+            + [P(status__in=[1, 2]) | P(team='b')])
+        obj = CountingDict(status=2, team='a')
+        self.assertEqual(predicate_set.match(obj), [2, 100])
+        self.assertEqual(obj.reads, {'status': 1, 'team': 1})
+
+    def test_joint_lookups_or(self):
+        obj = {'a': [], 'b': 1}
+        predicates = [P(a=1) | P(b=1), P(a__in=[1]) | P(a__gt=0) | P(b=1)]
+        self.assertEqual(
+            PredicateSet(predicates).match(obj),
+            [i for i, p in enumerate(predicates) if p.eval(obj)])
+
+
+class TestPredicateIndex(TestCase):
+    def test_matches_eval(self):
+        make_test_objects()
+        parent = TestObj.objects.first()
+        predicates = {
+            'exact': P(int_value=5),
+            'in': P(int_value__in=[1, 2, 3]),
+            'gt': P(int_value__gt=90),
+            'range_and_color': P(int_value__range=(20, 40), char_value__contains='red'),
+            'or': P(int_value__lte=3) | P(parent__int_value__gte=95),
+            'negated': ~P(int_value__gt=10),
+            'parent': P(parent=parent),
+            'no_parent': P(parent=None),
+            'dates': P(date_value__gte=date.today() - timedelta(days=1)),
+            'datetimes': P(datetime_value__lt=datetime.now() + timedelta(days=1)),
+            'datetime_vs_date': P(date_value__gte=datetime.now() - timedelta(days=1)),
+        }
+        predicates.update(('int_%s' % i, P(int_value=i, char_value__icontains='blue'))
+                          for i in range(100))
+        index = PredicateIndex(predicates)
+        for obj in TestObj.objects.all():
+            expected = [rule_id for rule_id, p in predicates.items() if p.eval(obj)]
+            self.assertEqual(index.match(obj), expected)
+            self.assertLess(len(index.candidates(obj)), 16)
+
+    def test_add_and_remove(self):
+        index = PredicateIndex([P(x__gt=1), P(x__in=[1, 5])])
+        self.assertEqual(index.match({'x': 5}), [0, 1])
+        index.add(0, P(x__lt=1))
+        self.assertEqual(index.match({'x': 5}), [1])
+        self.assertEqual(index.match({'x': 0}), [0])
+        index.remove(1)
+        self.assertEqual(index.match({'x': 5}), [])
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.match({'y': 5}), [])
+
+    def test_empty_range_and_falsy_bounds(self):
+        index = PredicateIndex({'inverted': P(x__range=(5, 1)), 'empty': P(x__gte=''),
+                                'b': P(x__gte='b'), 'or': P(x__range=(5, 1)) | P(x=3)})
+        self.assertEqual(index.match({'x': 3}), ['or'])
+        self.assertEqual(index.match({'x': 'a'}), ['empty'])
+        self.assertEqual(index.candidates({'x': 'a'}), {'empty'})
+        self.assertEqual(index.match({'x': 'c'}), ['empty', 'b'])
+
+    def test_interval_tree(self):
+        rng = Random(0)
+        intervals = [(rng.randint(0, 99), rng.randint(0, 99)) for _ in range(200)]
+        intervals = [(min(lo, hi), max(lo, hi)) for lo, hi in intervals]
+        intervals += [(None, 10), (90, None), (None, 50), (None, 0), (0, None)]
+        tree = IntervalTree()
+        tree.add(60, 40, 'inverted')
+        for i, (lo, hi) in enumerate(intervals):
+            tree.add(lo, hi, i)
+        for point in range(-1, 102):
+            expected = {
+                i for i, (lo, hi) in enumerate(intervals)
+                if (lo is None or lo <= point) and (hi is None or point <= hi)}
+            self.assertEqual(set(tree.stab(point)), expected)
+
+
+class TestMaterializedPredicateView(TestCase):
+    def setUp(self):
+        self.obj1 = TestObj.objects.create(int_value=10)
+        self.obj2 = TestObj.objects.create(int_value=60)
+        self.view = MaterializedPredicateView(P(int_value__gt=50), TestObj.objects.all())
+        self.deltas = []
+        self.view.subscribe(self.deltas.append)
+
+    def tearDown(self):
+        self.view.disconnect()
+
+    def test_initial_matches(self):
+        self.assertEqual(list(self.view), [self.obj2])
+        self.assertIn(self.obj2, self.view)
+        self.assertNotIn(self.obj1, self.view)
+
+    def test_manual_changes(self):
+        self.obj1.int_value = 70
+        self.assertEqual(self.view.update(self.obj1), Delta([self.obj1], []))
+        self.assertEqual(len(self.view), 2)
+        self.assertEqual(self.view.update(self.obj1), Delta([], []))
+        self.assertEqual(self.view.delete(self.obj2), Delta([], [self.obj2]))
+        self.assertEqual(self.view.delete(self.obj2), Delta([], []))
+        self.assertEqual(self.deltas, [Delta([self.obj1], []), Delta([], [self.obj2])])
+
+    def test_batch_changes(self):
+        new = TestObj(int_value=100)
+        self.obj2.int_value = 0
+        delta = self.view.apply(saved=[new, self.obj2], deleted=[self.obj1])
+        self.assertEqual(delta, Delta([new], [self.obj2]))
+        self.assertEqual(list(self.view), [new])
+
+    def test_signals(self):
+        self.view.connect(TestObj)
+        created = TestObj.objects.create(int_value=99)
+        self.assertIn(created, self.view)
+        self.obj2.int_value = 1
+        self.obj2.save()
+        self.assertNotIn(self.obj2, self.view)
+        created.delete()
+        self.assertEqual(len(self.view), 0)
+        self.assertEqual(
+            self.deltas, [Delta([created], []), Delta([], [self.obj2]), Delta([], [created])])
+
+        self.view.disconnect()
+        TestObj.objects.create(int_value=99)
+        self.assertEqual(len(self.view), 0)
+
+    def test_update_fields_not_read(self):
+        self.view.connect(TestObj)
+        with mock.patch.object(self.view.predicate, 'eval') as patched:
+            self.obj2.char_value = 'foo'
+            self.obj2.save(update_fields=['char_value'])
+            self.assertFalse(patched.called)
+            self.assertIs(list(self.view)[0], self.obj2)
+            self.obj2.save(update_fields=['int_value'])
+            self.assertTrue(patched.called)
+
+
+class TestDependencies(TestCase):
+    def test_fields(self):
+        self.assertEqual(
+            P(int_value__gt=1, char_value='x', pk=1).dependencies(TestObj),
+            {(TestObj, 'int_value'), (TestObj, 'char_value'), (TestObj, 'id')})
+
+    def test_relations(self):
+        predicate = (
+            P(parent__parent__date_value__year=2020)
+            | ~P(m2ms__int_value__in=[1], onetoonemodel__isnull=True))
+        self.assertEqual(predicate.dependencies(TestObj), {
+            (TestObj, 'parent'),
+            (TestObj, 'date_value'),
+            (TestObj, 'm2ms'),
+            (M2MModel, 'int_value'),
+            (TestObj, 'onetoonemodel'),
+        })
+        self.assertEqual(
+            P(test_obj__children__int_value=1).dependencies(ForeignKeyModel),
+            {(ForeignKeyModel, 'test_obj'), (TestObj, 'children'), (TestObj, 'int_value')})
+
+    def test_non_field_attributes(self):
+        self.assertEqual(
+            P(some_property__x='y', parent__some_property__x='y').dependencies(TestObj),
+            {(TestObj, 'some_property'), (TestObj, 'parent')})
+
+
+class TestEvalCache(TestCase):
+    def setUp(self):
+        self.parent = TestObj.objects.create(int_value=5)
+        self.obj = TestObj.objects.create(int_value=10, parent=self.parent)
+        self.now = 0
+        self.cache = EvalCache(maxsize=2, ttl=10, timer=lambda: self.now)
+
+    def test_hits_and_misses(self):
+        predicate = P(int_value=10)
+        self.assertTrue(self.cache.eval(predicate, self.obj))
+        self.assertTrue(self.cache.eval(predicate, self.obj))
+        self.assertTrue(self.cache.eval(P(int_value=10), self.obj))
+        self.assertEqual(self.cache.cache_info(), CacheInfo(2, 1, 2, 1))
+
+    def test_field_changes_invalidate(self):
+        predicate = P(int_value=10, parent__int_value=5)
+        self.assertTrue(self.cache.eval(predicate, self.obj))
+        self.obj.int_value = 11
+        self.assertFalse(self.cache.eval(predicate, self.obj))
+        self.obj.int_value = 10
+        self.obj.parent = None
+        self.assertFalse(self.cache.eval(predicate, self.obj))
+        self.assertEqual(self.cache.cache_info().hits, 0)
+
+    def test_threads(self):
+        cache = EvalCache(maxsize=2)
+        predicates = [P(int_value=i) for i in range(8)]
+        errors = []
+
+        def evaluate():
+            try:
+                for _ in range(200):
+                    for predicate in predicates:
+                        cache.eval(predicate, self.obj)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=evaluate) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        info = cache.cache_info()
+        self.assertEqual(info.hits + info.misses, 4 * 200 * len(predicates))
+        self.assertLessEqual(info.currsize, 2)
+
+    def test_expression_changes_invalidate(self):
+        predicate = P(int_value__gt=F('parent__int_value'))
+        self.assertIn((TestObj, 'parent'), predicate.dependencies(TestObj))
+        self.assertTrue(self.cache.eval(predicate, self.obj))
+        self.obj.parent = TestObj.objects.create(int_value=20)
+        self.assertFalse(self.cache.eval(predicate, self.obj))
+        self.assertEqual(self.cache.cache_info().hits, 0)
+
+    def test_eviction(self):
+        predicates = [P(int_value=10), P(int_value=11), P(int_value=12)]
+        for predicate in predicates:
+            self.cache.eval(predicate, self.obj)
+        self.assertEqual(self.cache.cache_info().currsize, 2)
+        self.cache.eval(predicates[2], self.obj)
+        self.cache.eval(predicates[0], self.obj)
+        self.assertEqual(self.cache.cache_info(), CacheInfo(1, 4, 2, 2))
+
+        self.now = 10
+        self.cache.eval(predicates[0], self.obj)
+        self.assertEqual(self.cache.cache_info().hits, 1)
+        self.cache.clear()
+        self.assertEqual(self.cache.cache_info(), CacheInfo(0, 0, 2, 0))
+
+    def test_uncacheable(self):
+        self.cache.eval(P(some_property__x='y'), self.obj)
+        self.cache.eval(P(int_value=10), TestObj(int_value=10))
+        self.cache.eval(P(int_value=10), {'int_value': 10})
+        self.cache.eval(P(int_value=bytearray(b'10')), self.obj)
+        self.assertEqual(self.cache.cache_info(), CacheInfo(0, 4, 2, 0))
+
+    def test_patch_with_eval_cache(self):
+        predicate = P(int_value=10) | P(parent__int_value=5)
+        with patch_with_eval_cache(self.cache) as cache:
+            self.assertIn(self.obj, predicate)
+            with mock.patch('predicate.cache.original_eval') as patched:
+                self.assertIn(self.obj, predicate)
+                self.assertFalse(patched.called)
+        self.assertEqual(cache.cache_info().hits, 1)
+        self.assertEqual(cache.cache_info().currsize, 1)
+
+
+class TestBenchmarks(TestCase):
+    def test_benchmarks_run(self):
+        results = run_benchmarks(scale=0.01, repeat=1)
+        self.assertEqual(list(results), [func.__name__ for func in BENCHMARKS])
+        self.assertIn('flat_predicate', format_results(results, baseline=results))
+
+
+class TestProfiling(TestCase):
+    def test_profile_predicates(self):
+        parent = TestObj.objects.create(int_value=5)
+        objs = [TestObj.objects.create(int_value=i, parent=parent) for i in range(4)]
+        objs = list(TestObj.objects.filter(pk__in=[obj.pk for obj in objs]))
+        predicate = P(int_value__gt=1, parent__int_value=5) | ~P(char_value='x')
+        with profile_predicates() as profile:
+            results = [obj in predicate for obj in objs]
+        self.assertEqual(results, [predicate.eval(obj) for obj in objs])
+
+        stats = profile.as_dict()
+        self.assertEqual(stats['total']['calls'], 4)
+        self.assertEqual(stats['total']['true'], 4)
+        node = stats['nodes']['int_value__gt & parent__int_value']
+        self.assertEqual(node['calls'], 4)
+        self.assertEqual(node['true_ratio'], 0.5)
+        self.assertEqual(node['relation_hops'], 4)
+        self.assertEqual(node['queries'], 4)
+        self.assertEqual(stats['lookups']['int_value__gt']['calls'], 4)
+        self.assertEqual(stats['lookups']['int_value__gt']['true'], 2)
+        self.assertEqual(stats['lookups']['parent__int_value']['calls'], 4)
+        self.assertEqual(stats['evaluators']['GT']['calls'], 4)
+        # char_value='x' is only checked when the first node doesn't match.
+        self.assertEqual(stats['evaluators']['Exact']['calls'], 6)
+
+    def test_single_relation_hop(self):
+        parent = TestObj.objects.create(int_value=5)
+        obj = TestObj.objects.select_related('parent').get(
+            pk=TestObj.objects.create(parent=parent).pk)
+        with profile_predicates() as profile:
+            P(parent=parent).eval(obj)
+            P(parent__int_value=5).eval(obj)
+        self.assertEqual(profile.nodes['parent'].relation_hops, 1)
+        self.assertEqual(profile.nodes['parent__int_value'].relation_hops, 1)
+
+    def test_threads(self):
+        objs = [{'x': i} for i in range(200)]
+        predicate = P(x__gt=100)
+        with profile_predicates() as profile:
+            threads = [
+                threading.Thread(target=predicate.filter, args=(objs,)) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(profile.total.calls, 800)
+        self.assertEqual(profile.lookups['x__gt'].calls, 800)
+
+    def test_patches_removed(self):
+        original_eval = P.eval
+        original_node_eval = LookupNode.eval
+        with profile_predicates():
+            self.assertNotEqual(P.eval, original_eval)
+        self.assertEqual(P.eval, original_eval)
+        self.assertEqual(LookupNode.eval, original_node_eval)
+
+
+class TestExplain(TestCase):
+    def test_explain_model(self):
+        predicate = P(int_value__gt=1, parent__int_value=5) | P(
+            m2ms__int_value__in=[1, 2], m2ms__char_value='r', parent__char_value='x')
+        plan = predicate.explain(TestObj)
+        self.assertIn('OR: children evaluated in order, stopping at the first True', plan)
+        self.assertIn('int_value__gt=1 [GT]', plan)
+        self.assertIn('m2ms__int_value__in=[1, 2] [In]', plan)
+        self.assertIn('parent: foreign key to TestObj (traversed), fan-out: 1 value', plan)
+        self.assertIn('m2ms: many-to-many relation to M2MModel (traversed), '
+                      'fan-out: many values', plan)
+        self.assertIn('rows: cartesian join of m2ms x parent, multi-valued through m2ms', plan)
+        self.assertIn('PredicateSet/PredicateIndex: interval tree', plan)
+        self.assertIn('PredicateSet/PredicateIndex: hash lookup of values', plan)
+
+    def test_explain_instance(self):
+        obj = TestObj.objects.create(int_value=1)
+        obj.m2ms.add(*[M2MModel.objects.create(int_value=i) for i in range(3)])
+        plan = (~P(m2ms__int_value__range=(0, 1))).explain(obj)
+        self.assertIn('NOT AND', plan)
+        self.assertIn('m2ms: many-to-many relation to M2MModel (traversed), '
+                      'fan-out: 3 value(s)', plan)
+        self.assertIn('rows: one per related value of m2ms, 3 observed', plan)
+
+    def test_explain_without_model(self):
+        plan = P(a__b__regex='x').explain()
+        self.assertIn('a: attribute or key, fan-out: unknown', plan)
+        self.assertIn('PredicateSet/PredicateIndex: none, always evaluated', plan)
+        self.assertIn('rows: unknown, one per value of a if multi-valued', plan)
+
+    def test_explain_dict_with_list(self):
+        plan = P(a=1).explain({'a': [1, 2]})
+        self.assertIn('a: attribute or key, fan-out: 2 value(s)', plan)
+        self.assertIn('rows: unknown, one per value of a if multi-valued, 2 observed', plan)
+        self.assertNotIn('rows: 1', plan)
+
+    def test_explain_expression(self):
+        plan = P(int_value__gt=F('m2ms__int_value')).explain(TestObj)
+        self.assertIn("F('m2ms__int_value'):", plan)
+        self.assertIn('m2ms: many-to-many relation to M2MModel (traversed), '
+                      'fan-out: many values', plan)
+        self.assertIn('rows: cartesian join of int_value x m2ms, multi-valued through m2ms', plan)
+
+
+class InlineExecutor(object):
+    def submit(self, func, *args):
+        future = Future()
+        future.set_result(func(*args))
+        return future
+
+
+class TestSamplingValidator(TestCase):
+    def setUp(self):
+        self.objs = [TestObj.objects.create(int_value=i) for i in range(5)]
+        self.mismatches = []
+
+    def validator(self, **kwargs):
+        kwargs.setdefault('executor', InlineExecutor())
+        return SamplingValidator(on_mismatch=self.mismatches.append, **kwargs)
+
+    def test_batches_one_query_per_predicate(self):
+        validator = self.validator(rate=1, batch_size=3)
+        predicate = P(int_value__gte=2)
+        with self.assertNumQueries(1):
+            results = [validator.eval(predicate, obj) for obj in self.objs[:3]]
+        self.assertEqual(results, [False, False, True])
+        with self.assertNumQueries(0):
+            validator.eval(predicate, self.objs[3])
+        with self.assertNumQueries(1):
+            self.assertEqual(len(validator.flush()), 1)
+        self.assertEqual(self.mismatches, [])
+
+    def test_reports_mismatches(self):
+        validator = self.validator(rate=1)
+        predicate = P(int_value=1)
+        obj = self.objs[1]
+        obj.int_value = 10
+        self.assertFalse(validator.eval(predicate, obj))
+        validator.flush()
+        self.assertEqual(self.mismatches, [Mismatch(predicate, TestObj, obj.pk, False, True)])
+
+    def test_sampling_rate(self):
+        samples = iter([0.5, 0.05, 0.2, 0.01, 0.9])
+        validator = self.validator(rate=0.1, rand=lambda: next(samples))
+        predicate = P(int_value=0)
+        for obj in self.objs:
+            validator.eval(predicate, obj)
+        (_, _, results), = validator._batches.values()
+        self.assertEqual(sorted(results), [self.objs[1].pk, self.objs[3].pk])
+
+    def test_skips_unsaved_instances(self):
+        validator = self.validator(rate=1)
+        validator.eval(P(int_value=0), TestObj(int_value=0))
+        self.assertEqual(validator.flush(), [])
+
+    def test_patch_with_sampling_validator(self):
+        validator = self.validator(rate=1)
+        predicate = P(int_value=1) | P(int_value=2)
+        with patch_with_sampling_validator(validator):
+            matches = [obj for obj in self.objs if obj in predicate]
+        self.assertEqual(matches, self.objs[1:3])
+        self.assertEqual(validator._batches, {})
+        self.assertEqual(P.eval, original_eval)
+
+
+class TestSamplingValidatorThreads(TransactionTestCase):
+    # Worker threads can't read the data of a TestCase's open transaction.
+    def test_closes_worker_connections(self):
+        obj = TestObj.objects.create(int_value=0)
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        mismatches = []
+        validator = SamplingValidator(rate=1, executor=executor, on_mismatch=mismatches.append)
+        self.assertTrue(validator.eval(P(int_value=0), obj))
+        with mock.patch('predicate.debug.close_old_connections') as patched:
+            for future in validator.flush():
+                future.result()
+        self.assertEqual(mismatches, [])
+        patched.assert_called_once_with()
+
+    def test_keeps_connection_in_transaction(self):
+        obj = TestObj.objects.create(int_value=0)
+        validator = SamplingValidator(rate=1, executor=InlineExecutor())
+        with mock.patch('predicate.debug.close_old_connections') as patched:
+            with transaction.atomic():
+                validator.eval(P(int_value=0), obj)
+                validator.flush()
+        self.assertFalse(patched.called)
+
+
+class TestValuesList(TestCase):
+    def setUp(self):
+        self.parent = TestObj.objects.create(int_value=1, char_value='parent')
+        self.objs = [
+            TestObj.objects.create(int_value=i, char_value=str(i), parent=self.parent)
+            for i in range(2, 5)]
+        self.objs[0].m2ms.add(*[M2MModel.objects.create(int_value=i) for i in range(2)])
+        self.queryset = TestObj.objects.filter(parent=self.parent).order_by('pk')
+
+    def test_matches_queryset(self):
+        lookups = ('int_value', 'parent__char_value', 'pk')
+        self.assertEqual(list(values_list(self.objs, *lookups)),
+                         list(self.queryset.values_list(*lookups)))
+
+    def test_matches_get_values_list(self):
+        lookups = ('int_value', 'm2ms__int_value')
+        self.assertEqual(
+            list(values_list(self.objs, *lookups)),
+            [row for obj in self.objs for row in get_values_list(obj, *lookups)])
+
+    def test_generator(self):
+        rows = values_list(iter(self.objs), 'int_value', flat=True)
+        self.assertEqual(next(rows), 2)
+        self.assertEqual(list(rows), [3, 4])
+
+    def test_named(self):
+        row, = values_list(self.objs[1:2], 'int_value', 'parent__int_value', named=True)
+        self.assertEqual(row.int_value, 3)
+        self.assertEqual(row.parent__int_value, 1)
+
+    def test_columnar(self):
+        self.assertEqual(
+            values_list(self.objs[1:], 'int_value', 'char_value', columnar=True),
+            {'int_value': [3, 4], 'char_value': ['3', '4']})
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(TypeError):
+            values_list(self.objs, 'int_value', 'char_value', flat=True)
+        with self.assertRaises(TypeError):
+            values_list(self.objs, 'int_value', flat=True, named=True)
+        with self.assertRaises(TypeError):
+            values_list(self.objs, 'int_value', foo=True)
+
+    def test_predicate_queryset(self):
+        pqs = PredicateQuerySet(self.queryset).filter(int_value__gt=2)
+        self.assertEqual(pqs.values_list('int_value', flat=True), [3, 4])
+        self.assertEqual(list(pqs.values('int_value', 'parent__int_value')),
+                         list(self.queryset.filter(int_value__gt=2).values(
+                             'int_value', 'parent__int_value')))
+        self.assertEqual(list(pqs.values()),
+                         list(self.queryset.filter(int_value__gt=2).values()))
+
+    def test_values_of_plain_objects(self):
+        pqs = PredicateQuerySet([{'a': 1, 'b': 2}, {'b': 3, 'a': 4}])
+        self.assertEqual(list(pqs.values()), [{'a': 1, 'b': 2}, {'a': 4, 'b': 3}])
+        self.assertEqual(list(pqs.filter(a__gt=1).values()), [{'a': 4, 'b': 3}])
+        self.assertEqual(list(PredicateQuerySet([]).values()), [])
+        with self.assertRaisesRegex(TypeError, 'values\\(\\) needs lookups for AttrClass'):
+            list(PredicateQuerySet([AttrClass()]).values())
+
+
+class TestAggregation(TestCase):
+    def setUp(self):
+        for i in range(6):
+            TestObj.objects.create(int_value=i, char_value='even' if i % 2 == 0 else 'odd')
+        TestObj.objects.create(int_value=6, char_value='odd')
+        self.queryset = TestObj.objects.order_by('pk')
+        self.pqs = PredicateQuerySet(self.queryset)
+
+    def test_aggregate(self):
+        aggregates = dict(
+            total=Sum('int_value'), low=Min('int_value'), high=Max('int_value'),
+            mean=Avg('int_value'), n=Count('int_value'), rows=Count('*'),
+            kinds=Count('char_value', distinct=True))
+        self.assertEqual(self.pqs.aggregate(**aggregates), self.queryset.aggregate(**aggregates))
+        self.assertEqual(
+            self.pqs.filter(int_value__gt=3).aggregate(Sum('int_value')),
+            {'int_value__sum': 15})
+
+    def test_aggregate_empty(self):
+        self.assertEqual(
+            self.pqs.filter(int_value__gt=10).aggregate(Sum('int_value'), Count('int_value')),
+            {'int_value__sum': None, 'int_value__count': 0})
+
+    def test_aggregate_ignores_none(self):
+        pqs = PredicateQuerySet([{'x': 1}, {'x': None}, {'x': 4}])
+        self.assertEqual(pqs.aggregate(Sum('x'), Count('x'), Avg('x')),
+                         {'x__sum': 5, 'x__count': 2, 'x__avg': 2.5})
+
+    def test_aggregate_unsupported(self):
+        with self.assertRaises(NotImplementedError):
+            self.pqs.aggregate(total=Sum('int_value', filter=Q(int_value__gt=1)))
+
+    def test_values_annotate(self):
+        pqs = self.pqs.values('char_value').annotate(total=Sum('int_value'), n=Count('*'))
+        self.assertEqual(list(pqs), [
+            {'char_value': 'even', 'total': 6, 'n': 3},
+            {'char_value': 'odd', 'total': 15, 'n': 4},
+        ])
+        self.assertEqual(list(pqs.filter(n__gt=3).values_list('char_value', flat=True)), ['odd'])
+
+    def test_values_annotate_single_pass(self):
+        objs = list(self.queryset)
+        pqs = PredicateQuerySet(objs).values('char_value').annotate(total=Sum('int_value'))
+        with mock.patch('predicate.aggregates.lookup_rows', wraps=lookup_rows) as patched:
+            self.assertEqual(pqs.count(), 2)
+        self.assertEqual(patched.call_count, len(objs))
+
+    def test_outer_joins(self):
+        objs = list(self.queryset)
+        M2MModel.objects.create(int_value=10).test_objs.add(objs[0], objs[1])
+        M2MModel.objects.create(int_value=20).test_objs.add(objs[1])
+        pqs = PredicateQuerySet(self.queryset.filter(int_value__lt=3))
+        queryset = self.queryset.filter(int_value__lt=3)
+        aggregates = dict(c=Count('*'), n=Count('m2ms'), s=Sum('m2ms__int_value'),
+                          low=Min('m2ms__int_value'))
+        self.assertEqual(pqs.aggregate(**aggregates), queryset.aggregate(**aggregates))
+        self.assertEqual(
+            list(pqs.values('char_value', 'int_value').annotate(**aggregates)),
+            list(queryset.values('char_value', 'int_value').annotate(**aggregates)
+                 .order_by('int_value')))
+
+    def test_unsupported_aggregate(self):
+        with self.assertRaisesRegex(NotImplementedError, 'StdDev'):
+            self.pqs.aggregate(StdDev('int_value'))
+
+    def test_avg_decimal(self):
+        pqs = PredicateQuerySet([{'x': Decimal('1.5')}, {'x': Decimal('2')}])
+        self.assertEqual(pqs.aggregate(Avg('x')), {'x__avg': Decimal('1.75')})
+
+    def test_distinct(self):
+        objs = list(self.queryset)
+        pqs = PredicateQuerySet(objs + objs[:2] + [TestObj.objects.get(pk=objs[0].pk)])
+        self.assertEqual(list(pqs.distinct()), objs)
+        self.assertEqual(
+            list(self.pqs.values('char_value').distinct()),
+            [{'char_value': 'even'}, {'char_value': 'odd'}])
+
+
+class TestOrderBy(TestCase):
+    def setUp(self):
+        parent = TestObj.objects.create(int_value=50, char_value='parent')
+        for i, value in enumerate([3, 1, 4, 1, 5, 9, 2, 6]):
+            TestObj.objects.create(
+                int_value=value, char_value='abcd'[i % 4], parent=parent if i % 2 else None)
+        self.queryset = TestObj.objects.exclude(char_value='parent')
+        self.pqs = PredicateQuerySet(list(self.queryset.order_by('pk')))
+
+    def assertOrderEqual(self, *ordering):
+        self.assertEqual(
+            [obj.pk for obj in self.pqs.order_by(*ordering)],
+            list(self.queryset.order_by(*ordering).values_list('pk', flat=True)))
+
+    def test_order_by(self):
+        self.assertOrderEqual('int_value', 'pk')
+        self.assertOrderEqual('-int_value', 'pk')
+        self.assertOrderEqual('char_value', '-int_value', '-pk')
+
+    def test_related_lookup_nulls_first(self):
+        # None sorts first in ascending order as on SQLite, whatever the
+        # database, so this isn't compared with the ORM.
+        objs = self.pqs.order_by('pk')
+        orphans = [obj.pk for obj in objs if obj.parent_id is None]
+        children = [obj.pk for obj in objs if obj.parent_id is not None]
+        self.assertEqual(
+            [obj.pk for obj in self.pqs.order_by('parent__int_value', 'pk')], orphans + children)
+        self.assertEqual(
+            [obj.pk for obj in self.pqs.order_by('-parent__int_value', 'pk')], children + orphans)
+
+    def test_top_k(self):
+        ordered = self.pqs.filter(int_value__gt=1).order_by('-int_value')
+        with mock.patch('predicate.predicate.heapq.nsmallest', wraps=heapq.nsmallest) as patched:
+            top = ordered[:3]
+        patched.assert_called_once()
+        self.assertEqual(patched.call_args[0][0], 3)
+        self.assertEqual([obj.int_value for obj in top], [9, 6, 5])
+        self.assertEqual(ordered[1].int_value, 6)
+        self.assertEqual([obj.int_value for obj in ordered[1:3]], [6, 5])
+        self.assertFalse(ordered._evaluated)
+        self.assertEqual([obj.int_value for obj in ordered[-2:]], [3, 2])
+
+    def test_values_order_by(self):
+        pqs = self.pqs.values('char_value').annotate(total=Sum('int_value')).order_by('-total')
+        self.assertEqual(list(pqs.values_list('char_value', flat=True)), ['b', 'a', 'd', 'c'])
+
+
+class TestCombine(TestCase):
+    def setUp(self):
+        for i in range(10):
+            TestObj.objects.create(int_value=i)
+        self.queryset = TestObj.objects.order_by('pk')
+        self.pqs = PredicateQuerySet(self.queryset)
+
+    def int_values(self, pqs):
+        return [obj.int_value for obj in pqs]
+
+    def test_shared_source_single_pass(self):
+        low = self.pqs.filter(int_value__lt=6)
+        high = self.pqs.filter(int_value__gte=3)
+        with mock.patch.object(P, 'filter', autospec=True, side_effect=P.filter) as patched:
+            self.assertEqual(self.int_values(low & high), [3, 4, 5])
+            self.assertEqual(self.int_values(low | high), list(range(10)))
+            self.assertEqual(self.int_values(low - high), [0, 1, 2])
+        self.assertEqual(patched.call_count, 3)
+
+    def test_shared_source_unfiltered(self):
+        low = self.pqs.filter(int_value__lt=3)
+        self.assertEqual(self.int_values(self.pqs | low), list(range(10)))
+        self.assertEqual(self.int_values(low | self.pqs), list(range(10)))
+        self.assertEqual(self.int_values(low - self.pqs), [])
+        self.assertEqual(self.int_values(self.pqs - low), list(range(3, 10)))
+        self.assertEqual(self.int_values(self.pqs & low), [0, 1, 2])
+
+    def test_source_fetched_once(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.pqs.count(), 10)
+            self.assertEqual(self.pqs.filter(int_value__lt=5).count(), 5)
+            self.assertEqual(self.pqs.exclude(int_value__lt=5).count(), 5)
+
+    def test_different_sources(self):
+        low = PredicateQuerySet(self.queryset.filter(int_value__lt=6))
+        high = PredicateQuerySet(list(self.queryset.filter(int_value__gte=3)))
+        self.assertEqual(self.int_values(low & high), [3, 4, 5])
+        self.assertEqual(self.int_values(high | low), [3, 4, 5, 6, 7, 8, 9, 0, 1, 2])
+        self.assertEqual(self.int_values(low - high), [0, 1, 2])
+        self.assertEqual(self.int_values(high - low), [6, 7, 8, 9])
+
+    def test_or_removes_duplicates(self):
+        objs = list(self.queryset[:3])
+        copies = list(self.queryset[1:4])
+        self.assertEqual(
+            self.int_values(PredicateQuerySet(objs + objs[:1]) | PredicateQuerySet(copies)),
+            [0, 1, 2, 3])
+
+
+IMPORT_SCRIPT = '''
+import json
+import sys
+
+import predicate
+import predicate.lookup_utils
+lazy_modules = [name for name in ('django.db.models', 'predicate.predicate') if name in sys.modules]
+from predicate import P
+print(json.dumps({'lazy_modules': lazy_modules, 'orm_loaded': 'django.db.models' in sys.modules,
+                  'in': P(a__in=[1, 2]).eval({'a': 1})}))
+'''
+
+
+class TestLazyImport(TestCase):
+    def run_script(self, script, *options):
+        return subprocess.run(
+            [sys.executable] + list(options) + ['-c', script],
+            cwd=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+
+    def import_times(self, script):
+        """
+        Returns a dict mapping the modules that script imports to their
+        cumulative import times in microseconds, from ``-X importtime``.
+        """
+        times = {}
+        for line in self.run_script(script, '-X', 'importtime').stderr.decode().splitlines():
+            _, cumulative, module = line.split('|')
+            if cumulative.strip().isdigit():
+                times[module.strip()] = int(cumulative)
+        return times
+
+    def test_import_without_orm(self):
+        result = json.loads(self.run_script(IMPORT_SCRIPT).stdout.decode())
+        self.assertEqual(result['lazy_modules'], [])
+        self.assertTrue(result['orm_loaded'])
+        self.assertTrue(result['in'])
+
+    @skipUnless(sys.version_info >= (3, 7), '-X importtime requires Python 3.7')
+    def test_import_time(self):
+        # Which modules are imported is checked rather than how long that
+        # takes, which varies with the load of the machine.
+        lazy = self.import_times('import predicate, predicate.lookup_utils')
+        self.assertIn('predicate.lookup_utils', lazy)
+        self.assertEqual([module for module in lazy if module.startswith('django')], [], lazy)
+        full = self.import_times('from predicate import P')
+        self.assertIn('django.db.models', full)
+        self.assertIn('predicate.predicate', full)
+
+
+class TestSplit(TestCase):
+    def setUp(self):
+        make_test_objects()
+
+    def test_split(self):
+        predicate = P(int_value__gt=10, parent__int_value__lt=50, some_property__x='y',
+                      m2ms__int_value=1, m2ms__unknown=2)
+        q, residual = predicate.split(TestObj)
+        self.assertIs(type(q), Q)
+        self.assertEqual(sorted(q.children),
+                         [('int_value__gt', 10), ('parent__int_value__lt', 50)])
+        self.assertEqual(sorted(residual.children), [
+            ('m2ms__int_value', 1), ('m2ms__unknown', 2), ('some_property__x', 'y')])
+
+    def test_split_whole(self):
+        predicate = P(int_value=1) | ~P(date_value__year__gt=2000, char_value__icontains='a')
+        q, residual = predicate.split(TestObj)
+        self.assertEqual(residual.children, [])
+        self.assertEqual(
+            list(TestObj.objects.filter(q)), list(TestObj.objects.filter(predicate)))
+
+    def test_split_or_with_residual(self):
+        predicate = P(int_value__lt=50) & (P(int_value=1) | P(some_property__x='z'))
+        q, residual = predicate.split(TestObj)
+        self.assertEqual(q.children, [('int_value__lt', 50)])
+        self.assertEqual(residual.connector, P.AND)
+        self.assertEqual(len(residual.children), 1)
+
+    def test_filter_queryset(self):
+        predicate = P(int_value__lt=50, some_property__x='y') & ~P(char_value__contains='red')
+        with self.assertNumQueries(1):
+            pqs = predicate.filter_queryset(TestObj.objects.order_by('pk'))
+            results = list(pqs)
+        self.assertEqual(results, predicate.filter(TestObj.objects.order_by('pk')))
+        self.assertEqual(results, list(TestObj.objects.filter(
+            int_value__lt=50).exclude(char_value__contains='red').order_by('pk')))
+        self.assertEqual(
+            list(P(some_property__x='z').filter_queryset(TestObj.objects.all())), [])
+
+
+class TestBatchEvaluation(TestCase):
+    def setUp(self):
+        make_test_objects()
+        self.objs = list(TestObj.objects.order_by('pk'))
+        self.predicate = P(int_value__lt=50, m2ms__int_value__gt=5)
+
+    def test_eval_db_many(self):
+        with self.assertNumQueries(1):
+            results = self.predicate.eval_db_many(self.objs)
+        self.assertEqual(
+            results, {(TestObj, obj.pk): self.predicate.eval(obj) for obj in self.objs})
+
+    def test_eval_db_many_models(self):
+        other = M2MModel.objects.create(pk=self.objs[0].pk, int_value=60)
+        predicate = P(int_value__gt=50)
+        with self.assertNumQueries(2):
+            results = predicate.eval_db_many([self.objs[0], other])
+        self.assertEqual(results, {
+            (TestObj, self.objs[0].pk): predicate.eval(self.objs[0]), (M2MModel, other.pk): True})
+
+    def test_eval_db_many_chunks(self):
+        with self.assertNumQueries(-(-len(self.objs) // 3)):
+            results = self.predicate.eval_db_many(self.objs, chunk_size=3)
+        self.assertEqual(len(results), len(self.objs))
+
+    def test_eval_db_many_unsaved(self):
+        with self.assertRaises(ValueError):
+            self.predicate.eval_db_many([TestObj()])
+
+    def test_eval_many_uses_database_for_fan_out(self):
+        expected = [self.predicate.eval(obj) for obj in self.objs]
+        with self.assertNumQueries(1):
+            self.assertEqual(self.predicate.eval_many(self.objs), expected)
+
+    def test_eval_many_uses_memory_when_loaded(self):
+        objs = list(TestObj.objects.prefetch_related('m2ms'))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.predicate.eval_many(objs),
+                             [self.predicate.eval(obj) for obj in objs])
+        with self.assertNumQueries(0):
+            P(int_value__lt=50).eval_many(self.objs)
+
+    def test_eval_db_many_base_manager(self):
+        obj = FilteredManagerModel.objects.create(int_value=0)
+        self.assertEqual(
+            P(int_value=0).eval_db_many([obj]), {(FilteredManagerModel, obj.pk): True})
+
+    def test_eval_many_consistent_semantics(self):
+        # __range excludes its upper bound in memory but not in SQL.
+        obj = TestObj.objects.create(int_value=50)
+        obj.m2ms.add(M2MModel.objects.create(int_value=10))
+        objs = list(TestObj.objects.order_by('pk'))
+        predicate = P(int_value__range=(0, 50), m2ms__int_value__gt=5)
+        self.assertFalse(predicate.eval_many(objs)[-1])
+        self.assertEqual(predicate.eval_many(objs), [predicate.eval(obj) for obj in objs])
+        predicate = P(int_value__lt=50, m2ms__int_value__gt=F('int_value'))
+        self.assertEqual(predicate.eval_many(objs), [predicate.eval(obj) for obj in objs])
+
+    def test_eval_many_residual_in_memory(self):
+        objs = self.objs + [TestObj(int_value=1)]
+        predicate = P(some_property__x='y', int_value__lt=50)
+        self.assertEqual(predicate.eval_many(objs), [predicate.eval(obj) for obj in objs])
+
+
+class TestSQLiteEngine(TestCase):
+    def setUp(self):
+        rng = Random(0)
+        self.objects = [{
+            'number': rng.choice([None, 1, 2, 3.5, 5]),
+            'text': rng.choice([None, 'red', 'blue', 'Red green']),
+            'date': date(2020, 1, rng.randint(1, 20)),
+            'mixed': rng.choice([None, 1, '1']),
+            'things': [{'x': rng.randint(0, 5), 'y': rng.choice('ab')}
+                       for _ in range(rng.randint(0, 3))],
+        } for _ in range(200)]
+        self.engine = SQLiteEngine(self.objects)
+
+    def test_matches_in_memory(self):
+        predicates = [
+            P(number__gt=1), ~P(number__gte=2), P(number=None), P(number__in=[1, None]),
+            P(number__range=(1, 4)), P(number__in=range(3)), P(text__contains='e'),
+            P(text__startswith='re'), P(text__icontains='RED'), P(text__regex='^b'),
+            P(date__gte=date(2020, 1, 10)), P(mixed=1), P(mixed='1'), P(mixed__isnull=True),
+            P(things__x=3, things__y='a'), ~P(things__x=3, things__y='a'),
+            P(things__x__gt=3) | P(number__lt=2), P(number=1) | P(things__x=1),
+            P(text__iexact='red', number__lte=3), ~(P(number=1) & P(text=None)), P(),
+        ]
+        for predicate in predicates:
+            self.assertEqual(self.engine.filter(predicate), predicate.filter(self.objects),
+                             predicate)
+
+    def test_missing_lookups(self):
+        objects = [{'x': 1, 'q': 1}]
+        engine = SQLiteEngine(objects)
+        predicate = (P(x=1) & P(q=1)) | P(y=1, w=1)
+        self.assertEqual(engine.filter(predicate), objects)
+        with self.assertRaises(LookupNotFound):
+            engine.filter(P(y=1) | P(x=1))
+
+    def test_reuses_tables(self):
+        self.engine.filter(P(number__gt=1, text='red'))
+        with mock.patch('predicate.sqlite.lookup_rows') as patched:
+            self.assertEqual(self.engine.count(P(number__lt=3, text__contains='e')),
+                             len(P(number__lt=3, text__contains='e').filter(self.objects)))
+        self.assertFalse(patched.called)
+        self.assertEqual(len(self.engine._tables), 1)
+        self.engine.filter(P(number__gt=1) & (P(text='red') | P(text='blue')))
+        self.assertEqual(len(self.engine._tables), 3)
+
+    def test_model_instances(self):
+        make_test_objects()
+        objs = list(TestObj.objects.select_related('parent').order_by('pk'))
+        engine = SQLiteEngine(objs)
+        predicate = P(int_value__lt=50, parent__int_value__gt=20) | P(parent=objs[0])
+        self.assertEqual(engine.filter(predicate), predicate.filter(objs))
+
+    def test_offload(self):
+        pqs = PredicateQuerySet(self.objects).offload()
+        filtered = pqs.filter(number__gt=1).exclude(text='red')
+        self.assertEqual(list(filtered),
+                         (P(number__gt=1) & ~P(text='red')).filter(self.objects))
+        self.assertIs(filtered._engine, pqs._engine)
+
+
+@skipUnless(pandas and pyarrow, 'pandas and pyarrow are not installed')
+class TestFrames(TestCase):
+    def setUp(self):
+        self.rows = [{
+            'int_value': i,
+            'char_value': None if i % 4 == 0 else 'Abc%d' % i,
+            'parent__int_value': None if i % 3 == 0 else i * 2,
+            'date': datetime(2020, 1, 1 + i),
+        } for i in range(12)]
+        self.objects = [
+            dict(row, parent={'int_value': row['parent__int_value']}) for row in self.rows]
+        self.predicates = [
+            P(int_value__gt=5), ~P(parent__int_value__gt=10), P(parent__int_value=None),
+            P(char_value__icontains='abc1') | P(int_value__in=[1, 2, None]),
+            ~P(char_value__isnull=True), P(int_value__range=(2, 7)),
+            P(char_value__startswith='Abc'), ~P(char_value__endswith='1'),
+            P(char_value__iexact='abc5'), ~(P(int_value__lt=3) & P(char_value__regex=r'\d$')),
+            P(date__week_day=3), P(date__day=4), P(date__gte=date(2020, 1, 5)), P(),
+        ]
+
+    def expected(self, predicate):
+        return [obj['int_value'] for obj in predicate.filter(self.objects)]
+
+    def test_dataframe(self):
+        frame = pandas.DataFrame(self.rows)
+        for predicate in self.predicates:
+            self.assertEqual(list(predicate.filter_frame(frame).int_value),
+                             self.expected(predicate), predicate)
+
+    def test_arrow_table(self):
+        table = pyarrow.Table.from_pylist(self.rows)
+        for predicate in self.predicates:
+            self.assertEqual(predicate.filter_frame(table).column('int_value').to_pylist(),
+                             self.expected(predicate), predicate)
+            self.assertEqual(predicate.to_mask(table).to_pylist(),
+                             [predicate.eval(obj) for obj in self.objects], predicate)
+
+    def test_python_fallback(self):
+        frame = pandas.DataFrame({'tags': [['a'], ['b', 'c'], None]})
+        self.assertEqual(list(P(tags__contains='c').to_mask(frame)), [False, True, False])
+
+    def test_column_mapping(self):
+        frame = pandas.DataFrame(self.rows).rename(columns={'parent__int_value': 'parent_id'})
+        predicate = P(parent__int_value__gt=10)
+        self.assertEqual(
+            list(predicate.filter_frame(frame, columns={'parent__int_value': 'parent_id'})
+                 .int_value),
+            self.expected(predicate))
+        with self.assertRaises(LookupNotFound):
+            predicate.to_mask(frame)
+
+    def test_dataset(self):
+        table = pyarrow.Table.from_pylist(self.rows)
+        predicate = P(int_value__gt=5) & ~P(char_value=None)
+        with tempfile.TemporaryDirectory() as directory:
+            pyarrow.parquet.write_table(
+                table, os.path.join(directory, 'rows.parquet'), row_group_size=4)
+            batches = list(filter_dataset(predicate, directory))
+        self.assertGreater(len(batches), 1)
+        self.assertEqual(
+            [value for batch in batches for value in batch.column('int_value').to_pylist()],
+            self.expected(predicate))
+
+
+FINGERPRINT_SCRIPT = '''
+from predicate import P
+print(P(a__in={'x', 'y', 'z'}, b={'c': 1, 'd': [2, 3]}).fingerprint())
+'''
+
+
+class TestFingerprint(TestCase):
+    def test_equivalent(self):
+        pairs = [
+            (P(a=1, b=2), P(b=2) & P(a=1)),
+            (P(a=1) | (P(b=2) | P(c=3)), P(c=3) | P(b=2) | P(a=1)),
+            (P(a=1) & (P(b=2) | ~P(c=3)), (~P(c=3) | P(b=2)) & P(a=1)),
+            (P(a__exact=1), P(a=1)),
+            (P(a__in=[1, 2]), P(a__in=(2, 1, 1))),
+            (P(a={'x': 1, 'y': 2}), P(a={'y': 2, 'x': 1})),
+            (P(a=1) & P(a=1), P(a=1)),
+            (P(P(P(b=2)), a=1), P(P(b=2), a=1)),
+        ]
+        for first, second in pairs:
+            self.assertEqual(first.fingerprint(), second.fingerprint(), (first, second))
+
+    def test_distinct(self):
+        predicates = [
+            P(a=1), P(a=True), P(a='1'), P(a=1.0), ~P(a=1), P(a__gt=1), P(b=1),
+            P(a=1, b=2), P(a=1) | P(b=2), ~P(a=1, b=2), P(a=[1, 2]), P(a=[2, 1]), P(),
+            P(m2ms__x=1, m2ms__y=2), P(P(m2ms__x=1), P(m2ms__y=2)),
+        ]
+        fingerprints = {predicate.fingerprint() for predicate in predicates}
+        self.assertEqual(len(fingerprints), len(predicates))
+
+    def test_model_instances(self):
+        obj = TestObj.objects.create(int_value=1)
+        self.assertEqual(P(parent=obj).fingerprint(),
+                         P(parent=TestObj.objects.get(pk=obj.pk)).fingerprint())
+        self.assertEqual(P(parent__in=[obj]).fingerprint(), P(parent__in=[obj.pk]).fingerprint())
+        with self.assertRaises(TypeError):
+            P(parent=TestObj(int_value=2)).fingerprint()
+        with self.assertRaises(TypeError):
+            P(a=object()).fingerprint()
+
+    def test_stable_across_processes(self):
+        cwd = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        fingerprints = {
+            subprocess.check_output(
+                [sys.executable, '-c', FINGERPRINT_SCRIPT], cwd=cwd,
+                env=dict(os.environ, PYTHONHASHSEED=seed)).decode().strip()
+            for seed in ('1', '2')}
+        self.assertEqual(fingerprints, {
+            P(a__in=['z', 'y', 'x'], b={'d': [2, 3], 'c': 1}).fingerprint()})
+
+    def test_eval_cache_shares_equivalent_predicates(self):
+        obj = TestObj.objects.create(int_value=10, char_value='x')
+        cache = EvalCache()
+        self.assertTrue(cache.eval(P(int_value=10, char_value='x'), obj))
+        self.assertTrue(cache.eval(P(char_value='x') & P(int_value__exact=10), obj))
+        self.assertEqual(cache.cache_info().hits, 1)
+
+    def test_intern_table(self):
+        table = InternTable()
+        first = P(int_value__gt=5, char_value='x')
+        self.assertIs(table.intern(first), first)
+        self.assertIs(table.intern(P(char_value='x') & P(int_value__gt=5)), first)
+        self.assertEqual(len(table), 1)
+        self.assertIn(P(char_value='x', int_value__gt=5), table)
+
+        shared = P(int_value__lt=3) | P(char_value='y')
+        rules = [table.intern(rule) for rule in [
+            first | ~shared, P(char_value='y') | P(int_value__lt=3), shared & P(int_value=1)]]
+        self.assertEqual(len(table), 4)
+        for obj in [{'int_value': 1, 'char_value': 'y'}, {'int_value': 6, 'char_value': 'x'},
+                    {'int_value': 4, 'char_value': 'z'}]:
+            state = EvaluationState(obj)
+            self.assertEqual([table.eval(rule, obj, state) for rule in rules],
+                             [rule.eval(obj) for rule in rules])
+            self.assertEqual(table.eval(first, obj), first.eval(obj))
+
+    def test_intern_table_shares_subtrees(self):
+        table = InternTable()
+        rules = [
+            table.intern(P(int_value__gt=5, char_value='x') | P(int_value=1)),
+            table.intern(P(int_value=1) | P(char_value='x', int_value__gt=5)),
+            table.intern(P(int_value__lt=3) | P(char_value='x', int_value__gt=5)),
+        ]
+        self.assertIs(rules[0], rules[1])
+        obj = {'int_value': 6, 'char_value': 'x'}
+        state = EvaluationState(obj)
+        table.eval(rules[0], obj, state)
+        evaluated = len(state.results)
+        self.assertTrue(table.eval(rules[2], obj, state))
+        # The conjunction's result for the first rule is reused, so only the
+        # new disjunction is evaluated, and it short-circuits.
+        self.assertEqual(len(state.results), evaluated + 1)
+
+
+class TestImplication(TestCase):
+    def test_implies(self):
+        pairs = [
+            (P(a=1), P(a__in=[1, 2])),
+            (P(a__in=[1, 2]), P(a__gte=1)),
+            (P(a=None), P(a__isnull=True)),
+            (P(a__gt=5), P(a__gt=3)),
+            (P(a__gte=5), P(a__gt=4)),
+            (P(a__range=(1, 5)), P(a__lt=5)),
+            (P(a__gt=1, a__lt=5), P(a__range=(1, 5))),
+            (P(a__startswith='abc'), P(a__startswith='ab')),
+            (P(a__startswith='abc'), P(a__isnull=False)),
+            (P(a=1, b=2), P(a=1)),
+            (P(a=1, b=3), P(a=1) | P(b=2)),
+            (P(a=1) | P(a=2), P(a__in=[1, 2, 3])),
+            (P(m2ms__x=1), P(m2ms__x__in=[1, 2]) | P(m2ms__y=2)),
+            (~P(a__in=[1, 2]), ~P(a=1)),
+            (P(m2ms__x=1, m2ms__y=2), P(m2ms__x__in=[1, 3], m2ms__y__gte=2)),
+            (P(date_value__gt=date(2020, 1, 1)), P(date_value__gte=date(2019, 1, 1))),
+        ]
+        for predicate, other in pairs:
+            self.assertTrue(predicate.implies(other), (predicate, other))
+            self.assertTrue(predicate.is_subset_of(other), (predicate, other))
+
+    def test_does_not_imply(self):
+        pairs = [
+            (P(a=1), P(a=1, b=2)),
+            (P(a__gt=3), P(a__gt=5)),
+            (P(a__gte=5), P(a__gt=5)),
+            (P(a__gt=1, a__lt=5), P(a__in=[1, 2]) | P(a__gte=2)),
+            (P(a__gt=1), P(a__isnull=True)),
+            (P(a__icontains='x'), P(a__contains='x')),
+            (P(a=1), P(a='1')),
+            (P(a__gt=1), P(a__gt='x')),
+            # Separate lookups may match different related objects.
+            (P(P(m2ms__x=1), P(m2ms__y=2)), P(m2ms__x=1, m2ms__y=2)),
+            # In memory, these disjunctions are false without any m2ms.
+            (P(a=1), P(a=1) | P(m2ms__x=2)),
+            (P(a=1), P(m2ms=1) | P(a=1)),
+            (P(a=1), P(a=1) | P(b=2)),
+        ]
+        for predicate, other in pairs:
+            self.assertFalse(predicate.implies(other), (predicate, other))
+
+    def test_sound(self):
+        rand = Random(0)
+        objects = [{
+            'a': rand.choice([None, 0, 1, 2, 3, 4, 5]),
+            'm': [{'x': rand.randint(0, 3), 'y': rand.randint(0, 3)}
+                  for _ in range(rand.randint(0, 2))],
+            'l': [rand.randint(0, 3) for _ in range(rand.randint(0, 2))],
+        } for _ in range(200)]
+
+        def lookup():
+            query = rand.choice(['exact', 'in', 'gt', 'gte', 'lt', 'lte', 'range', 'isnull'])
+            rhs = {
+                'in': rand.sample(range(6), 2),
+                'range': tuple(sorted(rand.sample(range(7), 2))),
+                'isnull': rand.choice([True, False]),
+            }.get(query, rand.randint(0, 5))
+            return P(**{'%s__%s' % (rand.choice(['a', 'l', 'm__x', 'm__y']), query): rhs})
+
+        def predicate(depth=2):
+            if depth == 0 or rand.random() < 0.3:
+                return lookup()
+            kind = rand.choice(['and', 'or', 'not'])
+            if kind == 'not':
+                return ~predicate(depth - 1)
+            elif kind == 'and':
+                return predicate(depth - 1) & predicate(depth - 1)
+            return predicate(depth - 1) | predicate(depth - 1)
+
+        implied = 0
+        for _ in range(2000):
+            first, second = predicate(), predicate()
+            if first.implies(second):
+                implied += 1
+                self.assertTrue(all(second.eval(obj) for obj in first.filter(objects)),
+                                (first, second))
+        self.assertGreater(implied, 0)
+
+
+class TestFilterCache(TestCase):
+    def setUp(self):
+        self.objects = [{'number': i, 'name': 'n%d' % (i % 10)} for i in range(100)]
+        self.cache = FilterCache()
+        self.pqs = PredicateQuerySet(self.objects).cache_results(self.cache)
+
+    def assertEvaluates(self, pqs, expected, evaluations):
+        with mock.patch.object(P, 'eval', autospec=True, side_effect=original_eval) as patched:
+            self.assertEqual(list(pqs), expected)
+        self.assertEqual(patched.call_count, evaluations)
+
+    def test_refilters_superset(self):
+        wide = self.pqs.filter(number__gte=50)
+        self.assertEvaluates(wide, self.objects[50:], 100)
+        narrow = self.pqs.filter(number__range=(60, 70))
+        self.assertEvaluates(narrow, self.objects[61:70], 50)
+        self.assertEvaluates(narrow.filter(name='n5'), [self.objects[65]], 9)
+        self.assertEqual(self.cache.cache_info(), CacheInfo(2, 1, 32, 3))
+
+    def test_exact_hits(self):
+        self.assertEvaluates(self.pqs.filter(number__lt=10), self.objects[:10], 100)
+        self.assertEvaluates(self.pqs.filter(number__lt=10).order_by('-number'),
+                             self.objects[9::-1], 0)
+        self.assertEvaluates(self.pqs.exclude(number__gte=10), self.objects[:10], 100)
+        self.assertEqual(self.cache.cache_info().hits, 1)
+
+    def test_unrelated_predicates(self):
+        self.assertEvaluates(self.pqs.filter(number__lt=10), self.objects[:10], 100)
+        self.assertEvaluates(self.pqs.filter(name='n1'), self.objects[1::10], 100)
+        self.assertEqual(self.cache.cache_info().misses, 2)
+
+
+class TestBind(TestCase):
+    def setUp(self):
+        rand = Random(0)
+        self.objects = [{
+            'tenant_id': rand.randint(0, 3),
+            'is_active': rand.random() < 0.5,
+            'number': rand.randint(0, 6),
+            'tags': [{'name': rand.choice('abc')} for _ in range(rand.randint(0, 2))],
+        } for _ in range(300)]
+        self.predicate = (
+            (P(tenant_id=1, is_active=True) & (P(number__gt=3) | P(number=0)))
+            | P(tenant_id__in=[2, 3], number=5)
+            | ~P(tenant_id=0, tags__name='a'))
+
+    def test_constants(self):
+        predicate = P(tenant_id=1, is_active=True) | P(tenant_id=2, number=5)
+        self.assertIs(predicate.bind(tenant_id=3), False)
+        self.assertIs(predicate.bind(tenant_id=1, is_active=True), True)
+        self.assertIs((~predicate).bind(tenant_id=1, is_active=True), False)
+        self.assertIs(P().bind(tenant_id=1), True)
+
+    def test_residual(self):
+        predicate = P(tenant_id=1, is_active=True) | P(tenant_id__in=[2, 3], number=5)
+        residual = predicate.bind(tenant_id=2)
+        self.assertIsInstance(residual, P)
+        self.assertEqual(residual.fingerprint(), P(number=5).fingerprint())
+        fives = [obj for obj in self.objects if obj['number'] == 5]
+        self.assertEqual(
+            predicate.bind(number=5).filter(fives),
+            (P(tenant_id=1, is_active=True) | P(tenant_id__in=[2, 3])).filter(fives))
+
+    def test_matches_eval(self):
+        for obj in self.objects:
+            residual = self.predicate.bind(tenant_id=obj['tenant_id'], is_active=obj['is_active'])
+            expected = self.predicate.eval(obj)
+            if isinstance(residual, bool):
+                self.assertEqual(residual, expected, obj)
+            else:
+                self.assertEqual(residual.eval(obj), expected, obj)
+
+    def test_disjunction_across_relations(self):
+        # In memory, P(number=1) | P(tags__name='a') is false without tags,
+        # so binding number doesn't decide it.
+        predicate = P(number=1) | P(tags__name='a')
+        self.assertEqual(predicate.bind(number=1).fingerprint(), predicate.fingerprint())
+
+    def test_disjunction_with_relation(self):
+        obj = TestObj.objects.create(int_value=1)
+        predicate = P(m2ms=M2MModel.objects.create()) | P(int_value=1)
+        self.assertFalse(predicate.eval(obj))
+        self.assertEqual(predicate.bind(int_value=1).fingerprint(), predicate.fingerprint())
+        pqs = PredicateQuerySet([obj]).partition_by('int_value')
+        self.assertEqual(list(pqs.filter(predicate)), [])
+        predicate = P(tags='a') | P(number=1)
+        self.assertFalse(predicate.eval({'tags': [], 'number': 1}))
+        self.assertFalse(predicate.bind(number=1).eval({'tags': [], 'number': 1}))
+
+    def test_partition_by(self):
+        pqs = PredicateQuerySet(self.objects).partition_by('tenant_id', 'is_active')
+        with mock.patch.object(P, 'bind', autospec=True, side_effect=P.bind) as patched:
+            self.assertEqual(list(pqs.filter(self.predicate)), self.predicate.filter(self.objects))
+        self.assertEqual(patched.call_count, len(
+            {(obj['tenant_id'], obj['is_active']) for obj in self.objects}))
+
+    def test_partition_by_multi_valued(self):
+        pqs = PredicateQuerySet(self.objects).partition_by('tags__name')
+        predicate = P(tags__name='a') & P(number__lt=3)
+        self.assertEqual(list(pqs.filter(predicate)), predicate.filter(self.objects))
+
+
+Point = collections.namedtuple('Point', ['x', 'y'])
+if dataclasses is not None:
+    Record = dataclasses.make_dataclass(
+        'Record', ['name', 'owner', ('points', list, dataclasses.field(default_factory=list))])
+
+
+class Slotted(object):
+    __slots__ = ('name', 'unset')
+
+    def __init__(self, name):
+        self.name = name
+
+
+class TestAccessors(TestCase):
+    @skipUnless(dataclasses, 'dataclasses requires Python 3.7')
+    def test_plain_objects(self):
+        record = Record('a', {'name': 'b'}, [Point(1, 2), Point(3, 4)])
+        self.assertTrue(P(name='a', owner__name='b', points__x=3, points__y__gt=3).eval(record))
+        self.assertFalse(P(points__x=1, points__y=4).eval(record))
+        self.assertTrue(P(owner__name='c').eval({'owner': Slotted('c')}))
+
+    @skipUnless(dataclasses, 'dataclasses requires Python 3.7')
+    def test_missing(self):
+        for obj in [{'other': 1}, Record('a', None), Point(1, 2), Slotted('a')]:
+            with self.assertRaises(LookupNotFound):
+                P(missing=1).eval(obj)
+        with self.assertRaises(LookupNotFound):
+            P(unset=1).eval(Slotted('a'))
+
+    def test_same_type_different_attributes(self):
+        class Obj(object):
+            pass
+        first, second = Obj(), Obj()
+        first.value = 1
+        self.assertTrue(P(value=1).eval(first))
+        with self.assertRaises(LookupNotFound):
+            P(value=1).eval(second)
+
+    def test_dict_attributes_and_subclasses(self):
+        # Attributes of dicts are found before their keys, as before.
+        self.assertFalse(P(items=1).eval({'items': 1}))
+        counts = collections.defaultdict(int)
+        self.assertTrue(P(missing=0).eval(counts))
+        self.assertTrue(P(a=1).eval(collections.OrderedDict(a=1)))
+
+    def test_models(self):
+        obj = TestObj.objects.create(int_value=1)
+        self.assertTrue(P(int_value=1, onetoonemodel=None).eval(obj))
+        OneToOneModel.objects.create(test_obj=obj)
+        obj = TestObj.objects.get(pk=obj.pk)
+        self.assertTrue(P(onetoonemodel__test_obj__int_value=1).eval(obj))
+        obj.extra = 'x'
+        self.assertTrue(P(extra='x').eval(obj))
+
+
+class TestExpressions(TestCase):
+    def test_matches_orm(self):
+        make_test_objects()
+        # Negated comparisons with NULL are false in SQL, but true in memory.
+        objs = list(TestObj.objects.filter(parent__isnull=False).order_by('pk'))
+        for obj in objs[::3]:
+            M2MModel.objects.create(int_value=obj.int_value - 5).test_objs.add(obj)
+            M2MModel.objects.create(int_value=obj.int_value + 5).test_objs.add(obj)
+        predicates = [
+            P(int_value__gt=F('parent__int_value')),
+            ~P(int_value__lt=F('parent__int_value')),
+            P(int_value__gte=F('parent__int_value') + 10),
+            P(int_value__lt=F('parent__int_value') * 2 - F('parent__parent__int_value')),
+            P(int_value__lt=F('parent__int_value') / 3),
+            P(int_value=F('id')) | P(parent__int_value__gt=F('int_value') % 7),
+            P(m2ms__int_value__gt=F('int_value')),
+            P(m2ms__int_value__lt=F('int_value'), m2ms__int_value__gt=F('m2ms__id')),
+        ]
+        for predicate in predicates:
+            expected = set(TestObj.objects.filter(predicate, parent__isnull=False).values_list(
+                'pk', flat=True))
+            self.assertEqual({obj.pk for obj in predicate.filter(objs)}, expected, predicate)
+
+    def test_joint_rows(self):
+        obj = {'rows': [{'low': 1, 'high': 2}, {'low': 5, 'high': 3}]}
+        self.assertTrue(P(rows__high__gt=F('rows__low')).eval(obj))
+        self.assertFalse(P(rows__high__gt=F('rows__low'), rows__low=5).eval(obj))
+        self.assertFalse(P(rows__high__gt=F('missing__value')).eval({'rows': [], 'missing': []}))
+
+    def test_sql_semantics(self):
+        values = {'a': -7, 'b': 2, 'zero': 0, 'none': None}
+        self.assertEqual(evaluate_expression(F('a') / F('b'), values), -3)
+        self.assertEqual(evaluate_expression(F('a') % F('b'), values), -1)
+        self.assertEqual(evaluate_expression(F('a') / 2.0, values), -3.5)
+        self.assertIsNone(evaluate_expression(F('a') / F('zero'), values))
+        self.assertIsNone(evaluate_expression(F('a') + F('none'), values))
+        self.assertFalse(P(none=F('none')).eval(values))
+        self.assertTrue(P(b=F('a') % 3 + 3).eval(values))
+
+    def test_engines(self):
+        objects = [{'x': i % 5, 'y': i % 3, 'things': [{'x': i % 4}]} for i in range(30)]
+        predicates = [
+            P(x__gt=F('y')), P(x=F('y') + 1) | P(y=0), P(x=1, things__x=F('y')),
+            ~P(things__x__lt=F('x')),
+        ]
+        rules = PredicateSet(predicates)
+        engine = SQLiteEngine(objects)
+        for obj in objects:
+            self.assertEqual(rules.match(obj), [
+                i for i, predicate in enumerate(predicates) if predicate.eval(obj)])
+        for predicate in predicates:
+            self.assertEqual(engine.filter(predicate), predicate.filter(objects))
+            self.assertEqual(PredicateIndex(predicates).match(objects[4]), rules.match(objects[4]))
+
+    def test_bind_and_implication(self):
+        predicate = P(x__gt=F('y'), z=1)
+        self.assertEqual(predicate.bind(x=1), predicate)
+        self.assertIs(predicate.bind(z=2), False)
+        self.assertTrue(predicate.implies(P(x__gt=F('y'))))
+        self.assertFalse(P(x=F('y')).implies(P(x__gt=0)))
+        self.assertEqual(P(x=F('y') + 1).fingerprint(), P(x=F('y') + 1).fingerprint())
+
+
+class TestClassify(TestCase):
+    def setUp(self):
+        self.objects = [
+            {'n': i, 'owner': {'team': 'ab'[i % 2]}, 'tags': [{'name': 'x'}] * (i % 3)}
+            for i in range(12)]
+        self.predicates = collections.OrderedDict([
+            ('big', P(n__gte=8)), ('team_a', P(owner__team='a')), ('tagged', P(tags__name='x')),
+        ])
+
+    def test_partition(self):
+        predicate = P(n__lt=5) | P(owner__team='b')
+        self.assertEqual(predicate.partition(iter(self.objects)),
+                         (predicate.filter(self.objects), predicate.exclude(self.objects)))
+
+    def test_first_match(self):
+        buckets = classify(iter(self.objects), self.predicates, default='other')
+        self.assertEqual(list(buckets), ['big', 'team_a', 'tagged', 'other'])
+        self.assertEqual([obj['n'] for obj in buckets['big']], [8, 9, 10, 11])
+        self.assertEqual([obj['n'] for obj in buckets['team_a']], [0, 2, 4, 6])
+        self.assertEqual([obj['n'] for obj in buckets['tagged']], [1, 5, 7])
+        self.assertEqual([obj['n'] for obj in buckets['other']], [3])
+
+    def test_all_matches(self):
+        buckets = classify(self.objects, list(self.predicates.values()), first_match=False)
+        for i, predicate in enumerate(self.predicates.values()):
+            self.assertEqual(buckets[i], predicate.filter(self.objects))
+        self.assertEqual(buckets[None], [self.objects[3]])
+
+    def test_shares_fetches(self):
+        predicates = {'a': P(owner__team='a'), 'b': P(owner__team='b', n__gt=3)}
+        with mock.patch.object(
+                LookupComponent, 'values_list', autospec=True,
+                side_effect=LookupComponent.values_list) as patched:
+            classify(self.objects, predicates, first_match=False)
+        # owner, owner__team and n, once per object.
+        self.assertEqual(patched.call_count, 3 * len(self.objects))